@@ -0,0 +1,131 @@
+#!/usr/bin/env python
+#
+# Simplistic command line utility to compare the CPU time taken to
+# write a volume with tarfile, as TarPartition.tarfile_write used to,
+# and with TarWriter.
+#
+# A directory of many small files is created and written as a volume
+# of one partition, with the output discarded.  It is not
+# comprehensive but rather a starting point to be hacked up to
+# evaluate changes to writing volumes.
+
+import os
+import shutil
+import sys
+import tarfile
+import tempfile
+import time
+
+from wal_e import copyfileobj
+from wal_e import page_cache
+from wal_e import pipebuf
+from wal_e import tar_partition
+
+
+class StreamPadFileObj(object):
+    """
+    Layer on a file to provide a precise stream byte length
+
+    This file-like-object accepts an underlying file-like-object and a
+    target size.  Once the target size is reached, no more bytes will
+    be returned.  Furthermore, if the underlying stream runs out of
+    bytes, '\0' will be returned until the target size is reached.
+
+    TarPartition.tarfile_write used to read files through it; TarWriter
+    pads them out itself.
+    """
+
+    __slots__ = ('underlying_fp', 'target_size', 'pos')
+
+    def __init__(self, underlying_fp, target_size):
+        self.underlying_fp = underlying_fp
+        self.target_size = target_size
+        self.pos = 0
+
+    def read(self, size):
+        max_readable = min(self.target_size - self.pos, size)
+        ret = self.underlying_fp.read(max_readable)
+        lenret = len(ret)
+        self.pos += lenret
+        return ret + '\0' * (max_readable - lenret)
+
+    def close(self):
+        return self.underlying_fp.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.close()
+        return False
+
+
+class NullWriter(object):
+    def write(self, data):
+        pass
+
+
+def make_files(root, count, size):
+    payload = os.urandom(size)
+    for i in xrange(count):
+        directory = os.path.join(root, str(i % 100))
+        if not os.path.isdir(directory):
+            os.mkdir(directory)
+        with open(os.path.join(directory, str(i)), 'wb') as f:
+            f.write(payload)
+
+
+def tarfile_write(tpart, fileobj):
+    tar = tarfile.open(fileobj=fileobj, mode='w|',
+                       bufsize=pipebuf.PIPE_BUF_BYTES)
+    for et_info in tpart:
+        if et_info.tarinfo.isfile():
+            with page_cache.BackupReader(et_info.submitted_path) as raw_file:
+                with StreamPadFileObj(
+                        raw_file, et_info.tarinfo.size) as f:
+                    tar.addfile(et_info.tarinfo, f)
+        else:
+            tar.addfile(et_info.tarinfo)
+    tar.close()
+
+
+def bench(name, write, tpart, rounds):
+    best = None
+    for i in xrange(rounds):
+        cpu_start = time.clock()
+        write(tpart, NullWriter())
+        cpu = time.clock() - cpu_start
+        best = cpu if best is None else min(best, cpu)
+
+    print '{0}: {1:.3f}s of CPU'.format(name, best)
+    return best
+
+
+def main():
+    count = int(sys.argv[1]) if len(sys.argv) > 1 else 20000
+    size = int(sys.argv[2]) if len(sys.argv) > 2 else 8192
+    rounds = 3
+
+    # As backup-push does.
+    tarfile.copyfileobj = copyfileobj.copyfileobj
+
+    root = tempfile.mkdtemp()
+    try:
+        make_files(root, count, size)
+
+        tpart = tar_partition.TarPartition(0)
+        for et_info in tar_partition._ClusterWalker(
+                os.path.abspath(root) + os.path.sep, {'tablespaces': []}):
+            tpart.append(et_info)
+
+        print '{0} members of {1} bytes'.format(len(tpart), size)
+        before = bench('tarfile', tarfile_write, tpart, rounds)
+        after = bench('TarWriter',
+                      lambda tpart, f: tpart.tarfile_write(f), tpart, rounds)
+        print 'speedup: {0:.1f}x'.format(before / after)
+    finally:
+        shutil.rmtree(root)
+
+
+if __name__ == '__main__':
+    main()
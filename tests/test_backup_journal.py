@@ -0,0 +1,145 @@
+import os
+import pytest
+
+from wal_e import backup_journal
+from wal_e import manifest
+from wal_e import tar_partition
+from wal_e.exception import UserException
+
+
+def make_cluster(tmpdir):
+    cluster = tmpdir.join('cluster').ensure(dir=True)
+    for name in ('16385', '16386', '16387'):
+        relation = cluster.join('base', '1', name)
+        relation.dirpath().ensure(dir=True)
+        relation.write(name * 100)
+        os.utime(unicode(relation), (1000000, 1000000))
+    return cluster
+
+
+def names(parts):
+    return set(et_info.tarinfo.name for tpart in parts for et_info in tpart)
+
+
+def new_journal(tmpdir):
+    return backup_journal.BackupJournal.create(
+        unicode(tmpdir.join('.wal-e', backup_journal.JOURNAL_NAME)),
+        {'prefix': 's3://bucket/prefix', 'created': 1000000.5})
+
+
+def test_resume_skips_uploaded(tmpdir, monkeypatch):
+    monkeypatch.setattr(tar_partition, 'PARTITION_MAX_MEMBERS', 2)
+    cluster = make_cluster(tmpdir)
+    journal = new_journal(tmpdir)
+
+    backup_manifest = manifest.BackupManifest('base_1')
+    spec, parts = tar_partition.partition(unicode(cluster), backup_manifest,
+                                          resumed=journal)
+    parts = list(parts)
+    assert len(parts) > 2
+
+    # The first volume is uploaded, and the second one is interrupted.
+    journal.start(parts[0].name)
+    parts[0].tarfile_write(open(os.devnull, 'wb'), backup_manifest)
+    checksums = {'algorithm': 'sha256', 'raw': 'ab', 'compressed': 'cd'}
+    journal.complete(parts[0], backup_manifest, checksums=checksums)
+    journal.start(parts[1].name)
+
+    cluster.join('base', '1', '16385').write('changed')
+
+    journal = backup_journal.BackupJournal.load(journal.path)
+    assert journal.parts == 1
+    assert journal.header['created'] == 1000000.5
+    assert journal.unfinished() == [parts[1].name]
+    assert journal.checksums == {parts[0].name: checksums}
+
+    resumed_manifest = manifest.BackupManifest('base_1')
+    spec, resumed = tar_partition.partition(unicode(cluster),
+                                            resumed_manifest,
+                                            resumed=journal)
+    resumed = list(resumed)
+
+    # Unchanged members of the first volume are left out, and the
+    # volume left incomplete is numbered over first.
+    uploaded = names(parts[:1])
+    changed = 'base/1/16385'
+    assert names(resumed) == (names(parts) - uploaded) | (
+        set([changed]) & uploaded)
+    assert resumed[0].name == parts[1].name
+    assert [tpart.name for tpart in resumed[1:]] == range(
+        2, len(resumed) + 1)
+
+    for name in uploaded:
+        if name.startswith('base/1/1638') and name != changed:
+            assert resumed_manifest.files[name][manifest.PART] == 0
+
+
+def test_cut_short_record_ignored(tmpdir):
+    journal = new_journal(tmpdir)
+    journal.start(0)
+    journal.start(1)
+
+    with open(journal.path, 'ab') as f:
+        f.write('{"started": ')
+
+    assert backup_journal.BackupJournal.load(journal.path).unfinished() == [
+        0, 1]
+
+
+def test_missing_journal(tmpdir):
+    with pytest.raises(UserException):
+        backup_journal.BackupJournal.load(unicode(tmpdir.join('missing')))
+
+
+class RecordingPgBackupStatements(object):
+    stopped = 0
+
+    @classmethod
+    def run_start_backup(cls):
+        return {'file_name': '000000010000000000000002',
+                'file_offset': '00000028'}
+
+    @classmethod
+    def run_stop_backup(cls):
+        cls.stopped += 1
+        return {'file_name': '000000010000000000000002',
+                'file_offset': '00000130'}
+
+    @classmethod
+    def pg_version(cls):
+        return {'version': '9.6'}
+
+
+@pytest.mark.parametrize('resumable', [False, True])
+def test_failed_backup_stopped(tmpdir, monkeypatch, resumable):
+    from wal_e import storage
+    from wal_e.operator import backup
+
+    monkeypatch.setattr(RecordingPgBackupStatements, 'stopped', 0)
+    monkeypatch.setattr(backup, 'PgBackupStatements',
+                        RecordingPgBackupStatements)
+
+    def fail_after_a_volume(self, *args, **kwargs):
+        journal = kwargs['journal']
+        if journal is not None:
+            journal.start(0)
+            journal.complete(tar_partition.TarPartition(0))
+        raise IOError('connection reset')
+
+    monkeypatch.setattr(backup.Backup, '_upload_pg_cluster_dir',
+                        fail_after_a_volume)
+
+    cluster = make_cluster(tmpdir)
+    cxt = backup.Backup(storage.StorageLayout('s3://bucket/prefix'),
+                        None, None)
+    with pytest.raises(IOError):
+        cxt.database_backup(unicode(cluster), resumable=resumable)
+
+    path = backup_journal.journal_path(unicode(cluster))
+    if resumable:
+        # Left in progress, to be finished with --resume.
+        assert RecordingPgBackupStatements.stopped == 0
+        assert backup_journal.BackupJournal.load(path).parts == 1
+    else:
+        assert RecordingPgBackupStatements.stopped == 1
+        assert not os.path.exists(path)
@@ -0,0 +1,210 @@
+import collections
+import hashlib
+import os
+import pytest
+
+from cStringIO import StringIO
+from wal_e import chunk_store
+from wal_e import compression
+from wal_e import storage
+from wal_e import tar_partition
+from wal_e.exception import UserCritical
+from wal_e.exception import UserException
+from wal_e.worker.base import _DeleteFromContext
+
+try:
+    compression.CODECS['zstd'].check()
+except UserException:
+    pytestmark = pytest.mark.skip(reason='zstandard is not installed')
+
+Key = collections.namedtuple('Key', ['key', 'bucket_name'])
+
+LAYOUT = storage.StorageLayout('s3://bucket/prefix')
+
+
+class FakeBlobstore(object):
+    def __init__(self):
+        self.objects = {}
+
+    def uri_put_file(self, creds, uri, fp, content_encoding=None):
+        self.objects[uri] = fp.read()
+
+    def uri_get_file(self, creds, uri, conn=None):
+        return self.objects[uri]
+
+
+@pytest.fixture
+def blobstore(monkeypatch):
+    store = FakeBlobstore()
+    monkeypatch.setattr(chunk_store, 'CHUNK_SIZE', 65536)
+    monkeypatch.setattr(chunk_store, 'get_blobstore', lambda layout: store)
+    return store
+
+
+def make_cluster(tmpdir):
+    cluster = tmpdir.join('cluster').ensure(dir=True)
+    relation = cluster.join('base', '1', '16385')
+    relation.dirpath().ensure(dir=True)
+
+    # Two identical chunks, a distinct one, and a partial one.
+    relation.write('a' * 65536 * 2 + 'b' * 65536 + 'c' * 100, 'wb')
+    cluster.join('PG_VERSION').write('9.6\n')
+    os.utime(unicode(relation), (1000000, 1000000))
+    return cluster
+
+
+def backup(cluster, chunks):
+    spec, parts = tar_partition.partition(unicode(cluster))
+    volumes = []
+    for tpart in parts:
+        f = StringIO()
+        tpart.tarfile_write(f, chunks=chunks)
+        volumes.append(f.getvalue())
+
+    chunks.join()
+    return volumes
+
+
+def uploader(known=None):
+    return chunk_store.ChunkUploader(
+        None, LAYOUT, None,
+        compression=compression.Compression(compression.CODECS['zstd'], 1),
+        known=known)
+
+
+def test_chunked_round_trip(tmpdir, blobstore):
+    cluster = make_cluster(tmpdir)
+    chunks = uploader()
+    volumes = backup(cluster, chunks)
+
+    assert len(chunks.referenced) == 3
+    assert len(blobstore.objects) == 3
+    assert all(url.startswith('s3://bucket/prefix/chunks_005/')
+               and url.endswith('.zst') for url in blobstore.objects)
+    assert sum(len(v) for v in volumes) < 65536
+
+    dest = tmpdir.join('dest').ensure(dir=True)
+    restorer = chunk_store.ChunkRestorer(None, LAYOUT, False)
+    for data in volumes:
+        tar_partition.TarPartition.tarfile_extract(StringIO(data),
+                                                   unicode(dest),
+                                                   chunks=restorer)
+    restorer.join()
+
+    restored = dest.join('base', '1', '16385')
+    assert (restored.read('rb') ==
+            cluster.join('base', '1', '16385').read('rb'))
+    assert restored.mtime() == 1000000
+    assert dest.join('PG_VERSION').read() == '9.6\n'
+
+
+def test_stored_chunks_not_uploaded_again(tmpdir, blobstore):
+    cluster = make_cluster(tmpdir)
+    backup(cluster, uploader())
+
+    keys = [Key(LAYOUT.chunk_path(os.path.basename(url)), 'bucket')
+            for url in blobstore.objects]
+    keys.append(Key(LAYOUT.chunk_path('unexpected'), 'bucket'))
+    known = chunk_store.stored_chunks(LAYOUT, keys)
+    assert len(known) == 3
+
+    blobstore.objects.clear()
+    chunks = uploader(known)
+    backup(cluster, chunks)
+
+    assert blobstore.objects == {}
+    assert sorted(chunks.referenced) == sorted(known.values())
+
+
+def test_corrupt_chunk(tmpdir, blobstore):
+    cluster = make_cluster(tmpdir)
+    volumes = backup(cluster, uploader())
+
+    # Swap the contents of two chunks.
+    a, b = sorted(blobstore.objects)[:2]
+    blobstore.objects[a], blobstore.objects[b] = (blobstore.objects[b],
+                                                  blobstore.objects[a])
+
+    dest = tmpdir.join('dest').ensure(dir=True)
+    restorer = chunk_store.ChunkRestorer(None, LAYOUT, False)
+    with pytest.raises(UserCritical):
+        for data in volumes:
+            tar_partition.TarPartition.tarfile_extract(StringIO(data),
+                                                       unicode(dest),
+                                                       chunks=restorer)
+        restorer.join()
+
+
+class FakeInfo(object):
+    def __init__(self, chunks):
+        self.chunks = chunks
+
+
+class FakeDeleter(object):
+    def __init__(self):
+        self.deleted = []
+
+    def delete(self, key):
+        self.deleted.append(key)
+
+
+class FakeDeleteFromContext(_DeleteFromContext):
+    def __init__(self, keys):
+        super(FakeDeleteFromContext, self).__init__(None, LAYOUT, False)
+        self.keys = keys
+        self.deleter = FakeDeleter()
+
+    def _backup_list(self, prefix):
+        return [k for k in self.keys if k.key.startswith(prefix)]
+
+
+def test_unreferenced_chunks_deleted():
+    digests = [hashlib.sha256(str(i)).hexdigest() + '.zst'
+               for i in xrange(3)]
+    old = 'base_000000010000000000000002_00000020'
+    new = 'base_000000010000000000000004_00000020'
+
+    keys = [Key(LAYOUT.basebackups() + name + '_backup_stop_sentinel.json',
+                'bucket') for name in (old, new)]
+    keys += [Key(LAYOUT.chunk_path(name), 'bucket') for name in digests]
+
+    cxt = FakeDeleteFromContext(keys)
+    cxt._loaded_backups[old] = FakeInfo(digests[:2])
+    cxt._loaded_backups[new] = FakeInfo(digests[1:])
+
+    cxt._delete_unreferenced_chunks(storage.SegmentNumber(log='00000000',
+                                                          seg='00000003'))
+
+    assert cxt.deleter.deleted == [Key(LAYOUT.chunk_path(digests[0]),
+                                       'bucket')]
+
+
+@pytest.mark.parametrize('completed', [False, True])
+def test_chunks_kept_while_pushing(completed):
+    digests = [hashlib.sha256(str(i)).hexdigest() + '.zst'
+               for i in xrange(2)]
+    old = 'base_000000010000000000000002_00000020'
+    pushing = 'base_000000010000000000000004_00000020'
+
+    keys = [Key(LAYOUT.basebackups() + old + '_backup_stop_sentinel.json',
+                'bucket'),
+            Key(LAYOUT.basebackups() + pushing + '/' +
+                chunk_store.PUSH_MARKER, 'bucket')]
+    keys += [Key(LAYOUT.chunk_path(name), 'bucket') for name in digests]
+    if completed:
+        keys.append(Key(LAYOUT.basebackups() + pushing +
+                        '_backup_stop_sentinel.json', 'bucket'))
+
+    cxt = FakeDeleteFromContext(keys)
+    cxt._loaded_backups[old] = FakeInfo(digests[:1])
+    cxt._loaded_backups[pushing] = FakeInfo(digests[:1])
+
+    cxt._delete_unreferenced_chunks(storage.SegmentNumber(log='00000000',
+                                                          seg='00000003'))
+
+    if completed:
+        assert cxt.deleter.deleted == [Key(LAYOUT.chunk_path(digests[1]),
+                                           'bucket')]
+    else:
+        # The backup being taken may rely on any chunk.
+        assert cxt.deleter.deleted == []
@@ -0,0 +1,140 @@
+import pytest
+import re
+
+from wal_e import compression
+from wal_e import pipeline
+from wal_e import storage
+from wal_e.exception import UserCritical
+from wal_e.exception import UserException
+
+
+@pytest.fixture(params=['zstd', 'lz4'])
+def codec(request):
+    """Each in-process codec, skipping those not installed"""
+    codec = compression.CODECS[request.param]
+    try:
+        codec.check()
+    except UserException, e:
+        pytest.skip(e.msg)
+
+    return codec
+
+
+def create_bogus_payload(dirname):
+    payload = 'abcd' * 1048576 + ''.join(chr(i % 251) for i in xrange(65536))
+    payload_file = dirname.join('payload')
+    payload_file.write(payload, 'wb')
+    return payload, payload_file
+
+
+def test_parse():
+    c = compression.parse(None)
+    assert c.codec.name == 'lzo'
+    assert c.level is None
+    assert c.suffix == '.lzo'
+
+    c = compression.parse('lzo:9')
+    assert c.codec.name == 'lzo'
+    assert c.level == 9
+
+    with pytest.raises(UserException):
+        compression.parse('gzip')
+
+    with pytest.raises(UserException):
+        compression.parse('lzo:10')
+
+    with pytest.raises(UserException):
+        compression.parse('lzo:fast')
+
+
+def test_fetch_order():
+    c = compression.Compression(compression.CODECS['lz4'], None)
+    assert [codec.name for codec in c.fetch_order()] == ['lz4', 'lzo', 'zstd']
+    assert c.fetch_programs() == [pipeline.LZOP_BIN]
+
+
+def test_codec_for_name():
+    for codec in compression.CODECS.values():
+        name = 'part_00000001.tar' + codec.suffix
+        assert compression.codec_for_name(name) is codec
+        assert re.match(storage.VOLUME_REGEXP, name).group(1) == '00000001'
+
+    assert compression.codec_for_name('part_00000001.tar') is None
+    assert re.match(storage.VOLUME_REGEXP, 'part_00000001.tar.gz') is None
+
+
+def test_round_trip(tmpdir, codec):
+    payload, payload_file = create_bogus_payload(tmpdir)
+    c = compression.Compression(codec, codec.levels[0])
+
+    compressed = tmpdir.join('compressed' + codec.suffix)
+    with open(unicode(compressed), 'wb') as out:
+        with open(unicode(payload_file), 'rb') as inp:
+            with pipeline.get_upload_pipeline(inp, out, compression=c):
+                pass
+
+    assert compressed.size() < len(payload)
+
+    # Decompress through a pipe, as when downloading.
+    with pipeline.get_download_pipeline(pipeline.PIPE, pipeline.PIPE,
+                                        codec=codec) as pl:
+        pl.stdin.write(compressed.read('rb'))
+        pl.stdin.flush()
+        pl.stdin.close()
+        round_trip = pl.stdout.read()
+
+    assert round_trip == payload
+
+
+def test_between_processes(tmpdir, codec):
+    """In-process filters connect to processes on either side"""
+    payload, payload_file = create_bogus_payload(tmpdir)
+
+    commands = [pipeline.CatFilter(),
+                codec.compression_filter(),
+                codec.decompression_filter(),
+                pipeline.CatFilter()]
+
+    with open(unicode(payload_file), 'rb') as inp:
+        with pipeline.Pipeline(commands, inp, pipeline.PIPE) as pl:
+            round_trip = pl.stdout.read()
+
+    assert round_trip == payload
+
+
+def test_parallel_frames(monkeypatch, tmpdir, codec):
+    """Frames compressed by several threads come out in order"""
+    payload, payload_file = create_bogus_payload(tmpdir)
+
+    monkeypatch.setattr(pipeline, 'FRAME_SIZE', 65536)
+
+    compressed = tmpdir.join('compressed' + codec.suffix)
+    with open(unicode(compressed), 'wb') as out:
+        with open(unicode(payload_file), 'rb') as inp:
+            with pipeline.Pipeline([codec.compression_filter(threads=4)],
+                                   inp, out):
+                pass
+
+    with open(unicode(compressed), 'rb') as inp:
+        with pipeline.Pipeline([codec.decompression_filter()],
+                               inp, pipeline.PIPE) as pl:
+            round_trip = pl.stdout.read()
+
+    assert round_trip == payload
+
+
+def test_corrupt_input(codec):
+    with pytest.raises(UserCritical):
+        with pipeline.get_download_pipeline(pipeline.PIPE, pipeline.PIPE,
+                                            codec=codec) as pl:
+            pl.stdin.write('not compressed at all' * 100)
+            pl.stdin.flush()
+            pl.stdin.close()
+            pl.stdout.read()
+
+
+def test_wal_path_suffix():
+    layout = storage.StorageLayout('s3://bucket/prefix')
+    assert layout.wal_path('000000010000000000000001').endswith('.lzo')
+    assert layout.wal_path('000000010000000000000001', '.zst') == (
+        'prefix/wal_005/000000010000000000000001.zst')
@@ -0,0 +1,62 @@
+import os
+import pytest
+
+from wal_e import durability
+from wal_e import file_io
+
+
+@pytest.mark.parametrize('strategy', ['fsync', 'writeback'])
+def test_sync_by_fsync(monkeypatch, tmpdir, strategy):
+    """Files are synced when asked, their writeback started earlier
+
+    That the files and directories are then actually synced is tested
+    in test_tar_hacks, and that tarfile_extract passes the files it
+    extracted in test_blackbox.
+    """
+    monkeypatch.setattr(durability, '_libc', {'sync_file_range': None})
+    started = []
+    monkeypatch.setattr(durability, '_start_writeback', started.append)
+
+    filenames = [unicode(tmpdir.join(name).ensure())
+                 for name in ('foo', 'bar')]
+    synced = []
+
+    with file_io.using_threads(0):
+        engine = durability.Durability(strategy)
+        for filename in filenames:
+            engine.extracted(filename)
+        engine.sync(filenames, synced.extend)
+        engine.finish()
+
+    assert synced == filenames
+    assert started == (filenames if strategy == 'writeback' else [])
+    assert engine.files == len(filenames)
+    assert 'fsync' in engine.timings
+
+
+def test_syncfs_at_finish(monkeypatch, tmpdir):
+    synced = []
+    monkeypatch.setattr(durability, '_libc', {'syncfs': None})
+    monkeypatch.setattr(durability, '_syncfs', synced.append)
+    monkeypatch.setattr(os, 'fsync', None)
+
+    dira = tmpdir.join('dira').ensure(dir=True)
+    dirb = tmpdir.join('dirb').ensure(dir=True)
+    filenames = [unicode(dira.join('foo').ensure()),
+                 unicode(dirb.join('bar').ensure())]
+
+    engine = durability.Durability('syncfs')
+    engine.sync(filenames)
+    assert synced == []
+
+    # Both directories are on the one file system.
+    engine.finish()
+    assert len(synced) == 1
+    assert synced[0] in (unicode(dira), unicode(dirb))
+    assert 'syncfs' in engine.timings
+
+
+def test_unavailable_strategy(monkeypatch):
+    monkeypatch.setattr(durability, '_libc', {})
+    assert durability.Durability('syncfs').strategy == 'fsync'
+    assert durability.Durability('writeback').strategy == 'fsync'
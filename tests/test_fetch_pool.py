@@ -0,0 +1,81 @@
+import gevent
+
+from wal_e.worker import fetch_pool
+
+
+class FakeFetcher(object):
+    """Records the volumes it fetches, taking delay seconds for each
+
+    The first failures fetches raise an error instead.
+    """
+
+    def __init__(self, log, delay=0, failures=0):
+        self.log = log
+        self.delay = delay
+        self.failures = failures
+        self.fetched = []
+
+    def fetch_partition_once(self, name, members=None):
+        gevent.sleep(self.delay)
+        if self.failures:
+            self.failures -= 1
+            raise IOError('connection reset')
+
+        self.fetched.append(name)
+        self.log.append(name)
+
+
+def volumes(*sizes):
+    return [('part_{0}.tar.lzo'.format(i), size, None)
+            for i, size in enumerate(sizes)]
+
+
+def test_largest_first():
+    log = []
+    pool = fetch_pool.FetchPool(1)
+    pool.fetch([FakeFetcher(log)], volumes(10, 30, 20, 30))
+
+    assert log == ['part_1.tar.lzo', 'part_3.tar.lzo',
+                   'part_2.tar.lzo', 'part_0.tar.lzo']
+
+
+def test_work_stealing():
+    log = []
+    slow = FakeFetcher(log, delay=0.2)
+    fast = FakeFetcher(log, delay=0.01)
+
+    fetch_pool.FetchPool(2).fetch([slow, fast], volumes(*[1] * 10))
+
+    assert len(slow.fetched) == 1
+    assert len(fast.fetched) == 9
+    assert sorted(log) == sorted(name for name, _, _ in volumes(*[1] * 10))
+
+
+def test_retire_failing_connection():
+    log = []
+    bad = FakeFetcher(log, failures=100)
+    good = FakeFetcher(log, delay=0.15)
+
+    pool = fetch_pool.FetchPool(2, max_failures=2)
+    pool.fetch([bad, good], volumes(1, 2, 3))
+
+    assert bad.fetched == []
+    assert sorted(good.fetched) == sorted(log)
+    assert len(log) == 3
+    assert pool.live == set([1])
+
+    # The connection stays retired for the volumes of other backups.
+    bad.failures = 0
+    pool.fetch([bad, good], volumes(1))
+    assert bad.fetched == []
+
+
+def test_last_connection_retries():
+    log = []
+    flaky = FakeFetcher(log, failures=5)
+
+    pool = fetch_pool.FetchPool(1, max_failures=2)
+    pool.fetch([flaky], volumes(1))
+
+    assert log == ['part_0.tar.lzo']
+    assert pool.live == set([0])
@@ -0,0 +1,102 @@
+import errno
+import gevent
+import gevent.monkey
+import pytest
+import threading
+
+from wal_e import file_io
+from wal_e import page_cache
+
+# As wal_e.cmd may have patched time.sleep to be cooperative.
+block = gevent.monkey.get_original('time', 'sleep')
+
+
+def test_run_lets_greenlets_run():
+    main_thread = threading.current_thread()
+    ticks = []
+
+    def tick():
+        for i in xrange(5):
+            ticks.append(i)
+            gevent.sleep(0.01)
+
+    def slow_read():
+        # Blocks its thread, as a read of a slow disk would.
+        block(0.2)
+        return threading.current_thread()
+
+    g = gevent.spawn(tick)
+    assert file_io.run(slow_read) is not main_thread
+    assert ticks == range(5)
+    g.get()
+
+
+def test_run_raises(tmpdir):
+    with pytest.raises(EnvironmentError) as e:
+        file_io.run(open, unicode(tmpdir.join('missing')))
+
+    assert e.value.errno == errno.ENOENT
+
+
+def test_run_without_threads():
+    with file_io.using_threads(0):
+        assert file_io.run(threading.current_thread) is (
+            threading.current_thread())
+
+
+def test_using_threads():
+    """The pool is sized as asked, and stopped afterwards"""
+    pool = file_io._get_pool()
+
+    with file_io.using_threads(2):
+        scoped = file_io._get_pool()
+        assert scoped is not pool
+        assert scoped.maxsize == 2
+        file_io.run(threading.current_thread)
+
+    assert scoped.size == 0
+    assert file_io._get_pool() is pool
+
+
+def test_run_off_main_hub():
+    """Calls from other threads are made there, keeping the pool"""
+    pool = file_io._get_pool()
+    threads = []
+
+    def call():
+        threads.append(file_io.run(threading.current_thread))
+        threads.append(file_io.spawn(threading.current_thread).get())
+
+    t = threading.Thread(target=call)
+    t.start()
+    t.join()
+
+    assert threads == [t, t]
+    assert file_io._get_pool() is pool
+
+
+def test_cooperative_reader(tmpdir):
+    f = tmpdir.join('file')
+    f.write('x' * 10000)
+
+    with file_io.CooperativeReader.open(page_cache.BackupReader,
+                                        unicode(f)) as reader:
+        b = bytearray(4000)
+        assert reader.readinto(b) == 4000
+        assert reader.read(10000) == 'x' * 6000
+        assert reader.read(10) == ''
+
+
+def test_stall_monitor(monkeypatch):
+    monkeypatch.setattr(file_io, 'STALL_INTERVAL', 0.01)
+    monkeypatch.setattr(file_io, 'STALL_THRESHOLD', 0.05)
+
+    with file_io.StallMonitor('test') as monitor:
+        gevent.sleep(0.05)
+        # Blocks the hub.
+        block(0.2)
+        gevent.sleep(0.05)
+
+    assert monitor.stalls == 1
+    assert 0.15 < monitor.stalled < 1
+    assert monitor.longest == monitor.stalled
@@ -2,6 +2,7 @@ import errno
 import os
 import pytest
 
+from cStringIO import StringIO
 from wal_e import files
 
 
@@ -49,3 +50,13 @@ def test_explicit_deletion_without_exception(tmpdir):
         open(p)
 
     assert e.value.errno == errno.ENOENT
+
+
+def test_read_exactly():
+    fp = StringIO('abcdef')
+    assert files.read_exactly(fp, 4, 'thing') == 'abcd'
+
+    with pytest.raises(IOError) as e:
+        files.read_exactly(fp, 4, 'thing')
+
+    assert str(e.value) == 'truncated thing'
@@ -0,0 +1,131 @@
+import hashlib
+import json
+import os
+import tarfile
+
+from cStringIO import StringIO
+from wal_e import manifest
+from wal_e import tar_partition
+
+
+class FakeBackupInfo(object):
+    def __init__(self, name, backup_manifest, depends_on=None):
+        self.name = name
+        self.depends_on = depends_on
+
+        # Round trip through JSON, as with the backup sentinel.
+        self.manifest = json.loads(json.dumps(backup_manifest.as_dict()))
+
+
+def make_cluster(tmpdir):
+    cluster = tmpdir.join('cluster').ensure(dir=True)
+    cluster.join('base').ensure(dir=True)
+    cluster.join('base', 'cold').write('cold data')
+    cluster.join('base', 'hot').write('hot data')
+    return cluster
+
+
+def backup(cluster, name, parent=None):
+    """Partition and write a cluster, as backup-push does"""
+    backup_manifest = manifest.BackupManifest(name, parent=parent)
+    spec, parts = tar_partition.partition(unicode(cluster), backup_manifest)
+
+    volumes = {}
+    for tpart in parts:
+        f = StringIO()
+        tpart.tarfile_write(f, backup_manifest)
+        volumes[tpart.name] = f.getvalue()
+
+    return backup_manifest, volumes
+
+
+def age(path, seconds=3600):
+    """Make a file appear not to have changed for a while"""
+    st = os.stat(unicode(path))
+    os.utime(unicode(path), (st.st_atime - seconds, st.st_mtime - seconds))
+
+
+def member_names(volumes):
+    names = set()
+    for data in volumes.values():
+        with tarfile.open(fileobj=StringIO(data)) as tar:
+            names.update(m.name for m in tar if m.isfile())
+
+    return names
+
+
+def test_full_backup_manifest(tmpdir):
+    cluster = make_cluster(tmpdir)
+    backup_manifest, volumes = backup(cluster, 'base_1')
+
+    assert member_names(volumes) == set(['base/cold', 'base/hot'])
+    assert backup_manifest.depends_on() == []
+
+    entry = backup_manifest.files['base/cold']
+    assert entry[manifest.SIZE] == len('cold data')
+    assert entry[manifest.DIGEST] == hashlib.sha1('cold data').hexdigest()
+    assert entry[manifest.BACKUP] == 'base_1'
+    assert entry[manifest.PART] == 0
+
+
+def test_incremental_backup(tmpdir):
+    cluster = make_cluster(tmpdir)
+    age(cluster.join('base', 'cold'))
+    age(cluster.join('base', 'hot'))
+
+    first, volumes = backup(cluster, 'base_1')
+    assert member_names(volumes) == set(['base/cold', 'base/hot'])
+
+    cluster.join('base', 'hot').write('hotter data')
+    cluster.join('base', 'new').write('new data')
+
+    second, volumes = backup(cluster, 'base_2',
+                             parent=FakeBackupInfo('base_1', first))
+    assert member_names(volumes) == set(['base/hot', 'base/new'])
+    assert second.files['base/cold'][manifest.BACKUP] == 'base_1'
+    assert second.files['base/hot'][manifest.BACKUP] == 'base_2'
+    assert second.depends_on() == ['base_1']
+
+    # Files unchanged since an earlier ancestor refer to it directly.
+    third, volumes = backup(
+        cluster, 'base_3',
+        parent=FakeBackupInfo('base_2', second, depends_on=['base_1']))
+    assert third.files['base/cold'][manifest.BACKUP] == 'base_1'
+    assert third.depends_on() == ['base_1']
+
+
+def test_recently_modified_not_inherited(tmpdir):
+    """Files modified around the time of the parent are archived again"""
+    cluster = make_cluster(tmpdir)
+    age(cluster.join('base', 'cold'))
+
+    first, volumes = backup(cluster, 'base_1')
+    second, volumes = backup(cluster, 'base_2',
+                             parent=FakeBackupInfo('base_1', first))
+
+    assert member_names(volumes) == set(['base/hot'])
+
+
+def test_members_by_volume(tmpdir):
+    cluster = make_cluster(tmpdir)
+    age(cluster.join('base', 'cold'))
+
+    first, volumes = backup(cluster, 'base_1')
+    second, volumes = backup(cluster, 'base_2',
+                             parent=FakeBackupInfo('base_1', first))
+
+    child = FakeBackupInfo('base_2', second, depends_on=['base_1'])
+    assert manifest.members_by_volume(child.manifest, 'base_1') == {
+        0: set(['base/cold'])}
+
+
+def test_extract_members(tmpdir):
+    cluster = make_cluster(tmpdir)
+    backup_manifest, volumes = backup(cluster, 'base_1')
+
+    dest = tmpdir.join('dest').ensure(dir=True)
+    tar_partition.TarPartition.tarfile_extract(
+        StringIO(volumes[0]), unicode(dest), members=set(['base/cold']))
+
+    assert dest.join('base', 'cold').read() == 'cold data'
+    assert not dest.join('base', 'hot').check()
@@ -0,0 +1,89 @@
+import os
+import pytest
+
+from wal_e import page_cache
+
+
+@pytest.fixture
+def small_window(monkeypatch):
+    monkeypatch.setattr(page_cache, 'WINDOW', 16 * page_cache.PAGE_SIZE)
+    monkeypatch.setattr(page_cache, 'STATS', page_cache.ReadStats())
+
+
+def create_file(tmpdir, size):
+    payload = os.urandom(size)
+    f = tmpdir.join('payload')
+    f.write(payload, 'wb')
+    return payload, unicode(f)
+
+
+def read_all(reader, size=65536):
+    chunks = []
+    while True:
+        data = reader.read(size)
+        if not data:
+            break
+        chunks.append(data)
+
+    return ''.join(chunks)
+
+
+@pytest.mark.parametrize('direct_io', [False, True])
+def test_read(small_window, tmpdir, direct_io):
+    payload, path = create_file(tmpdir, 100 * page_cache.PAGE_SIZE + 123)
+
+    with page_cache.BackupReader(path, direct_io) as f:
+        assert read_all(f, 5000) == payload
+
+    assert page_cache.STATS.bytes_read == len(payload)
+
+
+@pytest.mark.parametrize('direct_io', [False, True])
+def test_readinto(small_window, tmpdir, direct_io):
+    payload, path = create_file(tmpdir, 20 * page_cache.PAGE_SIZE + 5)
+
+    buf = bytearray(len(payload) + 100)
+    with page_cache.BackupReader(path, direct_io) as f:
+        assert f.readinto(memoryview(buf)[:7]) == 7
+        assert f.readinto(memoryview(buf)[7:]) == len(payload) - 7
+        assert f.readinto(memoryview(buf)) == 0
+
+    assert buf[:len(payload)] == payload
+    assert page_cache.STATS.bytes_read == len(payload)
+
+
+def test_short_reads_only_at_end(small_window, tmpdir):
+    payload, path = create_file(tmpdir, 40 * page_cache.PAGE_SIZE)
+
+    with page_cache.BackupReader(path) as f:
+        assert len(f.read(30 * page_cache.PAGE_SIZE)) == (
+            30 * page_cache.PAGE_SIZE)
+        assert len(f.read(30 * page_cache.PAGE_SIZE)) == (
+            10 * page_cache.PAGE_SIZE)
+        assert f.read(1) == ''
+
+
+def test_drops_only_pages_not_cached(monkeypatch, small_window, tmpdir):
+    payload, path = create_file(tmpdir, 41 * page_cache.PAGE_SIZE + 100)
+
+    # Pretend every other page was cached before the file was read.
+    def resident(fd, offset, length):
+        return [i % 2 == 0 for i in xrange(length // page_cache.PAGE_SIZE)]
+
+    dropped = []
+
+    def advise(fd, offset, length, advice):
+        if advice == page_cache._POSIX_FADV_DONTNEED:
+            dropped.append((offset // page_cache.PAGE_SIZE,
+                            length // page_cache.PAGE_SIZE))
+
+    monkeypatch.setattr(page_cache, '_resident', resident)
+    monkeypatch.setattr(page_cache, '_advise', advise)
+
+    with page_cache.BackupReader(path) as f:
+        assert read_all(f) == payload
+
+    # Nothing is dropped beyond the end of the file, but the last page
+    # is, though only partly read.
+    assert sorted(dropped) == [(i, 1) for i in xrange(1, 42, 2)]
+    assert page_cache.STATS.pages_dropped == 21
@@ -0,0 +1,143 @@
+import hashlib
+import json
+import os
+import struct
+
+from cStringIO import StringIO
+from wal_e import manifest
+from wal_e import page_delta
+from wal_e import tar_partition
+from wal_e.page_delta import PAGE_SIZE
+
+
+def make_page(lsn, fill):
+    header = struct.pack('=II', lsn >> 32, lsn & 0xFFFFFFFF)
+    return header + fill * (PAGE_SIZE - len(header))
+
+
+def write_relation(path, pages):
+    with open(unicode(path), 'wb') as f:
+        for lsn, fill in pages:
+            f.write(make_page(lsn, fill))
+
+
+def age(path, seconds=3600):
+    st = os.stat(unicode(path))
+    os.utime(unicode(path), (st.st_atime - seconds, st.st_mtime - seconds))
+
+
+class FakeBackupInfo(object):
+    def __init__(self, name, backup_manifest, start_lsn):
+        self.name = name
+        self.depends_on = None
+        self.wal_segment_backup_start = '00000001{0:08X}{1:08X}'.format(
+            start_lsn >> 32, (start_lsn & 0xFFFFFFFF) >> 24)
+        self.wal_segment_offset_backup_start = '{0:08X}'.format(
+            start_lsn & 0xFFFFFF)
+        self.manifest = json.loads(json.dumps(backup_manifest.as_dict()))
+
+
+def backup(cluster, name, parent=None):
+    backup_manifest = manifest.BackupManifest(name, parent=parent,
+                                              page_deltas=True)
+    spec, parts = tar_partition.partition(unicode(cluster), backup_manifest)
+
+    volumes = []
+    for tpart in parts:
+        f = StringIO()
+        tpart.tarfile_write(f, backup_manifest)
+        volumes.append(f.getvalue())
+
+    return backup_manifest, volumes
+
+
+def test_lsn_from_segment():
+    assert page_delta.lsn_from_segment(
+        '000000010000000200000003', '00000010') == 0x203000010
+
+
+def test_is_relation():
+    assert page_delta.is_relation('base/16384/16385')
+    assert page_delta.is_relation('base/16384/16385.1')
+    assert page_delta.is_relation('global/1262')
+    assert page_delta.is_relation(
+        'pg_tblspc/16386/PG_9.6_201608131/16384/16387')
+    assert not page_delta.is_relation('base/16384/16385_vm')
+    assert not page_delta.is_relation('base/16384/16385_fsm')
+    assert not page_delta.is_relation('base/16384/PG_VERSION')
+    assert not page_delta.is_relation('pg_clog/0000')
+
+
+def test_page_scan(tmpdir):
+    path = tmpdir.join('16385')
+    write_relation(path, [(100, 'a'), (300, 'b'), (0, '\0'), (50, 'c'),
+                          (200, 'd')])
+
+    digest = hashlib.sha1()
+    scan = page_delta.PageScan(unicode(path), 5 * PAGE_SIZE, 4 * PAGE_SIZE,
+                               200, digest)
+    try:
+        # Modified since, never logged, and beyond the previous end.
+        assert list(scan.changed_pages()) == [1, 2, 4]
+        assert list(scan.changed_runs()) == [(1, 2), (4, 1)]
+        assert not scan.worthwhile()
+        assert digest.hexdigest() == hashlib.sha1(path.read('rb')).hexdigest()
+    finally:
+        scan.close()
+
+
+def test_delta_round_trip(tmpdir):
+    cluster = tmpdir.join('cluster').ensure(dir=True)
+    relation = cluster.join('base', '1', '16385')
+    relation.dirpath().ensure(dir=True)
+
+    old_pages = [(100 + i, chr(ord('a') + i)) for i in xrange(10)]
+    write_relation(relation, old_pages)
+    age(relation)
+
+    first, first_volumes = backup(cluster, 'base_1')
+
+    # Modify two pages, and extend the relation by another.
+    new_pages = list(old_pages)
+    new_pages[3] = (1000, 'X')
+    new_pages[7] = (1001, 'Y')
+    new_pages.append((1002, 'Z'))
+    write_relation(relation, new_pages)
+
+    parent = FakeBackupInfo('base_1', first, start_lsn=500)
+    second, second_volumes = backup(cluster, 'base_2', parent=parent)
+
+    entry = second.files['base/1/16385']
+    assert entry[manifest.BACKUP] == 'base_1'
+    assert entry[manifest.DELTAS] == [['base_2', 0]]
+    assert second.depends_on() == ['base_1']
+    assert len(second_volumes[0]) < 4 * PAGE_SIZE
+
+    # Restore the first backup, then apply the second on top.
+    dest = tmpdir.join('dest').ensure(dir=True)
+    for volumes in (first_volumes, second_volumes):
+        for data in volumes:
+            tar_partition.TarPartition.tarfile_extract(StringIO(data),
+                                                       unicode(dest))
+
+    assert (dest.join('base', '1', '16385').read('rb') ==
+            relation.read('rb'))
+
+
+def test_delta_shrink(tmpdir):
+    target = tmpdir.join('target')
+    write_relation(target, [(1, 'a')] * 4)
+
+    source = tmpdir.join('source')
+    write_relation(source, [(1, 'a'), (9, 'b')])
+
+    scan = page_delta.PageScan(unicode(source), 2 * PAGE_SIZE,
+                               4 * PAGE_SIZE, 5, hashlib.sha1())
+    try:
+        delta = page_delta.DeltaReader(scan).read(scan.delta_size + 1)
+    finally:
+        scan.close()
+
+    assert len(delta) == scan.delta_size
+    page_delta.apply_delta(StringIO(delta), unicode(target))
+    assert target.read('rb') == source.read('rb')
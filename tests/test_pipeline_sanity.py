@@ -1,5 +1,7 @@
+import hashlib
 import pytest
 
+from wal_e import checksum
 from wal_e import pipeline
 from wal_e import pipebuf
 
@@ -49,6 +51,26 @@ def test_upload_download_pipeline(tmpdir, rate_limit):
     assert round_trip == payload
 
 
+def test_checksums(tmpdir):
+    """Both ends of an upload pipeline are digested"""
+    payload, payload_file = create_bogus_payload(tmpdir)
+    checksums = checksum.Checksums()
+
+    test_upload = tmpdir.join('upload')
+    with open(unicode(test_upload), 'w') as upload:
+        with open(unicode(payload_file)) as inp:
+            with pipeline.get_upload_pipeline(
+                    inp, upload, lzop=False, checksums=checksums):
+                pass
+
+    assert test_upload.read() == payload
+    digest = hashlib.sha256(payload).hexdigest()
+    assert checksums.as_dict() == {'algorithm': 'sha256',
+                                   'raw': digest,
+                                   'compressed': digest}
+    assert checksums.md5.digest() == hashlib.md5(payload).digest()
+
+
 def test_close_process_when_normal():
     """Process leaks must not occur in successful cases"""
     with pipeline.get_cat_pipeline(pipeline.PIPE, pipeline.PIPE) as pl:
@@ -0,0 +1,189 @@
+import gevent
+import hashlib
+import os
+import socket
+import tarfile
+
+import pytest
+
+from cStringIO import StringIO
+from wal_e import pipebuf
+from wal_e import pipeline
+from wal_e import tar_partition
+from wal_e.worker import upload
+
+
+class FakeKey(object):
+    def __init__(self, size):
+        self.size = size
+
+
+class FakeMultipartUpload(object):
+    part_size = 1024
+    uploads = []
+
+    def __init__(self, creds, uri, content_encoding=None):
+        self.uri = uri
+        self.parts = {}
+        self.completed = False
+        self.aborted = False
+        self.failures = {}
+        FakeMultipartUpload.uploads.append(self)
+
+    def put_part(self, part_number, data):
+        failure = self.failures.get(part_number)
+        if failure is not None:
+            self.failures[part_number] = None
+            raise failure
+
+        self.parts[part_number] = data
+
+    def complete(self, metadata=None):
+        self.completed = True
+        self.metadata = metadata
+        return FakeKey(len(self.contents()))
+
+    def abort(self):
+        self.aborted = True
+
+    def contents(self):
+        return ''.join(self.parts[n] for n in sorted(self.parts))
+
+
+class FakeBlobstore(object):
+    MultipartUpload = FakeMultipartUpload
+
+
+@pytest.fixture
+def uploader(monkeypatch):
+    # Use a pass-through pipeline so that lzop is not required.
+    real_upload_pipeline = pipeline.get_upload_pipeline
+
+    def cat_upload_pipeline(in_fd, out_fd, rate_limit=None, gpg_key=None,
+                            compression=None, checksums=None):
+        return real_upload_pipeline(in_fd, out_fd, lzop=False,
+                                    checksums=checksums)
+
+    monkeypatch.setattr(pipeline, 'get_upload_pipeline', cat_upload_pipeline)
+    monkeypatch.setattr(FakeMultipartUpload, 'uploads', [])
+
+    pu = upload.PartitionUploader(None, 's3://bucket/base_backup', None,
+                                  None)
+    pu.blobstore = FakeBlobstore
+    pu.stream = True
+    return pu
+
+
+def make_tpart(tmpdir, sizes):
+    tpart = tar_partition.TarPartition(7)
+    for i, size in enumerate(sizes):
+        f = tmpdir.join('file{0}'.format(i))
+        f.write(os.urandom(size), mode='wb')
+
+        ti = tarfile.TarInfo(f.basename)
+        ti.size = size
+        tpart.append(tar_partition.ExtendedTarInfo(
+            submitted_path=unicode(f), tarinfo=ti))
+
+    return tpart
+
+
+def test_stream_upload(uploader, tmpdir):
+    tpart = make_tpart(tmpdir, [5000, 0, 3000])
+    assert uploader(tpart) is tpart
+
+    mpu, = FakeMultipartUpload.uploads
+    assert mpu.uri == ('s3://bucket/base_backup/tar_partitions/'
+                       'part_00000007.tar.lzo')
+    assert mpu.completed
+    assert not mpu.aborted
+    assert len(mpu.parts) > 1
+    assert all(len(mpu.parts[n]) == FakeMultipartUpload.part_size
+               for n in sorted(mpu.parts)[:-1])
+
+    with tarfile.open(fileobj=StringIO(mpu.contents())) as tar:
+        for et_info in tpart:
+            member = tar.extractfile(et_info.tarinfo.name)
+            with open(et_info.submitted_path, 'rb') as f:
+                assert member.read() == f.read()
+
+    digest = hashlib.sha256(mpu.contents()).hexdigest()
+    assert mpu.metadata == {'sha256': digest, 'raw-sha256': digest}
+
+
+def test_stream_upload_part_retry(uploader, tmpdir, monkeypatch):
+    tpart = make_tpart(tmpdir, [5000])
+
+    real_init = FakeMultipartUpload.__init__
+
+    def flaky_init(self, *args, **kwargs):
+        real_init(self, *args, **kwargs)
+        self.failures[2] = socket.error('connection reset')
+
+    monkeypatch.setattr(FakeMultipartUpload, '__init__', flaky_init)
+
+    uploader(tpart)
+
+    mpu, = FakeMultipartUpload.uploads
+    assert mpu.completed
+    assert 2 in mpu.parts
+
+
+def test_stream_upload_abort(uploader, tmpdir, monkeypatch):
+    tpart = make_tpart(tmpdir, [5000])
+
+    real_init = FakeMultipartUpload.__init__
+
+    def broken_init(self, *args, **kwargs):
+        real_init(self, *args, **kwargs)
+        self.failures[1] = Exception('Boom')
+
+    monkeypatch.setattr(FakeMultipartUpload, '__init__', broken_init)
+
+    with pytest.raises(Exception) as e:
+        uploader(tpart)
+
+    assert str(e.value) == 'Boom'
+
+    mpu, = FakeMultipartUpload.uploads
+    assert mpu.aborted
+    assert not mpu.completed
+
+
+def test_stream_fallback():
+    """Blob stores without multipart support use temporary files."""
+
+    pu = upload.PartitionUploader(None, 'gs://bucket/base_backup', None,
+                                  None, stream=True)
+    assert not pu.stream
+
+
+def test_stream_upload_parts_held(uploader, tmpdir, monkeypatch):
+    """No more than PARTS_IN_FLIGHT parts are held at once"""
+    tpart = make_tpart(tmpdir, [20000])
+    held = [0]
+    most = [0]
+
+    real_read = pipebuf.NonBlockBufferedReader.read
+
+    def counting_read(self, size=None):
+        data = real_read(self, size)
+        if size == FakeMultipartUpload.part_size and data:
+            # A part read is held until it is sent.
+            held[0] += 1
+            most[0] = max(most[0], held[0])
+        return data
+
+    real_put_part = FakeMultipartUpload.put_part
+
+    def slow_put_part(self, part_number, data):
+        gevent.sleep(0.01)
+        real_put_part(self, part_number, data)
+        held[0] -= 1
+
+    monkeypatch.setattr(pipebuf.NonBlockBufferedReader, 'read',
+                        counting_read)
+    monkeypatch.setattr(FakeMultipartUpload, 'put_part', slow_put_part)
+
+    uploader(tpart)
+    assert most[0] == upload.PARTS_IN_FLIGHT
@@ -0,0 +1,186 @@
+import gevent
+import os
+import pytest
+
+from cStringIO import StringIO
+from wal_e.blobstore import streaming
+from wal_e.blobstore.s3 import s3_util
+from wal_e.blobstore.wabs import wabs_util
+
+from azure.common import AzureHttpError
+
+
+class RecordingStream(object):
+    """Records the writes made to it"""
+
+    def __init__(self):
+        self.writes = []
+        self.closed = False
+
+    def write(self, data):
+        self.writes.append(data)
+
+    def flush(self):
+        pass
+
+    def close(self):
+        self.closed = True
+
+
+class FakeBody(object):
+    def __init__(self, data):
+        self.f = StringIO(data)
+        self.reads = []
+
+    def read(self, size=-1):
+        self.reads.append(size)
+        return self.f.read(size)
+
+    def close(self):
+        pass
+
+
+class FakeKey(object):
+    def __init__(self, data):
+        self.body = FakeBody(data)
+
+    def get(self):
+        return {'Body': self.body}
+
+
+@pytest.fixture
+def small_chunks(monkeypatch):
+    monkeypatch.setattr(streaming, 'CHUNK_SIZE', 10)
+
+
+def test_s3_chunks(small_chunks):
+    key = FakeKey('x' * 25)
+    stream = RecordingStream()
+
+    assert s3_util.write_and_return_error(key, stream) is None
+    assert stream.writes == ['x' * 10, 'x' * 10, 'x' * 5]
+    assert set(key.body.reads) == set([10])
+    assert stream.closed
+
+
+def test_error_returned():
+    def broken(stream):
+        raise IOError('Boom')
+
+    stream = RecordingStream()
+    e = streaming.write_and_return_error(broken, stream)
+
+    assert isinstance(e, IOError)
+    assert stream.closed
+
+
+class FakeBlob(object):
+    def __init__(self, content, content_range):
+        self.content = content
+        self.properties = type('Properties', (), {})()
+        self.properties.content_range = content_range
+
+
+class FakeBlockBlobService(object):
+    def __init__(self, data):
+        self.data = data
+
+    def get_blob_to_bytes(self, container, path, start_range, end_range,
+                          max_connections):
+        if start_range >= len(self.data):
+            raise AzureHttpError('range not satisfiable', 416)
+
+        content = self.data[start_range:end_range + 1]
+        return FakeBlob(content, 'bytes {0}-{1}/{2}'.format(
+            start_range, start_range + len(content) - 1, len(self.data)))
+
+
+@pytest.mark.parametrize('size', [0, 10, 25])
+def test_wabs_ranges(small_chunks, size):
+    stream = RecordingStream()
+    conn = FakeBlockBlobService('x' * size)
+
+    assert wabs_util.write_and_return_error(
+        'wabs://container/path', conn, stream) is None
+    assert ''.join(stream.writes) == conn.data
+    assert all(len(data) <= 10 for data in stream.writes)
+
+
+class RangeReader(object):
+    """Reads ranges of data, the first ones slowest"""
+
+    def __init__(self, data, log):
+        self.data = data
+        self.log = log
+
+    def __call__(self, start, end):
+        self.log.append(start)
+        gevent.sleep(0.01 * max(0, 3 - len(self.log)))
+        return self.data[start:end + 1]
+
+
+@pytest.mark.parametrize('size', [0, 7, 10, 95])
+def test_ranges_in_order(small_chunks, size):
+    data = ''.join(chr(ord('a') + i // 10) for i in xrange(size))
+    log = []
+    stream = RecordingStream()
+
+    streaming.write_ranges([RangeReader(data, log) for i in xrange(3)],
+                           size, stream)
+
+    assert ''.join(stream.writes) == data
+    assert sorted(log) == range(0, size, 10)
+
+
+def test_ranges_read_ahead_bounded(small_chunks):
+    data = 'x' * 100
+    log = []
+
+    class StalledStream(RecordingStream):
+        def write(self, data):
+            gevent.sleep(1)
+
+    g = gevent.spawn(streaming.write_ranges,
+                     [RangeReader(data, log) for i in xrange(2)],
+                     len(data), StalledStream())
+    gevent.sleep(0.1)
+    g.kill()
+
+    # The range being written counts towards those read ahead.
+    assert len(log) == streaming.READ_AHEAD * 2
+
+
+def test_ranges_error(small_chunks):
+    def broken(start, end):
+        if start == 20:
+            raise IOError('Boom')
+        return 'x' * (end - start + 1)
+
+    with pytest.raises(IOError):
+        streaming.write_ranges([broken, broken], 50, RecordingStream())
+
+
+def test_ranges_short(small_chunks):
+    with pytest.raises(IOError):
+        streaming.write_ranges([lambda start, end: 'x'], 5,
+                               RecordingStream())
+
+
+class FakeRangedKey(object):
+    def __init__(self, data):
+        self.data = data
+        self.content_length = len(data)
+
+    def get(self, Range):
+        start, end = map(int, Range[len('bytes='):].split('-'))
+        return {'Body': FakeBody(self.data[start:end + 1])}
+
+
+def test_s3_ranges(small_chunks):
+    data = os.urandom(33)
+    stream = RecordingStream()
+    keys = [FakeRangedKey(data) for i in xrange(4)]
+
+    assert s3_util.write_ranges_and_return_error(keys, stream) is None
+    assert ''.join(stream.writes) == data
+    assert stream.closed
@@ -106,7 +106,7 @@ def test_dynamically_emptied_directories(tmpdir):
 def test_creation_upper_dir(tmpdir, monkeypatch):
     """Check for upper-directory creation in untarring
 
-    This affected the special "cat" based extraction works when no
+    This affected the special extraction of large files when no
     upper level directory is present.  Using that path depends on
     PIPE_BUF_BYTES, so test that integration via monkey-patching it to
     a small value.
@@ -126,20 +126,20 @@ def test_creation_upper_dir(tmpdir, monkeypatch):
     tar.add(unicode(some_file))
     tar.close()
 
-    # Replace cat_extract with a version that does the same, but
+    # Replace file_extract with a version that does the same, but
     # ensures that it is called by the test.
-    original_cat_extract = tar_partition.cat_extract
+    original_file_extract = tar_partition.file_extract
 
-    class CheckCatExtract(object):
+    class CheckFileExtract(object):
         def __init__(self):
             self.called = False
 
         def __call__(self, *args, **kwargs):
             self.called = True
-            return original_cat_extract(*args, **kwargs)
+            return original_file_extract(*args, **kwargs)
 
-    check = CheckCatExtract()
-    monkeypatch.setattr(tar_partition, 'cat_extract', check)
+    check = CheckFileExtract()
+    monkeypatch.setattr(tar_partition, 'file_extract', check)
     monkeypatch.setattr(pipebuf, 'PIPE_BUF_BYTES', 1)
 
     dest_dir = tmpdir.join('dest')
@@ -147,5 +147,253 @@ def test_creation_upper_dir(tmpdir, monkeypatch):
     with open(tar_path) as f:
         tar_partition.TarPartition.tarfile_extract(f, unicode(dest_dir))
 
-    # Make sure the test exercised cat_extraction.
+    # Make sure the test exercised file_extract.
     assert check.called
+
+
+def test_file_extract_chunks(tmpdir, monkeypatch):
+    """Check large files are extracted whole a chunk at a time"""
+    monkeypatch.setattr(tar_partition, 'EXTRACT_CHUNK_SIZE', 1000)
+
+    data = os.urandom(10 * 1000 + 7)
+    some_file = tmpdir.join('afile')
+    some_file.write(data, 'wb')
+
+    tar_path = unicode(tmpdir.join('foo.tar'))
+    tar = tarfile.open(name=tar_path, mode='w')
+    tar.add(unicode(some_file), arcname='afile')
+    tar.close()
+
+    dest = tmpdir.join('dest', 'afile')
+    with tarfile.open(name=tar_path, mode='r') as tar:
+        tar_partition.file_extract(tar, tar.getmember('afile'),
+                                   unicode(dest))
+
+    assert dest.read('rb') == data
+    assert dest.mtime() == int(some_file.mtime())
+
+
+def make_et_infos(sizes):
+    et_infos = []
+    for i, size in enumerate(sizes):
+        tarinfo = tarfile.TarInfo('file{0}'.format(i))
+        tarinfo.size = size
+        et_infos.append(tar_partition.ExtendedTarInfo(
+            submitted_path='/file{0}'.format(i), tarinfo=tarinfo))
+
+    return et_infos
+
+
+def plan_sizes(plan):
+    return [sum(et_info.tarinfo.size for et_info in members)
+            for members in plan]
+
+
+def plan_partitions(et_infos, max_partition_size, max_members):
+    plan = tar_partition._plan_partitions(
+        [et_info.tarinfo.size for et_info in et_infos],
+        max_partition_size, max_members)
+    return [[et_infos[i] for i in planned] for planned in plan]
+
+
+def test_plan_partitions_balanced(monkeypatch):
+    """Partitions come out close to equal, largest first"""
+    monkeypatch.setattr(tar_partition, 'PARTITION_MEMBER_COST', 0)
+
+    # Greedy sequential segmentation of these at a maximum of 100
+    # yields partitions of sizes 90, 90 and 70.
+    sizes = [50, 40, 50, 40, 30, 30, 10]
+    plan = plan_partitions(make_et_infos(sizes), 100, 100)
+
+    assert len(plan) == 3
+    assert sorted(plan_sizes(plan), reverse=True) == plan_sizes(plan)
+    assert max(plan_sizes(plan)) - min(plan_sizes(plan)) <= 10
+
+    # Every member is planned exactly once, in original order within
+    # its partition.
+    names = [et_info.tarinfo.name for members in plan for et_info in members]
+    assert sorted(names) == sorted('file{0}'.format(i)
+                                   for i in xrange(len(sizes)))
+    for members in plan:
+        indexes = [int(et_info.tarinfo.name[4:]) for et_info in members]
+        assert indexes == sorted(indexes)
+
+
+def test_plan_partitions_limits(monkeypatch):
+    """Size and member limits are never exceeded"""
+    monkeypatch.setattr(tar_partition, 'PARTITION_MEMBER_COST', 0)
+
+    sizes = [99, 98, 97] + [0] * 20 + [1] * 20
+    plan = plan_partitions(make_et_infos(sizes), 100, 8)
+
+    for members in plan:
+        assert len(members) <= 8
+        assert sum(et_info.tarinfo.size for et_info in members) <= 100
+
+    assert sum(len(members) for members in plan) == len(sizes)
+
+
+def test_plan_partitions_member_cost():
+    """Many small members are spread out, not piled into one partition"""
+    sizes = [0] * 1000
+    plan = plan_partitions(
+        make_et_infos(sizes),
+        tar_partition.PARTITION_MEMBER_COST * 300, 1000)
+
+    assert [len(members) for members in plan] == [250] * 4
+
+
+def test_partition_walk(tmpdir):
+    """The cluster directory and its tablespaces are walked as before"""
+    cluster = tmpdir.join('cluster').ensure(dir=True)
+    cluster.join('PG_VERSION').write('9.6')
+    cluster.join('postmaster.pid').write('1')
+    cluster.join('postgresql.conf').write('')
+    cluster.join('pg_xlog', '000000010000000000000001').ensure()
+    cluster.join('base', '1', '1234').ensure()
+    cluster.join('base', 'pgsql_tmp', 'tmp1').ensure()
+    cluster.join('lost+found', 'junk').ensure()
+    cluster.join('empty').ensure(dir=True)
+
+    ts_loc = tmpdir.join('tablespace').ensure(dir=True)
+    ts_loc.join('PG_9.6', '1', '5678').ensure()
+    ts_loc.join('PG_9.6', '2').ensure(dir=True)
+    cluster.join('pg_tblspc').ensure(dir=True)
+    cluster.join('pg_tblspc', '16386').mksymlinkto(ts_loc)
+
+    spec, parts = tar_partition.partition(unicode(cluster))
+    names = [et_info.tarinfo.name for tpart in parts for et_info in tpart]
+
+    assert sorted(names) == sorted([
+        '', 'PG_VERSION', 'pg_xlog', 'base', 'base/1', 'base/1/1234',
+        'base/pgsql_tmp', 'empty', 'pg_tblspc',
+        'pg_tblspc/16386/PG_9.6', 'pg_tblspc/16386/PG_9.6/1/5678',
+        'pg_tblspc/16386/PG_9.6/2'])
+    assert spec['tablespaces'] == ['16386']
+    assert spec['16386'] == {'loc': unicode(ts_loc) + os.path.sep,
+                             'link': 'pg_tblspc/16386'}
+
+    # Directories precede their contents.
+    assert names.index('base/1') < names.index('base/1/1234')
+
+
+def test_partitions_planned_while_walking(monkeypatch, tmpdir):
+    """Partitions are generated before all members are produced"""
+    monkeypatch.setattr(tar_partition, 'PARTITION_MEMBER_COST', 0)
+    monkeypatch.setattr(tar_partition, 'PARTITION_PLAN_WINDOW', 2)
+
+    root = unicode(tmpdir) + os.path.sep
+    produced = []
+
+    def et_infos():
+        for et_info in make_et_infos([50] * 20):
+            et_info = et_info._replace(
+                submitted_path=root + et_info.tarinfo.name)
+            produced.append(et_info)
+            yield et_info
+
+    parts = tar_partition._segmentation_guts(root, et_infos(), 100)
+    first = next(parts)
+    assert len(produced) < 20
+
+    parts = [first] + list(parts)
+    assert [tpart.name for tpart in parts] == range(len(parts))
+    assert sum(len(tpart) for tpart in parts) == 20
+    assert max(plan_sizes(parts)) <= 100
+
+
+def test_partitions_by_device(monkeypatch, tmpdir):
+    """Members on different devices are not partitioned together"""
+    cluster = tmpdir.join('cluster').ensure(dir=True)
+    cluster.join('base', '1', '1234').ensure()
+    ts_loc = tmpdir.join('tablespace').ensure(dir=True)
+    ts_loc.join('PG_9.6', '1', '5678').ensure()
+    cluster.join('pg_tblspc').ensure(dir=True)
+    ts_link = cluster.join('pg_tblspc', '16386')
+    ts_link.mksymlinkto(ts_loc)
+
+    # Pretend the tablespace is on a device of its own.
+    real_stat = os.stat
+
+    def fake_stat(path):
+        st = real_stat(path)
+        if path.startswith(unicode(ts_link)):
+            st = os.stat_result(st[:2] + (st.st_dev + 1,) + st[3:])
+        return st
+
+    monkeypatch.setattr(os, 'stat', fake_stat)
+
+    spec, parts = tar_partition.partition(unicode(cluster))
+    devices = {}
+    for tpart in parts:
+        for et_info in tpart:
+            devices[et_info.tarinfo.name] = tpart.device
+
+    cluster_dev = real_stat(unicode(cluster)).st_dev
+    assert devices['base/1/1234'] == cluster_dev
+    assert devices['pg_tblspc/16386/PG_9.6/1/5678'] == cluster_dev + 1
+
+
+def test_member_table_round_trip(tmpdir):
+    """TarInfos built from a MemberTable are as they were added"""
+    tmpdir.join('dir', 'file').ensure().write('contents')
+    tmpdir.join('link').mksymlinkto('dir/file')
+
+    root = unicode(tmpdir) + os.path.sep
+    bogus_tar = tarfile.TarFile(os.devnull, 'w', dereference=False)
+    table = tar_partition.MemberTable()
+    tpart = tar_partition.TarPartition(0, table)
+    originals = []
+    for name in ('', 'dir', 'dir/file', 'link'):
+        et_info = tar_partition.ExtendedTarInfo(
+            submitted_path=root + name,
+            tarinfo=bogus_tar.gettarinfo(root + name, arcname=name))
+        originals.append(et_info)
+        tpart.append(et_info)
+
+    for original, rebuilt in zip(originals, tpart):
+        assert rebuilt.submitted_path == original.submitted_path
+        assert rebuilt.tarinfo.get_info('utf-8', 'strict') == (
+            original.tarinfo.get_info('utf-8', 'strict'))
+
+    assert tpart.total_member_size == len('contents')
+
+
+def test_small_files_read_ahead(tmpdir, monkeypatch):
+    from cStringIO import StringIO
+    from wal_e import manifest
+
+    monkeypatch.setattr(tar_partition, 'PREFETCH_FILES', 2)
+    monkeypatch.setattr(tar_partition, 'PREFETCH_MAX_SIZE', 100)
+
+    cluster = tmpdir.join('cluster').ensure(dir=True)
+    contents = {}
+    for i in xrange(7):
+        # Every third file is too big to be read ahead.
+        name = 'file{0}'.format(i)
+        contents[name] = os.urandom(1000 if i % 3 == 0 else 10 + i)
+        cluster.join(name).write(contents[name], 'wb')
+        os.utime(unicode(cluster.join(name)), (1000000, 1000000))
+
+    spec, parts = tar_partition.partition(unicode(cluster))
+    tpart, = parts
+
+    # Files may be unlinked between planning and archiving.
+    cluster.join('file4').remove()
+    del contents['file4']
+
+    out = StringIO()
+    backup_manifest = manifest.BackupManifest('base_1')
+    tpart.tarfile_write(out, backup_manifest)
+
+    out.seek(0)
+    dest = tmpdir.join('dest').ensure(dir=True)
+    tar_partition.TarPartition.tarfile_extract(out, unicode(dest))
+
+    for name, data in contents.items():
+        assert dest.join(name).read('rb') == data
+        assert dest.join(name).mtime() == 1000000
+        assert name in backup_manifest.files
+
+    assert not dest.join('file4').check()
+    assert 'file4' not in backup_manifest.files
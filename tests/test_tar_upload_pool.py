@@ -1,14 +1,24 @@
+import gevent
+import itertools
 import pytest
+import tempfile
 
+from gevent import event
 from wal_e import exception
 from wal_e import worker
+from wal_e.worker import upload_pool
+
+_names = itertools.count()
 
 
 class FakeTarPartition(object):
     """Implements enough protocol to test concurrency semantics."""
-    def __init__(self, num_members, explosive=False):
+    def __init__(self, num_members, explosive=False, device=None):
         self._explosive = explosive
+        self.device = device
         self.num_members = num_members
+        self.name = next(_names)
+        self.total_member_size = 1000 * num_members
 
     def __len__(self):
         return self.num_members
@@ -23,6 +33,20 @@ class FakeUploader(object):
 
         return tpart
 
+    def compress(self, tpart):
+        if tpart._explosive:
+            raise tpart._explosive
+
+        return 'volume'
+
+    def upload(self, tpart, volume):
+        assert volume == 'volume'
+
+        if getattr(tpart, 'upload_explosive', None):
+            raise tpart.upload_explosive
+
+        return tpart
+
 
 class Explosion(Exception):
     """Marker type of injected faults."""
@@ -139,3 +163,206 @@ def test_pool_concurrent_failure():
         pool.join()
 
     assert e.value is exc
+
+
+def make_staged_pool(compress_concurrency, upload_concurrency, max_members,
+                     uploader=None, budget=None):
+    """Set up a staged pool, by default with a FakeUploader"""
+    return worker.StagedTarUploadPool(uploader or FakeUploader(),
+                                      compress_concurrency,
+                                      upload_concurrency, max_members,
+                                      budget=budget)
+
+
+def test_staged_simple():
+    pool = make_staged_pool(1, 1, 1)
+    pool.put(FakeTarPartition(1))
+    pool.join()
+
+
+def test_staged_not_enough_resources():
+    pool = make_staged_pool(1, 1, 1)
+
+    with pytest.raises(exception.UserCritical):
+        pool.put(FakeTarPartition(2))
+
+    pool.join()
+
+
+def test_staged_concurrent_success():
+    pool = make_staged_pool(2, 4, 8)
+
+    for i in xrange(30):
+        pool.put(FakeTarPartition(1))
+
+    pool.join()
+    assert pool.outstanding == 0
+    assert pool.member_burden == 0
+
+
+def test_staged_compress_fault():
+    pool = make_staged_pool(1, 1, 1)
+
+    pool.put(FakeTarPartition(1, explosive=Explosion('Boom')))
+
+    with pytest.raises(Explosion):
+        pool.put(FakeTarPartition(1))
+
+
+def test_staged_upload_fault():
+    pool = make_staged_pool(1, 1, 1)
+
+    tpart = FakeTarPartition(1)
+    tpart.upload_explosive = Explosion('Boom')
+    pool.put(tpart)
+
+    with pytest.raises(Explosion):
+        pool.join()
+
+
+def test_staged_put_after_join():
+    pool = make_staged_pool(1, 1, 1)
+
+    pool.join()
+
+    with pytest.raises(exception.UserCritical):
+        pool.put(FakeTarPartition(1))
+
+
+class BlockedUploader(FakeUploader):
+    """Records compressions while holding up uploads."""
+
+    def __init__(self):
+        self.compressed = 0
+        self.release = event.Event()
+
+    def compress(self, tpart):
+        self.compressed += 1
+        return FakeUploader.compress(self, tpart)
+
+    def upload(self, tpart, volume):
+        self.release.wait()
+        return FakeUploader.upload(self, tpart, volume)
+
+
+def test_staged_overlap():
+    """Compression proceeds while uploads are in progress
+
+    Compression continues until the uploaders and the queue of
+    finished volumes are full, and then stalls.
+    """
+    uploader = BlockedUploader()
+    pool = make_staged_pool(2, 2, 100, uploader=uploader)
+
+    putter = gevent.spawn(lambda: [pool.put(FakeTarPartition(1))
+                                   for i in xrange(20)])
+    gevent.sleep(0.1)
+
+    # Two volumes are being uploaded, two are queued and two are
+    # waiting to be queued.
+    assert uploader.compressed == 6
+    assert not putter.ready()
+
+    uploader.release.set()
+    putter.get()
+    pool.join()
+    assert uploader.compressed == 20
+
+
+class TempFileUploader(BlockedUploader):
+    """Compresses volumes into temporary files of 1000 bytes"""
+
+    def compress(self, tpart):
+        self.compressed += 1
+        f = tempfile.TemporaryFile()
+        f.write('x' * 1000)
+        f.flush()
+        return f
+
+    def upload(self, tpart, volume):
+        self.release.wait()
+        volume.close()
+        return tpart
+
+
+def test_staged_temp_budget(monkeypatch):
+    """Compression stalls while temporary files would exceed the budget"""
+    monkeypatch.setattr(upload_pool, 'BACKOFF_INTERVAL', 0.01)
+
+    uploader = TempFileUploader()
+    budget = worker.VolumeBudget(max_temp_bytes=2500, min_temp_free=1)
+    pool = make_staged_pool(10, 10, 100, uploader=uploader, budget=budget)
+
+    putter = gevent.spawn(lambda: [pool.put(FakeTarPartition(1))
+                                   for i in xrange(20)])
+    gevent.sleep(0.1)
+
+    # Two volumes take up 2000 bytes; a third would take up 3000.
+    assert uploader.compressed == 2
+    assert not putter.ready()
+
+    uploader.release.set()
+    putter.get()
+    pool.join()
+    assert uploader.compressed == 20
+    assert budget.refusal(FakeTarPartition(1), 0) is None
+
+
+def test_budget_temp_free():
+    """A volume is refused, even alone, if temporary space is short"""
+    budget = worker.VolumeBudget(min_temp_free=2 ** 62)
+    assert 'left free' in budget.refusal(FakeTarPartition(1), 0)
+
+    budget = worker.VolumeBudget(min_temp_free=2 ** 62, temp_files=False)
+    assert budget.refusal(FakeTarPartition(1), 0) is None
+
+
+def test_budget_memory():
+    """Memory is only budgeted while something else is in progress"""
+    budget = worker.VolumeBudget(max_memory=1, temp_files=False)
+    assert budget.refusal(FakeTarPartition(1), 0) is None
+    assert 'memory' in budget.refusal(FakeTarPartition(1), 1)
+
+
+def test_staged_readers_per_device():
+    """Volumes of a busy device are passed over for those of others"""
+    uploader = BlockedUploader()
+    compressing = []
+
+    def compress(tpart):
+        compressing.append(tpart.device)
+        uploader.release.wait()
+        return 'volume'
+
+    uploader.compress = compress
+    pool = worker.StagedTarUploadPool(uploader, 4, 4, 100,
+                                      readers_per_device=2)
+
+    for device in 'aaaaab':
+        pool.put(FakeTarPartition(1, device=device))
+    gevent.sleep(0.1)
+
+    # No more than two volumes of a device are compressed at once.
+    assert sorted(compressing) == ['a', 'a', 'b']
+
+    uploader.release.set()
+    pool.join()
+    assert sorted(compressing) == ['a'] * 5 + ['b']
+    assert pool.outstanding == 0
+
+
+@pytest.mark.parametrize('staged', [False, True])
+def test_refused_alone(staged):
+    """A volume refused with nothing in progress fails rather than hangs"""
+    budget = worker.VolumeBudget(min_temp_free=2 ** 62)
+    if staged:
+        pool = make_staged_pool(1, 1, 1, budget=budget)
+    else:
+        pool = worker.TarUploadPool(FakeUploader(), 1, 1, budget=budget)
+
+    with gevent.Timeout(1):
+        with pytest.raises(exception.UserException) as e:
+            pool.put(FakeTarPartition(1))
+            pool.join()
+
+    assert 'left free' in e.value.detail
@@ -0,0 +1,130 @@
+import errno
+import gevent
+import hashlib
+import os
+import pytest
+import socket
+import tarfile
+
+from cStringIO import StringIO
+from wal_e import manifest
+from wal_e import pipebuf
+from wal_e import tar_partition
+from wal_e import tar_worker
+from wal_e.exception import UserCritical
+
+
+@pytest.fixture(autouse=True)
+def worker_logging(monkeypatch):
+    # Workers configure logging from the environment they inherit.
+    monkeypatch.setenv('WALE_LOG_DESTINATION', 'stderr')
+
+
+def make_cluster(tmpdir):
+    cluster = tmpdir.join('cluster').ensure(dir=True)
+    cluster.join('PG_VERSION').write('9.6\n')
+    cluster.join('base', '1', 'empty').ensure()
+    cluster.join('base', '1', '16385').write(os.urandom(3 * 1024 * 1024 + 7),
+                                             'wb')
+    for i in xrange(20):
+        cluster.join('base', '1', str(16400 + i)).write(os.urandom(8192),
+                                                        'wb')
+    cluster.join('link').mksymlinkto('base/1/16385')
+    return cluster
+
+
+def write_to_pipe(write):
+    """Write through a pipe, as to a compressor, returning the bytes"""
+    r, w = os.pipe()
+    reader = pipebuf.NonBlockBufferedReader(os.fdopen(r, 'rb'))
+    writer = pipebuf.NonBlockBufferedWriter(os.fdopen(w, 'wb'))
+    g = gevent.spawn(reader.read)
+
+    write(writer)
+    writer.flush()
+    writer.close()
+
+    data = g.get()
+    reader.close()
+    return data
+
+
+class CountingBucket(object):
+    def __init__(self):
+        self.taken = 0
+
+    def take(self, n):
+        self.taken += n
+
+
+def test_same_as_in_process(tmpdir):
+    cluster = make_cluster(tmpdir)
+    spec, parts = tar_partition.partition(unicode(cluster))
+    tpart, = parts
+
+    expected = StringIO()
+    expected_manifest = manifest.BackupManifest('base_1')
+    tpart.tarfile_write(expected, expected_manifest)
+
+    backup_manifest = manifest.BackupManifest('base_1')
+    bucket = CountingBucket()
+    digests = []
+    data = write_to_pipe(lambda f: digests.append(tar_worker.write_volume(
+        tpart, f, backup_manifest, bucket)))
+
+    assert data == expected.getvalue()
+    assert digests == [hashlib.sha256(data).hexdigest()]
+    assert backup_manifest.files == expected_manifest.files
+    assert bucket.taken == len(data)
+
+
+def test_failure(tmpdir):
+    # A directory cannot be read as a file.
+    tarinfo = tarfile.TarInfo('bogus')
+    tarinfo.size = 10
+    tpart = tar_partition.TarPartition(0)
+    tpart.append(tar_partition.ExtendedTarInfo(
+        submitted_path=unicode(tmpdir), tarinfo=tarinfo))
+
+    with pytest.raises(UserCritical) as e:
+        write_to_pipe(lambda f: tar_worker.write_volume(tpart, f))
+
+    assert 'directory' in e.value.detail
+
+
+def test_failure_before_writing(tmpdir, monkeypatch):
+    """Failing to take up its job is reported by the worker too"""
+    cluster = make_cluster(tmpdir)
+    spec, parts = tar_partition.partition(unicode(cluster))
+    tpart, = parts
+
+    send = tar_worker._send
+
+    def send_bogus_job(sock, message):
+        if isinstance(message, dict):
+            del message['direct_io']
+        send(sock, message)
+
+    monkeypatch.setattr(tar_worker, '_send', send_bogus_job)
+
+    with pytest.raises(UserCritical) as e:
+        write_to_pipe(lambda f: tar_worker.write_volume(tpart, f))
+
+    assert e.value.msg == 'could not write a volume'
+    assert 'KeyError' in e.value.detail
+
+
+def test_connection_reset(tmpdir, monkeypatch):
+    cluster = make_cluster(tmpdir)
+    spec, parts = tar_partition.partition(unicode(cluster))
+    tpart, = parts
+
+    def reset(sock):
+        raise socket.error(errno.ECONNRESET, os.strerror(errno.ECONNRESET))
+
+    monkeypatch.setattr(tar_worker, '_recv', reset)
+
+    with pytest.raises(UserCritical) as e:
+        write_to_pipe(lambda f: tar_worker.write_volume(tpart, f))
+
+    assert e.value.msg == 'volume writing process exited unexpectedly'
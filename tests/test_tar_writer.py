@@ -0,0 +1,175 @@
+import gevent
+import hashlib
+import os
+import pytest
+import tarfile
+
+from cStringIO import StringIO
+from tar_performance import StreamPadFileObj
+from wal_e import manifest
+from wal_e import page_cache
+from wal_e import pipebuf
+from wal_e import tar_partition
+from wal_e import tar_writer
+from wal_e import zero_copy
+
+
+def make_cluster(tmpdir):
+    cluster = tmpdir.join('cluster').ensure(dir=True)
+    cluster.join('PG_VERSION').write('9.6\n')
+    cluster.join('base', '1', 'empty').ensure()
+    cluster.join('base', '1', '16385').write(os.urandom(3 * 1024 * 1024 + 7),
+                                             'wb')
+    cluster.join('base', '1', 'x' * 120).write('long name')
+    cluster.join('link').mksymlinkto('base/1/16385')
+    return cluster
+
+
+def tarfile_bytes(tpart):
+    """Write a partition with tarfile, as it used to be"""
+    out = StringIO()
+    tar = tarfile.open(fileobj=out, mode='w|')
+    for et_info in tpart:
+        if et_info.tarinfo.isfile():
+            with open(et_info.submitted_path, 'rb') as f:
+                tar.addfile(et_info.tarinfo, StreamPadFileObj(
+                    f, et_info.tarinfo.size))
+        else:
+            tar.addfile(et_info.tarinfo)
+    tar.close()
+
+    return out.getvalue()
+
+
+def test_same_bytes_as_tarfile(tmpdir, monkeypatch):
+    # Small enough for members to straddle the buffer.
+    monkeypatch.setattr(tar_writer, 'BUFFER_SIZE', 1000)
+    cluster = make_cluster(tmpdir)
+
+    spec, parts = tar_partition.partition(unicode(cluster))
+    for tpart in parts:
+        out = StringIO()
+        tpart.tarfile_write(out)
+        assert out.getvalue() == tarfile_bytes(tpart)
+
+
+def test_shrunk_file_padded(tmpdir):
+    f = tmpdir.join('shrunk')
+    f.write('contents')
+
+    tarinfo = tarfile.TarInfo('shrunk')
+    tarinfo.size = 1000
+    tpart = tar_partition.TarPartition(0)
+    tpart.append(tar_partition.ExtendedTarInfo(submitted_path=unicode(f),
+                                               tarinfo=tarinfo))
+
+    out = StringIO()
+    digest = hashlib.sha1()
+    tar = tar_writer.TarWriter(out)
+    with open(unicode(f), 'rb') as fp:
+        tar.add(tar_writer.pack_header(tarinfo), fp, tarinfo.size, digest)
+    tar.close()
+
+    assert out.getvalue() == tarfile_bytes(tpart)
+    assert digest.hexdigest() == hashlib.sha1(
+        'contents' + '\0' * 992).hexdigest()
+
+
+def write_to_pipe(write):
+    """Write through a pipe, as to a compressor, returning the bytes"""
+    r, w = os.pipe()
+    reader = pipebuf.NonBlockBufferedReader(os.fdopen(r, 'rb'))
+    writer = pipebuf.NonBlockBufferedWriter(os.fdopen(w, 'wb'))
+    g = gevent.spawn(reader.read)
+
+    write(writer)
+    writer.flush()
+    writer.close()
+
+    data = g.get()
+    reader.close()
+    return data
+
+
+@pytest.fixture
+def spliced(monkeypatch):
+    """Record the number of bytes moved by each splice"""
+    spliced = []
+    splice = zero_copy.splice
+
+    def counting_splice(fd_in, fd_out, length):
+        n = splice(fd_in, fd_out, length)
+        spliced.append(n)
+        return n
+
+    monkeypatch.setattr(zero_copy, 'splice', counting_splice)
+    return spliced
+
+
+@pytest.mark.skipif(not zero_copy.AVAILABLE, reason='requires splice(2)')
+@pytest.mark.parametrize('digested', [False, True])
+def test_spliced(tmpdir, spliced, digested):
+    contents = os.urandom(3 * 1024 * 1024 + 7)
+    f = tmpdir.join('file')
+    f.write(contents, 'wb')
+
+    # A file planned bigger than it turned out to be is padded out.
+    tpart = tar_partition.TarPartition(0)
+    for name, size in (('file', len(contents)),
+                       ('shrunk', len(contents) + 100000)):
+        tarinfo = tarfile.TarInfo(name)
+        tarinfo.size = size
+        tpart.append(tar_partition.ExtendedTarInfo(
+            submitted_path=unicode(f), tarinfo=tarinfo))
+
+    digests = []
+
+    def write(fileobj):
+        tar = tar_writer.TarWriter(fileobj)
+        for et_info in tpart:
+            digest = hashlib.sha1() if digested else None
+            with page_cache.BackupReader(et_info.submitted_path) as raw:
+                tar.add(tar_writer.pack_header(et_info.tarinfo), raw,
+                        et_info.tarinfo.size, digest)
+            digests.append(digest)
+        tar.close()
+
+    assert write_to_pipe(write) == tarfile_bytes(tpart)
+
+    if digested:
+        # Digested contents are copied through the buffer instead.
+        assert spliced == []
+        assert digests[0].hexdigest() == hashlib.sha1(contents).hexdigest()
+        assert digests[1].hexdigest() == hashlib.sha1(
+            contents + '\0' * 100000).hexdigest()
+    else:
+        assert sum(spliced) == 2 * len(contents)
+
+
+@pytest.mark.skipif(not zero_copy.AVAILABLE, reason='requires splice(2)')
+@pytest.mark.parametrize('zero_copy_wanted', [False, True])
+def test_zero_copy_volume(tmpdir, spliced, zero_copy_wanted):
+    cluster = make_cluster(tmpdir)
+    spec, parts = tar_partition.partition(unicode(cluster))
+    tpart, = parts
+
+    backup_manifest = manifest.BackupManifest('base_1')
+    digest = hashlib.sha256()
+    digested = []
+    data = write_to_pipe(lambda f: digested.append(
+        tpart.tarfile_write(f, backup_manifest, digest=digest,
+                            zero_copy=zero_copy_wanted)))
+    assert data == tarfile_bytes(tpart)
+
+    entry = backup_manifest.files['base/1/16385']
+    if zero_copy_wanted:
+        # The large file is spliced whole, and left undigested, as is
+        # the volume.
+        assert sum(spliced) == 3 * 1024 * 1024 + 7
+        assert entry[manifest.DIGEST] is None
+        assert digested == [False]
+    else:
+        assert spliced == []
+        assert entry[manifest.DIGEST] is not None
+        assert digested == [True]
+        assert digest.hexdigest() == hashlib.sha256(data).hexdigest()
@@ -0,0 +1,102 @@
+import pytest
+
+from cStringIO import StringIO
+from wal_e import throttle
+
+
+class FakeClock(object):
+    def __init__(self):
+        self.now = 1000.0
+        self.slept = 0.0
+
+    def time(self):
+        return self.now
+
+    def sleep(self, seconds):
+        self.slept += seconds
+        self.now += seconds
+
+
+@pytest.fixture
+def clock(monkeypatch):
+    clock = FakeClock()
+    monkeypatch.setattr(throttle.time, 'time', clock.time)
+    monkeypatch.setattr(throttle.gevent, 'sleep', clock.sleep)
+    return clock
+
+
+def test_rate(clock):
+    bucket = throttle.TokenBucket(1000)
+
+    # The first second's worth goes through as a burst.
+    bucket.take(1000)
+    assert clock.slept == 0
+
+    bucket.take(500)
+    assert clock.slept == pytest.approx(0.5)
+
+    # Idle time accumulates allowance, but only up to the burst size.
+    clock.now += 10
+    clock.slept = 0
+    bucket.take(1000)
+    assert clock.slept == 0
+    bucket.take(2000)
+    assert clock.slept == pytest.approx(2)
+
+
+def test_burst(clock):
+    bucket = throttle.TokenBucket(1000, burst=5000)
+    bucket.take(5000)
+    assert clock.slept == 0
+    bucket.take(1000)
+    assert clock.slept == pytest.approx(1)
+
+
+def test_shared(clock):
+    """Bytes taken by several readers add up against the one limit"""
+    bucket = throttle.TokenBucket(1000)
+    writers = [throttle.RateLimitedWriter(StringIO(), bucket)
+               for i in xrange(4)]
+
+    for i in xrange(10):
+        for w in writers:
+            w.write('x' * 250)
+
+    assert clock.slept == pytest.approx(9)
+    assert all(w.getvalue() == 'x' * 2500 for w in writers)
+
+
+def test_control_file(clock, tmpdir):
+    control = tmpdir.join('rate')
+    bucket = throttle.TokenBucket(1000, control_path=unicode(control))
+
+    # A missing control file leaves the limit alone.
+    bucket.take(100)
+    assert bucket.rate == 1000
+
+    control.write('2000\n')
+    control.setmtime(1)
+    clock.now += throttle.CONTROL_INTERVAL
+    bucket.take(100)
+    assert bucket.rate == 2000
+
+    control.write('fast\n')
+    control.setmtime(2)
+    clock.now += throttle.CONTROL_INTERVAL
+    bucket.take(100)
+    assert bucket.rate == 2000
+
+    control.write('0\n')
+    control.setmtime(3)
+    clock.now += throttle.CONTROL_INTERVAL
+    clock.slept = 0
+    bucket.take(10 ** 9)
+    assert bucket.rate is None
+    assert clock.slept == 0
+
+
+def test_unlimited_with_control_file_only(clock, tmpdir):
+    bucket = throttle.TokenBucket(None,
+                                  control_path=unicode(tmpdir.join('rate')))
+    bucket.take(10 ** 9)
+    assert clock.slept == 0
@@ -0,0 +1,230 @@
+"""
+Local journals of the base backups being taken, so they can resume.
+
+While a base backup is taken, backup-push keeps a journal of it in
+the .wal-e directory of the cluster directory, which is not itself
+backed up.  The journal records what is needed to finish the backup
+(the WAL segment it started at, the version of Postgres, and the
+options it was taken with) and then, as each volume is uploaded, the
+name, size and modification time of each of its members, their
+manifest entries and the checksums of the volume.
+
+Should the backup be interrupted, "backup-push --resume" reads the
+journal and, provided the backup is still in progress, walks the
+cluster directory again, leaving out the members of volumes already
+uploaded that are unchanged since.  Only the remaining members are
+archived, in volumes numbered after those already uploaded.
+
+A member changed since its volume was uploaded is archived again,
+leaving two copies of it in the backup.  Either is as good as the
+other: like any file copied while a backup is in progress, its
+changes since the backup started are replayed from WAL on restore.
+
+Volumes that were being uploaded when the backup was interrupted may
+or may not have been stored.  Their numbers are reused by the resumed
+backup, which writes an empty volume over any it has no use for, so
+that no volume not recorded in the journal remains.
+
+The journal is a file of JSON records, one per line, each written
+out with fsync.  A record cut short by a crash is ignored.
+
+"""
+import errno
+import json
+import os
+
+from wal_e.exception import UserException
+
+# The name of the journal within the .wal-e directory.
+JOURNAL_NAME = 'backup-push.journal'
+
+# The version of the format of journals.
+JOURNAL_VERSION = 1
+
+
+def journal_path(pg_cluster_dir):
+    return os.path.join(pg_cluster_dir, '.wal-e', JOURNAL_NAME)
+
+
+def _fsync_dir(path):
+    fd = os.open(path, os.O_RDONLY)
+    try:
+        os.fsync(fd)
+    finally:
+        os.close(fd)
+
+
+class BackupJournal(object):
+    """The journal of a base backup being taken
+
+    header is a dictionary describing the backup as a whole.
+    """
+
+    def __init__(self, path, header):
+        self.path = path
+        self.header = header
+        self.total_size = 0
+        self.chunk_names = set()
+
+        self._started = set()
+        self._completed = set()
+        # Fingerprints and manifest entries of the members of volumes
+        # uploaded, by member name.
+        self._members = {}
+        self._entries = {}
+
+        # The checksums of volumes uploaded, by number.
+        self.checksums = {}
+
+    @classmethod
+    def create(cls, path, header):
+        """Start the journal of a new backup, replacing any other"""
+        directory = os.path.dirname(path)
+        try:
+            os.mkdir(directory, 0700)
+        except EnvironmentError, e:
+            if e.errno != errno.EEXIST:
+                raise
+
+        journal = cls(path, dict(header, journal_version=JOURNAL_VERSION))
+        with open(path, 'wb') as f:
+            f.write(json.dumps(journal.header) + '\n')
+            f.flush()
+            os.fsync(f.fileno())
+        _fsync_dir(directory)
+
+        return journal
+
+    @classmethod
+    def load(cls, path):
+        try:
+            with open(path, 'rb') as f:
+                lines = f.read().split('\n')
+        except EnvironmentError, e:
+            if e.errno != errno.ENOENT:
+                raise
+
+            raise UserException(
+                msg='no interrupted backup to resume',
+                detail='There is no backup journal at "{0}".'.format(path),
+                hint='Run backup-push without --resume to take a backup.')
+
+        records = []
+        for line in lines:
+            try:
+                records.append(json.loads(line))
+            except ValueError:
+                # Only the last record, written as the backup was
+                # interrupted, may be incomplete.
+                break
+
+        if not records or records[0].get('journal_version') != \
+                JOURNAL_VERSION:
+            raise UserException(
+                msg='cannot read the backup journal',
+                detail=('The backup journal at "{0}" is not one written by '
+                        'this version of WAL-E.'.format(path)),
+                hint='Run backup-push without --resume to take a backup.')
+
+        journal = cls(path, records[0])
+        for record in records[1:]:
+            journal._apply(record)
+
+        return journal
+
+    def remove(self):
+        try:
+            os.unlink(self.path)
+        except EnvironmentError, e:
+            if e.errno != errno.ENOENT:
+                raise
+
+    @property
+    def parts(self):
+        """The number of volumes uploaded"""
+        return len(self._completed)
+
+    def part_numbers(self):
+        """Generate the numbers of the volumes yet to be uploaded
+
+        The numbers of volumes that may have been left incomplete
+        come first.
+        """
+        for number in self.unfinished():
+            yield number
+
+        number = max(self._started | self._completed or [-1]) + 1
+        while True:
+            yield number
+            number += 1
+
+    def unfinished(self):
+        """List the numbers of volumes started but not uploaded"""
+        return sorted(self._started - self._completed)
+
+    def uploaded(self, tarinfo, manifest=None):
+        """Tell whether a member is uploaded already, unchanged
+
+        If so, its manifest entry is copied to manifest, if passed.
+        """
+        if self._members.get(tarinfo.name) != (tarinfo.size, tarinfo.mtime):
+            return False
+
+        entry = self._entries.get(tarinfo.name)
+        if manifest is not None and entry is not None:
+            manifest.files[tarinfo.name] = entry
+
+        return True
+
+    def start(self, number):
+        """Record that volume number is about to be uploaded"""
+        self._append({'started': number})
+
+    def complete(self, tpart, manifest=None, chunk_names=(),
+                 checksums=None):
+        """Record that the TarPartition tpart was uploaded
+
+        Its members' entries are copied from manifest, if passed.
+        chunk_names are those of the stored chunks referred to so far.
+        checksums are those of the volume, if passed.
+        """
+        members = []
+        files = {}
+        for et_info in tpart:
+            tarinfo = et_info.tarinfo
+            members.append([tarinfo.name, tarinfo.size, tarinfo.mtime])
+            if manifest is not None and tarinfo.name in manifest.files:
+                files[tarinfo.name] = manifest.files[tarinfo.name]
+
+        self._append({'part': tpart.name,
+                      'size': tpart.total_member_size,
+                      'members': members,
+                      'files': files,
+                      'chunks': sorted(set(chunk_names) - self.chunk_names),
+                      'checksums': checksums})
+
+    def _append(self, record):
+        with open(self.path, 'ab') as f:
+            f.write(json.dumps(record) + '\n')
+            f.flush()
+            os.fsync(f.fileno())
+
+        self._apply(record)
+
+    def _apply(self, record):
+        if 'started' in record:
+            self._started.add(record['started'])
+            return
+
+        self._completed.add(record['part'])
+        self.total_size += record['size']
+        self.chunk_names.update(record['chunks'])
+        if record.get('checksums') is not None:
+            self.checksums[record['part']] = record['checksums']
+
+        # JSON decoding yields unicode member names, whereas tar
+        # member names are byte strings.
+        for name, size, mtime in record['members']:
+            self._members[name.encode('utf-8')] = (size, mtime)
+        for name, entry in record['files'].iteritems():
+            self._entries[name.encode('utf-8')] = entry
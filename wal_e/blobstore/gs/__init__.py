@@ -1,11 +1,13 @@
 from wal_e.blobstore.gs.credentials import Credentials
 from wal_e.blobstore.gs.utils import (
-    do_lzop_get, uri_put_file, uri_get_file, write_and_return_error)
+    do_lzop_get, uri_put_file, uri_get_file, write_and_return_error,
+    write_ranges_and_return_error)
 
 __all__ = [
     'Credentials',
     'do_lzop_get',
     'uri_put_file',
     'uri_get_file',
-    'write_and_return_error'
+    'write_and_return_error',
+    'write_ranges_and_return_error',
 ]
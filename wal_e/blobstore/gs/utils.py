@@ -1,13 +1,19 @@
+from cStringIO import StringIO
 from gcloud import storage
 from gcloud import exceptions
+from gcloud.streaming.http_wrapper import Request
+from gcloud.streaming.transfer import Download
 from urlparse import urlparse
 import gevent
 import socket
 import traceback
 
 from . import calling_format
+from wal_e import compression
 from wal_e import files
 from wal_e import log_help
+from wal_e.blobstore import streaming
+from wal_e.exception import UserCritical
 from wal_e.pipeline import get_download_pipeline
 from wal_e.piper import PIPE
 from wal_e.retries import retry, retry_with_count
@@ -25,7 +31,8 @@ def _uri_to_blob(creds, uri, conn=None):
     return storage.Blob(url_tup.path, b)
 
 
-def uri_put_file(creds, uri, fp, content_encoding=None, conn=None):
+def uri_put_file(creds, uri, fp, content_encoding=None, conn=None,
+                 metadata=None, content_md5=None):
     assert fp.tell() == 0
     blob = _uri_to_blob(creds, uri, conn=conn)
 
@@ -35,6 +42,19 @@ def uri_put_file(creds, uri, fp, content_encoding=None, conn=None):
     fp.seek(0, 0)
     blob.upload_from_file(fp, num_retries=0, size=size,
                           content_type=content_encoding)
+
+    # The upload takes neither, so the MD5 digest computed by the
+    # service is checked afterwards, and metadata set separately.
+    if content_md5 is not None and blob.md5_hash != content_md5:
+        raise UserCritical(
+            msg='uploaded object does not match its MD5 digest',
+            detail=('The object {0} has the MD5 digest {1}, where {2} was '
+                    'sent.'.format(uri, blob.md5_hash, content_md5)))
+
+    if metadata is not None:
+        blob.metadata = metadata
+        blob.patch()
+
     return blob
 
 
@@ -51,7 +71,8 @@ def do_lzop_get(creds, url, path, decrypt, do_retry=True):
     is never stored on disk.
 
     """
-    assert url.endswith('.lzo'), 'Expect an lzop-compressed file'
+    codec = compression.codec_for_name(url)
+    assert codec is not None, 'Expect a compressed file'
 
     def log_wal_fetch_failures_on_error(exc_tup, exc_processor_cxt):
         def standard_detail_message(prefix=''):
@@ -88,7 +109,8 @@ def do_lzop_get(creds, url, path, decrypt, do_retry=True):
     def download():
         with files.DeleteOnError(path) as decomp_out:
             blob = _uri_to_blob(creds, url)
-            with get_download_pipeline(PIPE, decomp_out.f, decrypt) as pl:
+            with get_download_pipeline(PIPE, decomp_out.f, decrypt,
+                                       codec=codec) as pl:
                 g = gevent.spawn(write_and_return_error, blob, pl.stdin)
 
                 try:
@@ -127,10 +149,33 @@ def do_lzop_get(creds, url, path, decrypt, do_retry=True):
 
 
 def write_and_return_error(blob, stream):
-    try:
-        stream.write(blob.download_as_string())
-        stream.flush()
-    except Exception, e:
-        return e
-    finally:
-        stream.close()
+    def download(stream):
+        # The blob is fetched, and written, in ranges of this size.
+        blob.chunk_size = streaming.CHUNK_SIZE
+        blob.download_to_file(stream)
+
+    return streaming.write_and_return_error(download, stream)
+
+
+def _read_range(blob, conn, start, end):
+    buf = StringIO()
+    download = Download.from_stream(buf, auto_transfer=False,
+                                    total_size=blob.size)
+    download.initialize_download(Request(blob.media_link, 'GET', {}),
+                                 conn.connection.http)
+    download.get_range(start, end, use_chunks=False)
+    return buf.getvalue()
+
+
+def write_ranges_and_return_error(blob, conns, stream):
+    """As write_and_return_error, fetching ranges over several connections
+
+    Ranges of blob are fetched over the HTTP connections of conns.
+    """
+    def download(stream):
+        streaming.write_ranges(
+            [lambda start, end, conn=conn: _read_range(blob, conn, start, end)
+             for conn in conns],
+            blob.size, stream)
+
+    return streaming.write_and_return_error(download, stream)
@@ -1,14 +1,18 @@
 from wal_e.blobstore.s3.s3_credentials import Credentials
+from wal_e.blobstore.s3.s3_util import MultipartUpload
 from wal_e.blobstore.s3.s3_util import do_lzop_get
 from wal_e.blobstore.s3.s3_util import uri_get_file
 from wal_e.blobstore.s3.s3_util import uri_put_file
 from wal_e.blobstore.s3.s3_util import write_and_return_error
+from wal_e.blobstore.s3.s3_util import write_ranges_and_return_error
 
 
 __all__ = [
     'Credentials',
+    'MultipartUpload',
     'do_lzop_get',
     'uri_put_file',
     'uri_get_file',
     'write_and_return_error',
+    'write_ranges_and_return_error',
 ]
@@ -1,5 +1,7 @@
+import base64
 import collections
 import gevent
+import hashlib
 import socket
 import traceback
 from urlparse import urlparse
@@ -7,8 +9,10 @@ from urlparse import urlparse
 import botocore
 
 from . import calling_format
+from wal_e import compression
 from wal_e import files
 from wal_e import log_help
+from wal_e.blobstore import streaming
 from wal_e.pipeline import get_download_pipeline
 from wal_e.piper import PIPE
 from wal_e.retries import retry, retry_with_count
@@ -32,7 +36,8 @@ def _uri_to_key(creds, uri, conn=None):
     return bucket.Object(url_tup.path.lstrip('/'))
 
 
-def uri_put_file(creds, uri, fp, content_encoding=None):
+def uri_put_file(creds, uri, fp, content_encoding=None, metadata=None,
+                 content_md5=None):
     # Per Boto 2.2.2, which will only read from the current file
     # position to the end.  This manifests as successfully uploaded
     # *empty* keys in S3 instead of the intended data because of how
@@ -47,10 +52,57 @@ def uri_put_file(creds, uri, fp, content_encoding=None):
 
     url_tup = urlparse(uri)
 
-    k = bucket.put_object(Key=url_tup.path.lstrip('/'), Body=fp)
+    kwargs = {}
+    if metadata is not None:
+        kwargs['Metadata'] = metadata
+    if content_md5 is not None:
+        kwargs['ContentMD5'] = content_md5
+
+    k = bucket.put_object(Key=url_tup.path.lstrip('/'), Body=fp, **kwargs)
     return _Key(size=k.content_length)
 
 
+class MultipartUpload(object):
+    """Build an S3 object out of independently sent parts
+
+    Parts are numbered from one and may be sent in any order and
+    retried individually.  S3 requires every part but the last to be
+    at least 5 MiB.  Each part is sent along with its MD5 digest.
+
+    Metadata passed to complete cannot be stored, as S3 only takes
+    metadata when the upload is initiated.
+    """
+    part_size = 32 * 1024 * 1024
+
+    def __init__(self, creds, uri, content_encoding=None):
+        key = _uri_to_key(creds, uri)
+        if content_encoding is not None:
+            self._mpu = key.initiate_multipart_upload(
+                ContentType=content_encoding)
+        else:
+            self._mpu = key.initiate_multipart_upload()
+
+        self._etags = {}
+        self._sizes = {}
+
+    def put_part(self, part_number, data):
+        content_md5 = base64.b64encode(hashlib.md5(data).digest())
+        resp = self._mpu.Part(part_number).upload(Body=data,
+                                                  ContentMD5=content_md5)
+        self._etags[part_number] = resp['ETag']
+        self._sizes[part_number] = len(data)
+        return len(data)
+
+    def complete(self, metadata=None):
+        parts = [{'ETag': self._etags[n], 'PartNumber': n}
+                 for n in sorted(self._etags)]
+        self._mpu.complete(MultipartUpload={'Parts': parts})
+        return _Key(size=sum(self._sizes.values()))
+
+    def abort(self):
+        self._mpu.abort()
+
+
 def uri_get_file(creds, uri, conn=None):
     k = _uri_to_key(creds, uri, conn=conn)
     # boto3 returns a file descriptor, so we need to read it off the socket
@@ -65,7 +117,8 @@ def do_lzop_get(creds, url, path, decrypt, do_retry=True):
     is never stored on disk.
 
     """
-    assert url.endswith('.lzo'), 'Expect an lzop-compressed file'
+    codec = compression.codec_for_name(url)
+    assert codec is not None, 'Expect a compressed file'
 
     def log_wal_fetch_failures_on_error(exc_tup, exc_processor_cxt):
         def standard_detail_message(prefix=''):
@@ -101,7 +154,8 @@ def do_lzop_get(creds, url, path, decrypt, do_retry=True):
     def download():
         with files.DeleteOnError(path) as decomp_out:
             key = _uri_to_key(creds, url)
-            with get_download_pipeline(PIPE, decomp_out.f, decrypt) as pl:
+            with get_download_pipeline(PIPE, decomp_out.f, decrypt,
+                                       codec=codec) as pl:
                 g = gevent.spawn(write_and_return_error, key, pl.stdin)
 
                 try:
@@ -141,10 +195,33 @@ def do_lzop_get(creds, url, path, decrypt, do_retry=True):
 
 
 def write_and_return_error(key, stream):
+    def download(stream):
+        body = key.get()['Body']
+        try:
+            streaming.copy_chunks(body.read, stream)
+        finally:
+            body.close()
+
+    return streaming.write_and_return_error(download, stream)
+
+
+def _read_range(key, start, end):
+    body = key.get(Range='bytes={0}-{1}'.format(start, end))['Body']
     try:
-        stream.write(key.get()['Body'].read())
-        stream.flush()
-    except Exception, e:
-        return e
+        return body.read()
     finally:
-        stream.close()
+        body.close()
+
+
+def write_ranges_and_return_error(keys, stream):
+    """As write_and_return_error, fetching ranges over several connections
+
+    keys holds the same key on each connection to fetch ranges over.
+    """
+    def download(stream):
+        streaming.write_ranges(
+            [lambda start, end, key=key: _read_range(key, start, end)
+             for key in keys],
+            keys[0].content_length, stream)
+
+    return streaming.write_and_return_error(download, stream)
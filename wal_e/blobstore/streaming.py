@@ -0,0 +1,112 @@
+"""
+Streaming objects from blob stores into download pipelines.
+
+Objects fetched, such as base backup volumes of up to 1.5 GiB, are
+written to the pipeline decompressing them a chunk of CHUNK_SIZE
+bytes at a time, as the chunks arrive.  Writing to the pipeline waits
+while it is full, so no more than a chunk or so is held in memory per
+download, and decompression proceeds while the rest is downloaded.
+
+Large objects can instead be fetched over several connections at
+once, by write_ranges: each connection fetches the next range of
+CHUNK_SIZE bytes not yet fetched, and the ranges are written to the
+pipeline in order as they become contiguous.  Ranges fetched ahead of
+the one to be written next wait in a reorder buffer, which is bounded
+to READ_AHEAD ranges per connection, after which the connections wait
+for the pipeline to catch up.
+
+"""
+import gevent
+
+from gevent import event
+from gevent import lock
+
+# The size of the chunks read and written.  Google Cloud Storage
+# requires a multiple of 256 KiB.
+CHUNK_SIZE = 4 * 1024 * 1024
+
+# The ranges that may be fetched, or held, ahead of the pipeline per
+# connection fetching them.
+READ_AHEAD = 2
+
+
+def copy_chunks(read, stream):
+    """Write what read(CHUNK_SIZE) returns to stream, until it is empty"""
+    while True:
+        chunk = read(CHUNK_SIZE)
+        if not chunk:
+            break
+
+        stream.write(chunk)
+        del chunk
+
+
+def write_ranges(read_ranges, size, stream):
+    """Write an object of size bytes to stream, a range at a time
+
+    read_ranges holds a function for each connection to fetch ranges
+    over, which returns the bytes from start to end, inclusive, when
+    called as read_range(start, end).
+    """
+    count = (size + CHUNK_SIZE - 1) // CHUNK_SIZE
+    if count == 0:
+        return
+
+    ranges = iter(xrange(count))
+    slots = lock.Semaphore(READ_AHEAD * len(read_ranges))
+    fetched = {}
+    arrived = event.Event()
+
+    def fetch(read_range):
+        while True:
+            slots.acquire()
+            index = next(ranges, None)
+            if index is None:
+                slots.release()
+                return
+
+            start = index * CHUNK_SIZE
+            end = min(start + CHUNK_SIZE, size) - 1
+            data = read_range(start, end)
+            if len(data) != end - start + 1:
+                raise IOError('fetched {0} bytes of the range {1}-{2} of '
+                              'an object of {3} bytes'
+                              .format(len(data), start, end, size))
+
+            fetched[index] = data
+            arrived.set()
+
+    fetchers = [gevent.spawn(fetch, read_range)
+                for read_range in read_ranges[:count]]
+    for g in fetchers:
+        g.link(lambda g: arrived.set())
+
+    try:
+        for index in xrange(count):
+            while index not in fetched:
+                for g in fetchers:
+                    if g.ready() and not g.successful():
+                        raise g.exception
+
+                arrived.clear()
+                arrived.wait()
+
+            stream.write(fetched.pop(index))
+            slots.release()
+    finally:
+        gevent.killall(fetchers)
+
+
+def write_and_return_error(download, stream):
+    """Call download(stream) to write an object to stream, closing it
+
+    Any exception raised is returned instead, so that a greenlet
+    feeding a pipeline can hand it over to the one reading from it.
+    """
+    try:
+        download(stream)
+        stream.flush()
+    except Exception, e:
+        return e
+    finally:
+        stream.close()
@@ -1,6 +1,7 @@
 from wal_e.blobstore.swift.credentials import Credentials
 from wal_e.blobstore.swift.utils import (
-    uri_put_file, uri_get_file, do_lzop_get, write_and_return_error, SwiftKey
+    uri_put_file, uri_get_file, do_lzop_get, write_and_return_error,
+    write_ranges_and_return_error, SwiftKey
 )
 
 __all__ = [
@@ -9,5 +10,6 @@ __all__ = [
     "uri_get_file",
     "do_lzop_get",
     "write_and_return_error",
+    "write_ranges_and_return_error",
     "SwiftKey",
 ]
@@ -1,3 +1,4 @@
+import base64
 import socket
 import traceback
 from urlparse import urlparse
@@ -6,8 +7,10 @@ import gevent
 
 from swiftclient.exceptions import ClientException
 
+from wal_e import compression
 from wal_e import log_help
 from wal_e import files
+from wal_e.blobstore import streaming
 from wal_e.blobstore.swift import calling_format
 from wal_e.pipeline import get_download_pipeline
 from wal_e.piper import PIPE
@@ -24,7 +27,8 @@ class SwiftKey(object):
         self.last_modified = last_modified
 
 
-def uri_put_file(creds, uri, fp, content_encoding=None):
+def uri_put_file(creds, uri, fp, content_encoding=None, metadata=None,
+                 content_md5=None):
     assert fp.tell() == 0
     assert uri.startswith('swift://')
 
@@ -33,8 +37,19 @@ def uri_put_file(creds, uri, fp, content_encoding=None):
     container_name = url_tup.netloc
     conn = calling_format.connect(creds)
 
+    # Swift takes the MD5 digest as the hexadecimal ETag.
+    etag = None
+    if content_md5 is not None:
+        etag = base64.b64decode(content_md5).encode('hex')
+
+    headers = None
+    if metadata is not None:
+        headers = dict(('X-Object-Meta-' + name, value)
+                       for name, value in metadata.iteritems())
+
     conn.put_object(
-        container_name, url_tup.path, fp, content_type=content_encoding
+        container_name, url_tup.path, fp, content_type=content_encoding,
+        etag=etag, headers=headers
     )
     # Swiftclient doesn't return us the total file size, we see how much of the
     # file swiftclient read in order to determine the file size.
@@ -49,7 +64,8 @@ def do_lzop_get(creds, uri, path, decrypt, do_retry=True):
     is never stored on disk.
 
     """
-    assert uri.endswith('.lzo'), 'Expect an lzop-compressed file'
+    codec = compression.codec_for_name(uri)
+    assert codec is not None, 'Expect a compressed file'
 
     def log_wal_fetch_failures_on_error(exc_tup, exc_processor_cxt):
         def standard_detail_message(prefix=''):
@@ -85,7 +101,8 @@ def do_lzop_get(creds, uri, path, decrypt, do_retry=True):
 
     def download():
         with files.DeleteOnError(path) as decomp_out:
-            with get_download_pipeline(PIPE, decomp_out.f, decrypt) as pl:
+            with get_download_pipeline(PIPE, decomp_out.f, decrypt,
+                                       codec=codec) as pl:
 
                 conn = calling_format.connect(creds)
 
@@ -142,12 +159,30 @@ def uri_get_file(creds, uri, conn=None, resp_chunk_size=None):
 
 
 def write_and_return_error(uri, conn, stream):
-    try:
-        response = uri_get_file(None, uri, conn, resp_chunk_size=8192)
+    def download(stream):
+        response = uri_get_file(None, uri, conn,
+                                resp_chunk_size=streaming.CHUNK_SIZE)
         for chunk in response:
             stream.write(chunk)
-        stream.flush()
-    except Exception, e:
-        return e
-    finally:
-        stream.close()
+
+    return streaming.write_and_return_error(download, stream)
+
+
+def write_ranges_and_return_error(uri, conns, stream):
+    """As write_and_return_error, fetching ranges over several connections"""
+    url_tup = urlparse(uri)
+
+    def read_range(conn, start, end):
+        _, content = conn.get_object(
+            url_tup.netloc, url_tup.path,
+            headers={'Range': 'bytes={0}-{1}'.format(start, end)})
+        return content
+
+    def download(stream):
+        headers = conns[0].head_object(url_tup.netloc, url_tup.path)
+        streaming.write_ranges(
+            [lambda start, end, conn=conn: read_range(conn, start, end)
+             for conn in conns],
+            int(headers['content-length']), stream)
+
+    return streaming.write_and_return_error(download, stream)
@@ -1,13 +1,17 @@
 from wal_e.blobstore.wabs.wabs_credentials import Credentials
+from wal_e.blobstore.wabs.wabs_util import MultipartUpload
 from wal_e.blobstore.wabs.wabs_util import do_lzop_get
 from wal_e.blobstore.wabs.wabs_util import uri_get_file
 from wal_e.blobstore.wabs.wabs_util import uri_put_file
 from wal_e.blobstore.wabs.wabs_util import write_and_return_error
+from wal_e.blobstore.wabs.wabs_util import write_ranges_and_return_error
 
 __all__ = [
     'Credentials',
+    'MultipartUpload',
     'do_lzop_get',
     'uri_get_file',
     'uri_put_file',
     'write_and_return_error',
+    'write_ranges_and_return_error',
 ]
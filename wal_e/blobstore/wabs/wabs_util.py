@@ -1,16 +1,21 @@
+import base64
 import collections
 import gevent
 import socket
 import traceback
 
+from azure.common import AzureHttpError
 from azure.common import AzureMissingResourceHttpError
+from azure.storage.blob import BlobBlock
 from azure.storage.blob import BlockBlobService
 from azure.storage.blob import ContentSettings
 
 from . import calling_format
 from urlparse import urlparse
+from wal_e import compression
 from wal_e import log_help
 from wal_e import files
+from wal_e.blobstore import streaming
 from wal_e.pipeline import get_download_pipeline
 from wal_e.piper import PIPE
 from wal_e.retries import retry, retry_with_count
@@ -23,7 +28,8 @@ _Key = collections.namedtuple('_Key', ['size'])
 WABS_CHUNK_SIZE = 4 * 1024 * 1024
 
 
-def uri_put_file(creds, uri, fp, content_encoding=None):
+def uri_put_file(creds, uri, fp, content_encoding=None, metadata=None,
+                 content_md5=None):
     assert fp.tell() == 0
     assert uri.startswith('wabs://')
     url_tup = urlparse(uri)
@@ -33,11 +39,14 @@ def uri_put_file(creds, uri, fp, content_encoding=None):
     fp.seek(0, 0)
     conn = BlockBlobService(account_name=creds.account_name,
                 account_key=creds.account_key)
-    if content_encoding is not None:
-        conn.create_blob_from_stream(url_tup.netloc, url_tup.path, fp,
-            content_settings=ContentSettings(content_type=content_encoding))
-    else:
-        conn.create_blob_from_stream(url_tup.netloc, url_tup.path, fp)
+
+    # The blob is sent in blocks, each checked by the service against
+    # its MD5 digest, and that of the whole blob is stored with it.
+    conn.create_blob_from_stream(
+        url_tup.netloc, url_tup.path, fp,
+        content_settings=ContentSettings(content_type=content_encoding,
+                                         content_md5=content_md5),
+        metadata=metadata, validate_content=content_md5 is not None)
 
     # To maintain consistency with the S3 version of this function we must
     # return an object with a certain set of attributes.  Currently, that set
@@ -45,6 +54,58 @@ def uri_put_file(creds, uri, fp, content_encoding=None):
     return _Key(size=size)
 
 
+class MultipartUpload(object):
+    """Build a block blob out of independently sent blocks
+
+    Blocks are numbered from one and may be sent in any order and
+    retried individually.  Nothing is visible until the block list is
+    committed, and uncommitted blocks are garbage collected by the
+    service, so aborting needs no cleanup.  Each block is checked by
+    the service against its MD5 digest.
+    """
+    part_size = WABS_CHUNK_SIZE
+
+    def __init__(self, creds, uri, content_encoding=None):
+        assert uri.startswith('wabs://')
+        url_tup = urlparse(uri)
+
+        self._container = url_tup.netloc
+        self._blob = url_tup.path
+        self._content_encoding = content_encoding
+        self._conn = BlockBlobService(account_name=creds.account_name,
+                                      account_key=creds.account_key)
+        self._sizes = {}
+
+    @staticmethod
+    def _block_id(part_number):
+        # Block ids must all be of the same length within a blob.
+        return base64.b64encode('{0:08d}'.format(part_number))
+
+    def put_part(self, part_number, data):
+        self._conn.put_block(self._container, self._blob, data,
+                             self._block_id(part_number),
+                             validate_content=True)
+        self._sizes[part_number] = len(data)
+        return len(data)
+
+    def complete(self, metadata=None):
+        blocks = [BlobBlock(id=self._block_id(n)) for n in sorted(self._sizes)]
+        if self._content_encoding is not None:
+            self._conn.put_block_list(
+                self._container, self._blob, blocks,
+                content_settings=ContentSettings(
+                    content_type=self._content_encoding),
+                metadata=metadata)
+        else:
+            self._conn.put_block_list(self._container, self._blob, blocks,
+                                      metadata=metadata)
+
+        return _Key(size=sum(self._sizes.values()))
+
+    def abort(self):
+        pass
+
+
 def uri_get_file(creds, uri, conn=None):
     assert uri.startswith('wabs://')
     url_tup = urlparse(uri)
@@ -63,7 +124,8 @@ def do_lzop_get(creds, url, path, decrypt, do_retry=True):
     is never stored on disk.
 
     """
-    assert url.endswith('.lzo'), 'Expect an lzop-compressed file'
+    codec = compression.codec_for_name(url)
+    assert codec is not None, 'Expect a compressed file'
     assert url.startswith('wabs://')
 
     conn = BlockBlobService(account_name=creds.account_name,
@@ -103,7 +165,8 @@ def do_lzop_get(creds, url, path, decrypt, do_retry=True):
 
     def download():
         with files.DeleteOnError(path) as decomp_out:
-            with get_download_pipeline(PIPE, decomp_out.f, decrypt) as pl:
+            with get_download_pipeline(PIPE, decomp_out.f, decrypt,
+                                       codec=codec) as pl:
                 g = gevent.spawn(write_and_return_error, url, conn, pl.stdin)
 
                 try:
@@ -140,12 +203,56 @@ def do_lzop_get(creds, url, path, decrypt, do_retry=True):
     return download()
 
 
+def _write_blob(url, conn, stream):
+    """Write a blob to stream, fetching it a range at a time"""
+    url_tup = urlparse(url)
+    offset = 0
+    size = None
+
+    while size is None or offset < size:
+        try:
+            blob = conn.get_blob_to_bytes(
+                url_tup.netloc, url_tup.path, start_range=offset,
+                end_range=offset + streaming.CHUNK_SIZE - 1,
+                max_connections=1)
+        except AzureHttpError, e:
+            # There is no range to fetch of an empty blob.
+            if offset == 0 and e.status_code == 416:
+                return
+            raise
+
+        if size is None:
+            # The Content-Range is "bytes start-end/size".
+            size = int(blob.properties.content_range.rsplit('/', 1)[1])
+
+        if not blob.content:
+            raise IOError('blob {0} ended at {1} of {2} bytes'
+                          .format(url, offset, size))
+
+        stream.write(blob.content)
+        offset += len(blob.content)
+        del blob
+
+
 def write_and_return_error(url, conn, stream):
-    try:
-        data = uri_get_file(None, url, conn=conn)
-        stream.write(data)
-        stream.flush()
-    except Exception, e:
-        return e
-    finally:
-        stream.close()
+    return streaming.write_and_return_error(
+        lambda stream: _write_blob(url, conn, stream), stream)
+
+
+def write_ranges_and_return_error(url, conns, stream):
+    """As write_and_return_error, fetching ranges over several connections"""
+    url_tup = urlparse(url)
+
+    def read_range(conn, start, end):
+        return conn.get_blob_to_bytes(
+            url_tup.netloc, url_tup.path, start_range=start,
+            end_range=end, max_connections=1).content
+
+    def download(stream):
+        blob = conns[0].get_blob_properties(url_tup.netloc, url_tup.path)
+        streaming.write_ranges(
+            [lambda start, end, conn=conn: read_range(conn, start, end)
+             for conn in conns],
+            blob.properties.content_length, stream)
+
+    return streaming.write_and_return_error(download, stream)
@@ -0,0 +1,72 @@
+"""
+Checksums of the objects uploaded, taken as they are uploaded.
+
+Volumes of base backups and WAL segments pass through an upload
+pipeline (see pipeline.get_upload_pipeline) on their way to the blob
+store.  Given a Checksums, the pipeline digests what comes out of it,
+the compressed (and possibly encrypted) object, and what goes into
+it, the raw WAL segment.  The raw tar stream of a volume is instead
+digested by the TarWriter writing it, which sees every byte anyway,
+rather than in another pass; volumes with files spliced into them
+(see tar_writer) go without.
+
+The digests are stored with the object as metadata, where the blob
+store supports it, and those of volumes in the backup's sentinel, so
+that a backup can be checked or compared without downloading it.
+The blob store is also sent the MD5 digest of the object, where it
+supports it, to check the object was received intact.
+
+"""
+import base64
+import hashlib
+
+# The algorithm of the digests recorded.
+ALGORITHM = 'sha256'
+
+
+class Checksums(object):
+    """Digests of what goes into and comes out of an upload pipeline
+
+    raw_digests and compressed_digests are the hash objects for the
+    pipeline to update with its input and its output, respectively.
+    Unless raw is true, the pipeline leaves its input alone, and the
+    digest taken of it elsewhere, if any, is to be set as raw_hexdigest.
+    """
+
+    def __init__(self, content_md5=True, raw=True):
+        self.raw = hashlib.new(ALGORITHM) if raw else None
+        self.raw_hexdigest = None
+        self.compressed = hashlib.new(ALGORITHM)
+
+        # Only objects uploaded whole, rather than in parts, are sent
+        # along with their MD5 digest.
+        self.md5 = hashlib.md5() if content_md5 else None
+
+        self.raw_digests = [] if self.raw is None else [self.raw]
+        self.compressed_digests = [self.compressed]
+        if self.md5 is not None:
+            self.compressed_digests.append(self.md5)
+
+    def content_md5(self):
+        """The base64 encoded MD5 digest of the output, or None"""
+        if self.md5 is None:
+            return None
+        return base64.b64encode(self.md5.digest())
+
+    def _raw_hexdigest(self):
+        if self.raw is not None:
+            return self.raw.hexdigest()
+        return self.raw_hexdigest
+
+    def metadata(self):
+        """The digests, as metadata to store with the object"""
+        metadata = {ALGORITHM: self.compressed.hexdigest()}
+        if self._raw_hexdigest() is not None:
+            metadata['raw-' + ALGORITHM] = self._raw_hexdigest()
+        return metadata
+
+    def as_dict(self):
+        """The digests, as recorded in the backup sentinel"""
+        return {'algorithm': ALGORITHM,
+                'compressed': self.compressed.hexdigest(),
+                'raw': self._raw_hexdigest()}
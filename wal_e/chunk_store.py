@@ -0,0 +1,351 @@
+"""
+Deduplicated storage of the contents of large files in base backups.
+
+In a chunked backup, a regular file of at least CHUNK_SIZE bytes is cut
+into chunks of CHUNK_SIZE bytes, counted from the start of the file.
+Each chunk is compressed and optionally encrypted like a volume, and
+stored once under the SHA-256 digest of its contents.  The "chunks"
+directory that holds them is shared by all backups, so a chunk
+already stored by an earlier backup is not uploaded again.
+
+The file is archived as a tar member of type CHUNK_TYPE, whose
+contents are:
+
+* a header, holding a magic number, the size of the file and the
+  chunk size;
+
+* for every chunk, its digest and the suffix of the codec it was
+  compressed with.
+
+PostgreSQL modifies its files in place, a page at a time, and extends
+them at the end, so data does not move around within a file.  Cutting
+chunks at fixed offsets in each file finds the data shared with
+earlier backups just as well as cutting them where a rolling hash of
+the contents says to would, without computing that hash for every
+byte.
+
+The names of the chunks a backup refers to are listed in its sentinel,
+so that "delete" can remove those no remaining backup refers to.  A
+backup still being taken has no sentinel yet, and may also rely on
+chunks stored by backups being deleted, so a chunked "backup-push"
+first stores a PUSH_MARKER object in the directory of its backup,
+before it lists the chunks already stored.  "delete" removes no
+chunks while a backup it retains has a marker but no sentinel; that
+of a backup that failed holds chunks back until the backup is
+deleted itself.  A "backup-push" started just as "delete" decides
+what to remove may still lose chunks to it.
+
+"""
+import errno
+import gevent
+import gevent.pool
+import hashlib
+import os
+import re
+import socket
+import struct
+
+from cStringIO import StringIO
+from wal_e import compression
+from wal_e import file_io
+from wal_e import log_help
+from wal_e import pipeline
+from wal_e import storage
+from wal_e.blobstore import get_blobstore
+from wal_e.exception import UserCritical
+from wal_e.files import read_exactly
+from wal_e.piper import PIPE
+from wal_e.retries import retry, retry_with_count
+
+logger = log_help.WalELogger(__name__)
+
+# A tar member type not used by tar implementations.
+CHUNK_TYPE = 'Y'
+
+MAGIC = 'WALECHK1'
+HEADER = struct.Struct('<8sQQ')
+
+# A digest, and the codec suffix padded with NULs.
+ENTRY = struct.Struct('<32s8s')
+
+CHUNK_SIZE = 4 * 1024 * 1024
+
+# Stored in the directory of a chunked backup as it is taken.
+PUSH_MARKER = 'chunked_push_in_progress'
+
+# The number of chunks sent or fetched at once.
+CHUNK_CONCURRENCY = 8
+
+
+def wants_chunking(tarinfo):
+    return tarinfo.isfile() and tarinfo.size >= CHUNK_SIZE
+
+
+def _chunk_url(layout, name):
+    return '{scheme}://{store}/{path}'.format(
+        scheme=layout.scheme, store=layout.store_name(),
+        path=layout.chunk_path(name))
+
+
+def stored_chunks(layout, keys):
+    """Map digests to the names of the chunks among keys
+
+    The keys are those listed in the chunk directory.
+    """
+    known = {}
+    for key in keys:
+        name = layout.key_name(key).rsplit('/', 1)[-1]
+        match = re.match(storage.CHUNK_REGEXP + '$', name)
+        if match is not None:
+            known[match.group('digest')] = name
+
+    return known
+
+
+def _pipe_through(pl, data):
+    """Write data through a pipeline, returning its output"""
+    def write():
+        pl.stdin.write(data)
+        pl.stdin.flush()
+        pl.stdin.close()
+
+    g = gevent.spawn(write)
+    try:
+        out = pl.stdout.read()
+    except:
+        g.kill()
+        raise
+
+    g.get()
+    return out
+
+
+class ChunkUploader(object):
+    """Stores the chunks of the files of a chunked backup
+
+    known maps the digests of chunks already stored to their names.
+    The chunks of files are read at the rate allowed by rate_limiter,
+    a TokenBucket, if passed.
+    Chunks are sent in the background, CHUNK_CONCURRENCY at a time; put
+    blocks while that many are in flight, and join waits for all of
+    them to be sent, while wait_sent only waits for those already put.
+    """
+
+    def __init__(self, creds, layout, gpg_key, compression=None,
+                 known=None, rate_limiter=None):
+        self.creds = creds
+        self.layout = layout
+        self.gpg_key = gpg_key
+        self.compression = compression
+        self.rate_limiter = rate_limiter
+        self.blobstore = get_blobstore(layout)
+
+        self.known = dict(known or {})
+        self.referenced = set()
+
+        self._pool = gevent.pool.Pool(size=CHUNK_CONCURRENCY)
+        self._sending = []
+
+    @property
+    def suffix(self):
+        return '.lzo' if self.compression is None else self.compression.suffix
+
+    def put(self, data):
+        """Store a chunk, unless it is already, and return its entry"""
+        if self.rate_limiter is not None:
+            self.rate_limiter.take(len(data))
+
+        digest = hashlib.sha256(data)
+        name = self.known.get(digest.hexdigest())
+
+        if name is None:
+            name = digest.hexdigest() + self.suffix
+            self.known[digest.hexdigest()] = name
+            self._raise_errors()
+            self._sending.append(self._pool.spawn(self._send, name, data))
+
+        self.referenced.add(name)
+        # The name is the hexadecimal digest followed by the suffix.
+        return ENTRY.pack(digest.digest(), name[64:])
+
+    def _raise_errors(self):
+        for g in [g for g in self._sending if g.ready()]:
+            g.get()
+            self._sending.remove(g)
+
+    def join(self):
+        self._pool.join()
+        self._raise_errors()
+
+    def wait_sent(self):
+        """Wait for the chunks referred to so far to be sent"""
+        gevent.joinall(list(self._sending))
+        self._raise_errors()
+
+    def _send(self, name, data):
+        with pipeline.get_upload_pipeline(
+                PIPE, PIPE, gpg_key=self.gpg_key,
+                compression=self.compression) as pl:
+            compressed = _pipe_through(pl, data)
+
+        url = _chunk_url(self.layout, name)
+
+        def log_chunk_failures_on_error(exc_tup, exc_processor_cxt):
+            typ, value, tb = exc_tup
+            del exc_tup
+
+            if issubclass(typ, socket.error):
+                socketmsg = value[1] if isinstance(value, tuple) else value
+
+                logger.info(
+                    msg='Retrying send because of a socket error',
+                    detail=('The socket error\'s message is \'{0}\'.  There '
+                            'have been {n} attempts to send the chunk {url} '
+                            'so far.'.format(socketmsg, n=exc_processor_cxt,
+                                             url=url)))
+            else:
+                raise typ, value, tb
+
+        @retry(retry_with_count(log_chunk_failures_on_error))
+        def put_chunk_helper():
+            return self.blobstore.uri_put_file(self.creds, url,
+                                               StringIO(compressed))
+
+        put_chunk_helper()
+        logger.debug(msg='stored a chunk',
+                     detail='The chunk was stored at "{0}".'.format(url))
+
+
+def chunk_file(f, size, chunks, digest=None):
+    """Store the chunks of a file, returning the chunked member contents
+
+    Only the first size bytes of f are stored; should the file have
+    shrunk, it is padded with NULs, as TarWriter does.  The
+    digest, if passed, is updated with what was stored.
+    """
+    index = [HEADER.pack(MAGIC, size, CHUNK_SIZE)]
+    remaining = size
+
+    while remaining > 0:
+        want = min(remaining, CHUNK_SIZE)
+        data = f.read(want)
+        if len(data) < want:
+            data += '\0' * (want - len(data))
+
+        if digest is not None:
+            digest.update(data)
+
+        index.append(chunks.put(data))
+        remaining -= want
+
+    return ''.join(index)
+
+
+class _PendingFile(object):
+    """A file being restored, and the number of its chunks yet to come"""
+
+    def __init__(self, path, remaining, mtime):
+        self.path = path
+        self.remaining = remaining
+        self.mtime = mtime
+
+
+class ChunkRestorer(object):
+    """Restores chunked files, fetching their chunks in the background
+
+    The chunks of the files of a volume are fetched CHUNK_CONCURRENCY
+    at a time while the volume is extracted.  A file's modification
+    time is set, and it is synced, once all its chunks are written.
+    join waits for all files to be restored.
+    """
+
+    def __init__(self, creds, layout, decrypt):
+        self.creds = creds
+        self.layout = layout
+        self.decrypt = decrypt
+        self.blobstore = get_blobstore(layout)
+
+        self._pool = gevent.pool.Pool(size=CHUNK_CONCURRENCY)
+        self._fetching = []
+
+    def restore(self, fp, target_path, tarinfo):
+        """Restore a file from the chunked member contents read from fp"""
+        magic, size, chunk_size = HEADER.unpack(
+            read_exactly(fp, HEADER.size, 'chunked member'))
+        if magic != MAGIC:
+            raise IOError('bad chunked member magic number {0!r}'
+                          .format(magic))
+
+        n_chunks = (size + chunk_size - 1) // chunk_size
+        entries = [ENTRY.unpack(read_exactly(fp, ENTRY.size,
+                                             'chunked member'))
+                   for i in xrange(n_chunks)]
+
+        upperdirs = os.path.dirname(target_path)
+        try:
+            os.makedirs(upperdirs)
+        except EnvironmentError as e:
+            if e.errno != errno.EEXIST:
+                raise
+
+        with open(target_path, 'wb') as f:
+            f.truncate(size)
+
+        pending = _PendingFile(target_path, n_chunks, tarinfo.mtime)
+        for i, (digest, suffix) in enumerate(entries):
+            self._raise_errors()
+            self._fetching.append(self._pool.spawn(
+                self._fetch, pending, i * chunk_size, digest,
+                suffix.rstrip('\0')))
+
+    def _raise_errors(self):
+        for g in [g for g in self._fetching if g.ready()]:
+            g.get()
+            self._fetching.remove(g)
+
+    def join(self):
+        self._pool.join()
+        self._raise_errors()
+
+    def _fetch(self, pending, offset, digest, suffix):
+        name = digest.encode('hex') + suffix
+        url = _chunk_url(self.layout, name)
+
+        @retry()
+        def get_chunk_helper():
+            return self.blobstore.uri_get_file(self.creds, url)
+
+        with pipeline.get_download_pipeline(
+                PIPE, PIPE, self.decrypt,
+                codec=compression.codec_for_name(name)) as pl:
+            data = _pipe_through(pl, get_chunk_helper())
+
+        if hashlib.sha256(data).digest() != digest:
+            raise UserCritical(
+                msg='chunk does not match its digest',
+                detail='The chunk at "{0}" is corrupt.'.format(url))
+
+        file_io.run(_write_chunk, pending.path, offset, data)
+
+        pending.remaining -= 1
+        if pending.remaining == 0:
+            file_io.run(_finish_file, pending.path, pending.mtime)
+
+
+def _write_chunk(path, offset, data):
+    fd = os.open(path, os.O_WRONLY)
+    try:
+        os.lseek(fd, offset, os.SEEK_SET)
+        while data:
+            data = data[os.write(fd, data):]
+    finally:
+        os.close(fd)
+
+
+def _finish_file(path, mtime):
+    fd = os.open(path, os.O_WRONLY)
+    try:
+        os.fsync(fd)
+        os.utime(path, (mtime, mtime))
+    finally:
+        os.close(fd)
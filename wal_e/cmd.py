@@ -88,6 +88,9 @@ import traceback
 
 from wal_e import log_help
 
+from wal_e import compression as compression_codecs
+from wal_e import durability
+from wal_e import file_io
 from wal_e import subprocess
 from wal_e.exception import UserCritical
 from wal_e.exception import UserException
@@ -229,6 +232,19 @@ def build_parser():
         'Can also be defined via environment variable '
         'WALE_GPG_KEY_ID')
 
+    parser.add_argument(
+        '--compression', metavar='CODEC[:LEVEL]',
+        help='Codec, and optionally level, to compress WAL segments and '
+        'base backups with: lzo (the default), zstd or lz4.  Archives '
+        'compressed with any codec can be fetched regardless.  '
+        'Can also be defined via environment variable WALE_COMPRESSION')
+
+    parser.add_argument(
+        '--compression-threads', type=int, metavar='N',
+        help='Number of threads compressing with the zstd and lz4 '
+        'codecs, which cut their input into frames compressed in '
+        'parallel.  Defaults to the number of CPUs.')
+
     parser.add_argument(
         '--terse', action='store_true',
         help='Only log messages as or more severe than a warning.')
@@ -244,6 +260,11 @@ def build_parser():
     backup_fetchpush_parent.add_argument(
         '--pool-size', '-p', type=int, default=4,
         help='Set the maximum number of concurrent transfers')
+    backup_fetchpush_parent.add_argument(
+        '--io-threads', type=int, default=file_io.THREADS, metavar='N',
+        help=('Number of threads reading and writing files in the cluster '
+              'directory, so that transfers go on while they wait on the '
+              'disk; 0 to do without (default: %(default)s)'))
 
     # operator to print the wal-e version
     subparsers.add_parser('version', help='print the wal-e version')
@@ -275,6 +296,108 @@ def build_parser():
         'tunable number of bytes per second', dest='rate_limit',
         metavar='BYTES_PER_SECOND',
         type=int, default=None)
+    backup_push_parser.add_argument(
+        '--cluster-read-burst',
+        help=('Allow reading this many bytes at once in excess of the '
+              'rate limit after a pause (default: one second\'s worth)'),
+        dest='rate_limit_burst', metavar='BYTES', type=int, default=None)
+    backup_push_parser.add_argument(
+        '--cluster-read-rate-limit-file',
+        help=('Read the rate limit from this file whenever it changes '
+              'during the backup, 0 lifting the limit'),
+        dest='rate_limit_file', metavar='PATH', default=None)
+    backup_push_parser.add_argument(
+        '--direct-io',
+        help=('Read the cluster directory with O_DIRECT, bypassing the '
+              'page cache, where the file system supports it'),
+        dest='direct_io',
+        action='store_true',
+        default=False)
+    backup_push_parser.add_argument(
+        '--zero-copy',
+        help=('Splice the contents of files of 64 KiB and more into the '
+              'compressor without reading them.  Their SHA-1 digests are '
+              'then left out of the backup\'s manifest, and the volumes '
+              'holding them go without a raw-sha256 digest; by default '
+              'files are read and digested instead'),
+        dest='zero_copy',
+        action='store_true',
+        default=False)
+    backup_push_parser.add_argument(
+        '--compression-pool-size', type=int, default=None,
+        help=('Set the maximum number of concurrent volume compressions; '
+              '--pool-size then sets the number of concurrent uploads '
+              '(default: same as --pool-size)'))
+    backup_push_parser.add_argument(
+        '--stream-upload',
+        help=('Upload volumes in parts while they are being compressed '
+              'instead of staging them in temporary files first (S3 and '
+              'WABS only)'),
+        dest='stream_upload',
+        action='store_true',
+        default=False)
+    backup_push_parser.add_argument(
+        '--readers-per-device', metavar='N', type=int, default=None,
+        help=('Read at most this many volumes from each device, such as '
+              'that of a tablespace, at once, starting volumes of other '
+              'devices meanwhile; size the compression pool to cover all '
+              'devices'))
+    backup_push_parser.add_argument(
+        '--max-temp-bytes', metavar='BYTES', type=int, default=None,
+        help=('Hold back volumes from compression while the temporary '
+              'files of those awaiting upload would exceed this size'))
+    backup_push_parser.add_argument(
+        '--min-temp-free', metavar='BYTES', type=int, default=None,
+        help=('Hold back volumes from compression while they would leave '
+              'less free space than this for temporary files (default: '
+              '10%% of their file system)'))
+    backup_push_parser.add_argument(
+        '--max-memory', metavar='BYTES', type=int, default=None,
+        help=('Hold back volumes from compression while WAL-E takes up '
+              'more memory than this'))
+    backup_push_parser.add_argument(
+        '--incremental-from', metavar='QUERY', default=None,
+        help=('Only upload files changed since the named backup, or the '
+              'latest one if LATEST is passed, and refer to earlier '
+              'backups for the rest'))
+    backup_push_parser.add_argument(
+        '--page-deltas',
+        help=('With --incremental-from, upload only the pages of changed '
+              'relation files that were modified since that backup'),
+        dest='page_deltas',
+        action='store_true',
+        default=False)
+    backup_push_parser.add_argument(
+        '--chunked',
+        help=('Store large files as chunks shared with other backups, '
+              'uploading only chunks that are not stored already'),
+        dest='chunked',
+        action='store_true',
+        default=False)
+    backup_push_parser.add_argument(
+        '--tar-processes',
+        help=('Write volumes from processes of their own, so that '
+              'writing several at once uses as many CPUs (not with '
+              '--chunked)'),
+        dest='tar_processes',
+        action='store_true',
+        default=False)
+    backup_push_parser.add_argument(
+        '--resumable',
+        help=('Should the backup fail after uploading some volumes, leave '
+              'it in progress, rather than stopping it, so that it can be '
+              'finished with --resume'),
+        dest='resumable',
+        action='store_true',
+        default=False)
+    backup_push_parser.add_argument(
+        '--resume',
+        help=('Finish a backup interrupted part way through, uploading only '
+              'what it had not uploaded yet; it is finished as it was '
+              'started, regardless of the other options describing it'),
+        dest='resume',
+        action='store_true',
+        default=False)
     backup_push_parser.add_argument(
         '--while-offline',
         help=('Backup a Postgres cluster that is in a stopped state '
@@ -309,6 +432,17 @@ def build_parser():
               'restoration (optional, see README for more information).'),
         type=str,
         default=None)
+    backup_fetch_parser.add_argument(
+        '--download-connections', metavar='N', type=int, default=1,
+        help=('Fetch each volume in ranges over this many connections at '
+              'once, per volume fetched at once (default: 1, fetching '
+              'volumes whole)'))
+    backup_fetch_parser.add_argument(
+        '--durability', choices=durability.STRATEGIES, default='fsync',
+        help=('How restored files are synced: fsync each volume\'s files '
+              'in parallel, fsync after starting writeback of each file '
+              'as it is extracted, or syncfs each file system once at the '
+              'end (default: fsync)'))
 
     # backup-list operator section
     backup_list_parser.add_argument(
@@ -460,6 +594,17 @@ def configure_backup_cxt(args):
     if gpg_key_id is not None:
         external_program_check([GPG_BIN])
 
+    if args.compression_threads is not None:
+        if args.compression_threads < 1:
+            raise UserException(
+                msg='--compression-threads must be at least one',
+                detail='The value passed was {0}.'.format(
+                    args.compression_threads))
+
+    compression = compression_codecs.parse(
+        args.compression or os.getenv('WALE_COMPRESSION'),
+        threads=args.compression_threads)
+
     # Enumeration of reading in configuration for all supported
     # backend data stores, yielding value adhering to the
     # 'operator.Backup' protocol.
@@ -469,7 +614,7 @@ def configure_backup_cxt(args):
 
         from wal_e.operator import s3_operator
 
-        return s3_operator.S3Backup(store, None, gpg_key_id)
+        return s3_operator.S3Backup(store, None, gpg_key_id, compression)
     elif store.is_wabs:
         account_name = args.wabs_account_name or os.getenv('WABS_ACCOUNT_NAME')
         if account_name is None:
@@ -488,7 +633,7 @@ def configure_backup_cxt(args):
 
         creds = wabs.Credentials(account_name, access_key)
 
-        return WABSBackup(store, creds, gpg_key_id)
+        return WABSBackup(store, creds, gpg_key_id, compression)
     elif store.is_swift:
         from wal_e.blobstore import swift
         from wal_e.operator.swift_operator import SwiftBackup
@@ -502,11 +647,11 @@ def configure_backup_cxt(args):
             os.getenv('SWIFT_ENDPOINT_TYPE', 'publicURL'),
             os.getenv('SWIFT_AUTH_VERSION', '2'),
         )
-        return SwiftBackup(store, creds, gpg_key_id)
+        return SwiftBackup(store, creds, gpg_key_id, compression)
     elif store.is_gs:
         creds = gs_creds(args)
         from wal_e.operator.gs_operator import GSBackup
-        return GSBackup(store, creds, gpg_key_id)
+        return GSBackup(store, creds, gpg_key_id, compression)
     else:
         raise UserCritical(
             msg='no unsupported blob stores should get here',
@@ -557,16 +702,38 @@ def main():
     try:
         backup_cxt = configure_backup_cxt(args)
 
+        # External programs needed by the configured compression codec,
+        # and by any codec objects being fetched may be compressed with.
+        codec_programs = list(backup_cxt.compression.codec.programs)
+        fetch_programs = backup_cxt.compression.fetch_programs()
+
+        if subcommand in ('backup-fetch', 'backup-push'):
+            if args.io_threads < 0:
+                raise UserException(
+                    msg='--io-threads must not be negative',
+                    detail='The value passed was {0}.'.format(
+                        args.io_threads))
+
         if subcommand == 'backup-fetch':
             monkeypatch_tarfile_copyfileobj()
 
-            external_program_check([LZOP_BIN])
+            if args.download_connections < 1:
+                raise UserException(
+                    msg='invalid number of download connections',
+                    detail='--download-connections was {0}.'.format(
+                        args.download_connections),
+                    hint='Pass a positive number.')
+
+            external_program_check(fetch_programs)
             backup_cxt.database_fetch(
                 args.PG_CLUSTER_DIRECTORY,
                 args.BACKUP_NAME,
                 blind_restore=args.blind_restore,
                 restore_spec=args.restore_spec,
-                pool_size=args.pool_size)
+                pool_size=args.pool_size,
+                download_connections=args.download_connections,
+                durability=args.durability,
+                io_threads=args.io_threads)
         elif subcommand == 'backup-list':
             backup_cxt.backup_list(query=args.QUERY, detail=args.detail)
         elif subcommand == 'backup-push':
@@ -578,34 +745,98 @@ def main():
                 external_program_check([CONFIG_BIN])
                 parser = PgControlDataParser(args.PG_CLUSTER_DIRECTORY)
                 controldata_bin = parser.controldata_bin()
-                external_programs = [
-                    LZOP_BIN,
-                    PV_BIN,
-                    controldata_bin]
+                external_programs = codec_programs + [controldata_bin]
             else:
-                external_programs = [LZOP_BIN, PSQL_BIN, PV_BIN]
+                external_programs = codec_programs + [PSQL_BIN]
 
             external_program_check(external_programs)
             rate_limit = args.rate_limit
 
+            for option, value in (
+                    ('--cluster-read-rate-limit', rate_limit),
+                    ('--cluster-read-burst', args.rate_limit_burst)):
+                if value is not None and value <= 0:
+                    raise UserException(
+                        msg='invalid rate limit',
+                        detail='{0} was {1}.'.format(option, value),
+                        hint='Pass a positive number of bytes.')
+
+            for option, value in (
+                    ('--max-temp-bytes', args.max_temp_bytes),
+                    ('--min-temp-free', args.min_temp_free),
+                    ('--max-memory', args.max_memory)):
+                if value is not None and value <= 0:
+                    raise UserException(
+                        msg='invalid volume budget',
+                        detail='{0} was {1}.'.format(option, value),
+                        hint='Pass a positive number of bytes.')
+
+            if (args.readers_per_device is not None and
+                    args.readers_per_device < 1):
+                raise UserException(
+                    msg='invalid number of readers per device',
+                    detail='--readers-per-device was {0}.'.format(
+                        args.readers_per_device),
+                    hint='Pass a positive number.')
+
+            if args.tar_processes and args.chunked:
+                raise UserException(
+                    msg='volumes of chunked backups cannot be written by '
+                    'processes of their own',
+                    hint='Pass only one of --tar-processes and --chunked.')
+
+            if (args.stream_upload and
+                    args.compression_pool_size is not None):
+                raise UserException(
+                    msg='streamed volumes are compressed as they are '
+                    'uploaded',
+                    detail=('--compression-pool-size does not apply to '
+                            '--stream-upload, where --pool-size sets how '
+                            'many volumes are compressed and uploaded at '
+                            'once.'),
+                    hint=('Pass only one of --stream-upload and '
+                          '--compression-pool-size.'))
+
+            if args.page_deltas and args.incremental_from is None:
+                raise UserException(
+                    msg='page deltas require an incremental backup',
+                    hint='Pass --incremental-from along with --page-deltas.')
+
             while_offline = args.while_offline
             backup_cxt.database_backup(
                 args.PG_CLUSTER_DIRECTORY,
                 rate_limit=rate_limit,
+                rate_limit_burst=args.rate_limit_burst,
+                rate_limit_file=args.rate_limit_file,
                 while_offline=while_offline,
-                pool_size=args.pool_size)
+                pool_size=args.pool_size,
+                compression_pool_size=args.compression_pool_size,
+                stream_upload=args.stream_upload,
+                incremental_from=args.incremental_from,
+                page_deltas=args.page_deltas,
+                chunked=args.chunked,
+                resumable=args.resumable,
+                resume=args.resume,
+                tar_processes=args.tar_processes,
+                max_temp_bytes=args.max_temp_bytes,
+                min_temp_free=args.min_temp_free,
+                max_memory=args.max_memory,
+                readers_per_device=args.readers_per_device,
+                direct_io=args.direct_io,
+                zero_copy=args.zero_copy,
+                io_threads=args.io_threads)
         elif subcommand == 'wal-fetch':
-            external_program_check([LZOP_BIN])
+            external_program_check(fetch_programs)
             res = backup_cxt.wal_restore(args.WAL_SEGMENT,
                                          args.WAL_DESTINATION,
                                          args.prefetch)
             if not res:
                 sys.exit(1)
         elif subcommand == 'wal-prefetch':
-            external_program_check([LZOP_BIN])
+            external_program_check(fetch_programs)
             backup_cxt.wal_prefetch(args.BASE_DIRECTORY, args.SEGMENT)
         elif subcommand == 'wal-push':
-            external_program_check([LZOP_BIN])
+            external_program_check(codec_programs)
             backup_cxt.wal_archive(args.WAL_SEGMENT,
                                    concurrency=args.pool_size)
         elif subcommand == 'delete':
@@ -0,0 +1,167 @@
+"""
+Compression codecs for archived WAL segments and base backup volumes.
+
+The codec an object was compressed with is recorded in the suffix of
+its name: ".lzo" for lzop, ".zst" for zstd and ".lz4" for lz4, so the
+right decompressor can be picked when the object is fetched.
+
+lzop runs as an external program, as it always has.  zstd and lz4 run
+in-process, on threads of their own (see pipeline.ThreadedFilter), and
+require the "zstandard" and "lz4" Python packages respectively.
+
+"""
+import collections
+import importlib
+
+from wal_e import pipeline
+from wal_e import storage
+from wal_e.exception import UserException
+
+
+class Codec(object):
+    """A compression format, and the filters to produce and read it"""
+
+    def __init__(self, name, suffix, levels, compressor, decompressor,
+                 module=None, programs=()):
+        self.name = name
+        self.suffix = suffix
+        # The range of supported compression levels, inclusive.
+        self.levels = levels
+        self.compressor = compressor
+        self.decompressor = decompressor
+        # A Python module or external programs that must be present.
+        self.module = module
+        self.programs = programs
+
+    def check(self):
+        """Ensure what this codec requires is installed"""
+        if self.module is None:
+            return
+
+        try:
+            importlib.import_module(self.module)
+        except ImportError:
+            raise UserException(
+                msg='compression codec {0} is not available'.format(
+                    self.name),
+                detail='The Python module "{0}" could not be imported.'
+                .format(self.module),
+                hint='Install the Python package providing it.')
+
+    def compression_filter(self, level=None, threads=None):
+        return self.compressor(level, threads)
+
+    def decompression_filter(self):
+        return self.decompressor()
+
+
+class Compression(collections.namedtuple('Compression',
+                                         ['codec', 'level', 'threads'])):
+    """A codec, and the level to compress with (None for its default)
+
+    threads is the number of threads compressing frames with the
+    in-process codecs, None for one per CPU.
+    """
+
+    def __new__(cls, codec, level, threads=None):
+        return super(Compression, cls).__new__(cls, codec, level, threads)
+
+    @property
+    def suffix(self):
+        return self.codec.suffix
+
+    def compression_filter(self):
+        return self.codec.compression_filter(self.level, self.threads)
+
+    def fetch_order(self):
+        """Codecs to look for objects compressed with, this one first"""
+        return [self.codec] + [codec for codec in CODECS.values()
+                               if codec is not self.codec]
+
+    def fetch_programs(self):
+        """External programs that fetching objects may require
+
+        Objects are decompressed by the codec their names call for,
+        which may be any of them.
+        """
+        programs = []
+        for codec in self.fetch_order():
+            programs.extend(program for program in codec.programs
+                            if program not in programs)
+        return programs
+
+
+CODECS = collections.OrderedDict(
+    (codec.name, codec) for codec in [
+        Codec('lzo', '.lzo', (1, 9),
+              lambda level, threads: pipeline.LZOCompressionFilter(level),
+              pipeline.LZODecompressionFilter,
+              programs=(pipeline.LZOP_BIN,)),
+        Codec('zstd', '.zst', (1, 22),
+              lambda level, threads: pipeline.ZstdCompressionFilter(
+                  3 if level is None else level, threads),
+              pipeline.ZstdDecompressionFilter,
+              module='zstandard'),
+        Codec('lz4', '.lz4', (0, 16),
+              lambda level, threads: pipeline.LZ4CompressionFilter(
+                  0 if level is None else level, threads),
+              pipeline.LZ4DecompressionFilter,
+              module='lz4.frame'),
+    ])
+
+DEFAULT_CODEC = 'lzo'
+
+DEFAULT_COMPRESSION = Compression(CODECS[DEFAULT_CODEC], None)
+
+assert (sorted(codec.suffix for codec in CODECS.values()) ==
+        sorted(storage.COMPRESSION_SUFFIXES))
+
+
+def parse(spec, threads=None):
+    """Parse a CODEC[:LEVEL] specification into a Compression
+
+    The default codec is used if spec is None.  threads is the
+    number of threads compressing frames, None for one per CPU.
+    """
+    if spec is None:
+        spec = DEFAULT_CODEC
+
+    name, sep, level = spec.partition(':')
+    codec = CODECS.get(name)
+    if codec is None:
+        raise UserException(
+            msg='unsupported compression codec',
+            detail='The codec "{0}" is not known.'.format(name),
+            hint='The supported codecs are: {0}.'.format(
+                ', '.join(CODECS)))
+
+    if sep:
+        low, high = codec.levels
+        try:
+            level = int(level)
+        except ValueError:
+            level = None
+
+        if level is None or not low <= level <= high:
+            raise UserException(
+                msg='invalid compression level',
+                detail='The compression level was "{0}".'.format(spec),
+                hint=('The levels supported by {0} range from {1} to {2}.'
+                      .format(name, low, high)))
+    else:
+        level = None
+
+    codec.check()
+    return Compression(codec, level, threads)
+
+
+def codec_for_name(name):
+    """Find the codec an object was compressed with from its name
+
+    Returns None if the name does not end in any codec's suffix.
+    """
+    for codec in CODECS.values():
+        if name.endswith(codec.suffix):
+            return codec
+
+    return None
@@ -0,0 +1,230 @@
+"""
+Making the files restored by backup-fetch durable.
+
+backup-fetch reports success only once the files it restored, and the
+directories holding them, have been written to stable storage.  How
+that is done is chosen with --durability:
+
+* fsync, the default, syncs the files of each volume once it has been
+  extracted, FSYNC_BATCH files at a time with the batches synced in
+  parallel on the file I/O pool, and then the directories holding
+  them, in the same way;
+
+* writeback also has the kernel start writing each file back as soon
+  as it has been extracted, with sync_file_range, so that little is
+  left to write by the time the file is synced;
+
+* syncfs syncs nothing until all volumes have been extracted, and then
+  each file system restored to with one syncfs, which writes back its
+  files and directories together.
+
+Python 2 has neither, so sync_file_range and syncfs are called from
+libc through ctypes.  Where they are unavailable, files are synced as
+by fsync.
+
+The time spent in each phase is summed over the volumes synced at
+once, and logged by Durability.log at the end of the restore.
+
+"""
+import collections
+import ctypes
+import ctypes.util
+import os
+import sys
+import threading
+import time
+
+from wal_e import file_io
+from wal_e import log_help
+
+logger = log_help.WalELogger(__name__)
+
+STRATEGIES = ('fsync', 'writeback', 'syncfs')
+
+# The number of files synced by each thread of the file I/O pool at a
+# time.
+FSYNC_BATCH = 64
+
+# Linux's value of this constant.
+_SYNC_FILE_RANGE_WRITE = 2
+
+_OPEN_FLAGS = os.O_RDONLY | getattr(os, 'O_BINARY', 0)
+
+
+def _load_libc():
+    if not sys.platform.startswith('linux'):
+        return {}
+
+    try:
+        libc = ctypes.CDLL(ctypes.util.find_library('c'), use_errno=True)
+    except OSError:
+        return {}
+
+    functions = {}
+
+    sync_file_range = getattr(libc, 'sync_file_range', None)
+    if sync_file_range is not None:
+        sync_file_range.argtypes = [ctypes.c_int, ctypes.c_int64,
+                                    ctypes.c_int64, ctypes.c_uint]
+        sync_file_range.restype = ctypes.c_int
+        functions['sync_file_range'] = sync_file_range
+
+    syncfs = getattr(libc, 'syncfs', None)
+    if syncfs is not None:
+        syncfs.argtypes = [ctypes.c_int]
+        syncfs.restype = ctypes.c_int
+        functions['syncfs'] = syncfs
+
+    return functions
+
+
+_libc = _load_libc()
+
+
+def _fsync_paths(paths, flags=_OPEN_FLAGS):
+    for path in paths:
+        fd = os.open(path, flags)
+        try:
+            os.fsync(fd)
+        finally:
+            os.close(fd)
+
+
+def _fsync_batches(paths, flags=_OPEN_FLAGS):
+    results = [file_io.spawn(_fsync_paths, paths[i:i + FSYNC_BATCH], flags)
+               for i in xrange(0, len(paths), FSYNC_BATCH)]
+    for result in results:
+        result.get()
+
+
+def fsync_files(filenames):
+    """fsync files, and then the directories holding them
+
+    They are synced FSYNC_BATCH at a time, with the batches synced in
+    parallel on the file I/O pool.
+    """
+    _fsync_batches(filenames)
+
+    # Some OSes also require us to fsync the directory where we've
+    # created files or subdirectories.
+    if hasattr(os, 'O_DIRECTORY'):
+        _fsync_batches(list(set(os.path.dirname(f) for f in filenames)),
+                       os.O_RDONLY | os.O_DIRECTORY)
+
+
+def _start_writeback(path):
+    """Have the kernel start writing a file back, without waiting"""
+    # Writeback started early is only an optimization: errors are
+    # left to the fsync that follows.
+    try:
+        fd = os.open(path, _OPEN_FLAGS)
+    except EnvironmentError:
+        return
+
+    try:
+        _libc['sync_file_range'](fd, 0, 0, _SYNC_FILE_RANGE_WRITE)
+    finally:
+        os.close(fd)
+
+
+def _syncfs(path):
+    fd = os.open(path, _OPEN_FLAGS)
+    try:
+        if _libc['syncfs'](fd) != 0:
+            e = ctypes.get_errno()
+            raise OSError(e, os.strerror(e), path)
+    finally:
+        os.close(fd)
+
+
+class Durability(object):
+    """Syncs restored files by one of STRATEGIES
+
+    tarfile_extract calls extracted with each regular file it wrote,
+    and sync with the absolute paths of everything it extracted but
+    symbolic links, at least once per volume.  finish is to be called
+    once every volume has been extracted, before the restore is
+    reported complete.
+    """
+
+    def __init__(self, strategy='fsync'):
+        assert strategy in STRATEGIES
+
+        needed = {'writeback': 'sync_file_range',
+                  'syncfs': 'syncfs'}.get(strategy)
+        if needed is not None and needed not in _libc:
+            logger.warning(
+                msg='cannot sync restored files by ' + strategy,
+                detail='{0} is not available on this system.'.format(
+                    needed),
+                hint='Restored files are synced by fsync instead.')
+            strategy = 'fsync'
+
+        self.strategy = strategy
+        self.timings = collections.OrderedDict()
+        self.files = 0
+        self._directories = set()
+        self._lock = threading.Lock()
+
+    def _add_time(self, phase, started):
+        with self._lock:
+            self.timings[phase] = (self.timings.get(phase, 0.0) +
+                                   time.time() - started)
+
+    def _writeback(self, path):
+        started = time.time()
+        _start_writeback(path)
+        self._add_time('start writeback', started)
+
+    def extracted(self, path):
+        """Note a regular file was written to path"""
+        if self.strategy == 'writeback':
+            # Not waited for, lest extraction wait on the disk.
+            file_io.spawn(self._writeback, path)
+
+    def sync(self, filenames, fsync=fsync_files):
+        """Make the files, and the directories holding them, durable
+
+        They are synced by fsync, a function taking the filenames.
+        With syncfs, that is left to finish.
+        """
+        self.files += len(filenames)
+
+        if self.strategy == 'syncfs':
+            self._directories.update(os.path.dirname(f) for f in filenames)
+            return
+
+        started = time.time()
+        fsync(filenames)
+        self._add_time('fsync', started)
+
+    def finish(self):
+        """Sync what sync left to the end of the restore"""
+        if not self._directories:
+            return
+
+        started = time.time()
+        filesystems = {}
+        for path in self._directories:
+            filesystems.setdefault(os.stat(path).st_dev, path)
+
+        for path in filesystems.itervalues():
+            file_io.run(_syncfs, path)
+
+        self._directories.clear()
+        self._add_time('syncfs', started)
+
+    def log(self):
+        logger.info(
+            msg='synced restored files',
+            detail=('{0} files were synced by {1}, taking {2}.'.format(
+                self.files, self.strategy,
+                ', '.join('{0:.2f} seconds to {1}'.format(seconds, phase)
+                          for phase, seconds in self.timings.iteritems())
+                or 'no time')),
+            structured=dict(
+                [('action', 'backup-fetch'),
+                 ('strategy', self.strategy),
+                 ('files', self.files)] +
+                [(phase.replace(' ', '_'), '{0:.3f}'.format(seconds))
+                 for phase, seconds in self.timings.iteritems()]))
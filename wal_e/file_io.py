@@ -0,0 +1,196 @@
+"""
+Doing blocking file I/O without blocking every greenlet.
+
+WAL-E's transfers run in greenlets, all on the one thread of gevent's
+hub.  Reading, writing and syncing regular files are system calls
+gevent cannot make cooperative: made from a greenlet, they block the
+hub, and with it every other greenlet, for as long as the disk takes.
+Uploads and downloads then stall behind a slow disk.
+
+run calls a function on a pool of threads shared by the process, and
+lets other greenlets run until it returns.  Functions
+making several such calls, such as opening a file and reading ahead
+of it, are best run whole, as each call on the pool costs a thread
+switch or two.  spawn starts calling a function there without waiting
+for it.  CooperativeReader reads the file it wraps on the pool.
+The pool has THREADS threads, or as many as backup-fetch and
+backup-push are told to use (see using_threads).
+
+Called other than from a greenlet of the main thread's hub, as from a
+thread of the pool or of a ThreadedFilter, run and spawn simply call
+the function, which blocks only that thread.
+
+StallMonitor measures how long the hub was kept from running
+greenlets, whatever the cause, to tell whether it still happens.
+
+"""
+import contextlib
+import gevent
+import gevent.event
+import gevent.threadpool
+import threading
+import time
+
+from wal_e import log_help
+
+logger = log_help.WalELogger(__name__)
+
+# The number of threads doing file I/O by default.  With none, it is
+# done by the greenlets themselves.
+THREADS = 8
+
+# StallMonitor checks on the hub this often, in seconds, and counts it
+# as stalled if it is later than this to do so.
+STALL_INTERVAL = 0.1
+STALL_THRESHOLD = 0.05
+
+_threads = THREADS
+_pool = None
+
+
+def _on_main_hub():
+    # threading is not patched by gevent, so other threads are told
+    # apart without creating hubs of their own.
+    return isinstance(threading.current_thread(), threading._MainThread)
+
+
+def _get_pool():
+    global _pool
+    if _pool is None or _pool.hub is not gevent.get_hub():
+        # The main thread's hub was replaced, as by tests.
+        _pool = gevent.threadpool.ThreadPool(_threads)
+    return _pool
+
+
+@contextlib.contextmanager
+def using_threads(threads):
+    """Do file I/O on a pool of that many threads meanwhile
+
+    The pool is started when first needed, and stopped on leaving.
+    """
+    global _threads, _pool
+
+    saved = _threads, _pool
+    _threads, _pool = threads, None
+    try:
+        yield
+    finally:
+        if _pool is not None:
+            _pool.kill()
+        _threads, _pool = saved
+
+
+def run(fn, *args, **kwargs):
+    """Call fn on the file I/O pool, returning what it returns"""
+    if not _threads or not _on_main_hub():
+        return fn(*args, **kwargs)
+    return _get_pool().apply(fn, args, kwargs)
+
+
+def spawn(fn, *args, **kwargs):
+    """Start calling fn on the file I/O pool
+
+    Returns an AsyncResult, to get what fn returns from.
+    """
+    if _threads and _on_main_hub():
+        return _get_pool().spawn(fn, *args, **kwargs)
+
+    result = gevent.event.AsyncResult()
+    try:
+        result.set(fn(*args, **kwargs))
+    except Exception, e:
+        result.set_exception(e)
+    return result
+
+
+class CooperativeReader(object):
+    """Wraps a BackupReader, reading it on the file I/O pool
+
+    Closing the file, which does not wait on the disk, is left to the
+    greenlet.
+    """
+
+    def __init__(self, f):
+        self._f = f
+
+    @classmethod
+    def open(cls, opener, *args):
+        """Open a file with opener, on the pool, and wrap it"""
+        return cls(run(opener, *args))
+
+    def read(self, size):
+        return run(self._f.read, size)
+
+    def readinto(self, b):
+        return run(self._f.readinto, b)
+
+    def splice(self, fd, size):
+        return run(self._f.splice, fd, size)
+
+    def close(self):
+        self._f.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.close()
+        return False
+
+
+class StallMonitor(object):
+    """Measures the time the hub was blocked while it is running
+
+    A greenlet wakes every STALL_INTERVAL seconds.  Whenever it wakes
+    STALL_THRESHOLD seconds or more later than it should have, the
+    hub is counted as having been blocked for that long.  When used
+    as a context manager, the time is logged at the end.
+    """
+
+    def __init__(self, action):
+        self.action = action
+        self.stalls = 0
+        self.stalled = 0.0
+        self.longest = 0.0
+        self._greenlet = None
+
+    def start(self):
+        self._greenlet = gevent.spawn(self._watch)
+
+    def stop(self):
+        if self._greenlet is not None:
+            self._greenlet.kill()
+            self._greenlet = None
+
+    def _watch(self):
+        while True:
+            before = time.time()
+            gevent.sleep(STALL_INTERVAL)
+            late = time.time() - before - STALL_INTERVAL
+
+            if late >= STALL_THRESHOLD:
+                self.stalls += 1
+                self.stalled += late
+                self.longest = max(self.longest, late)
+
+    def log(self):
+        logger.info(
+            msg='measured event loop stalls',
+            detail=('Greenlets were kept from running {0} times, for '
+                    '{1:.2f} seconds in all and at most {2:.2f} seconds '
+                    'at once.'.format(self.stalls, self.stalled,
+                                      self.longest)),
+            structured={'action': self.action,
+                        'stalls': self.stalls,
+                        'stalled': '{0:.3f}'.format(self.stalled),
+                        'longest': '{0:.3f}'.format(self.longest)})
+
+    def __enter__(self):
+        self.start()
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.stop()
+        if exc_type is None:
+            self.log()
+        return False
@@ -22,3 +22,15 @@ class DeleteOnError(object):
         finally:
             if self.f:
                 self.f.close()
+
+
+def read_exactly(fp, size, what):
+    """Read size bytes of fp, raising IOError if fewer remain
+
+    what names what is read, for the error message.
+    """
+    data = fp.read(size)
+    if len(data) != size:
+        raise IOError('truncated {0}'.format(what))
+
+    return data
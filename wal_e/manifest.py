@@ -0,0 +1,165 @@
+"""
+Per-file manifests of base backups, used for incremental backups.
+
+A manifest records the size, modification time and SHA-1 digest of
+every regular file archived by a base backup, the digest being null
+for files archived by backup-push --zero-copy.  It also records which
+backup, and which volume of that backup, holds the file's contents,
+and the checksums of the volumes of the backup (see checksum).
+
+A backup taken incrementally from a parent backup only archives files
+whose size or modification time differ from the parent's manifest
+entry.  For the other files it copies the parent's entry, which refers
+to the (possibly older) backup actually holding their contents.  A
+restore thus needs volumes from that backup and from each backup it
+"depends on".
+
+As with rsync's default behavior, a change to a file is assumed to be
+reflected in its size or modification time.  So that writes within the
+resolution of the modification time are not missed, files modified
+shortly before the parent backup began are always archived again.
+
+With page deltas, a changed relation file is archived as a delta of
+its pages modified since the parent backup began (see page_delta),
+provided its delta chain is not too long already.  Its entry then
+refers to the backup holding the full copy of the file as before, and
+lists the backups holding deltas to apply to it, oldest first.
+
+"""
+import time
+
+from wal_e import page_delta
+
+# Positions of the fields of a manifest entry, which are kept as
+# lists to keep the backup sentinel compact.  DELTAS is a list of
+# [backup, part] pairs.
+SIZE, MTIME, DIGEST, BACKUP, PART, DELTAS = range(6)
+
+# Modification times within this many seconds of the start of a
+# backup are not trusted to show whether a file changed since.
+MTIME_SLACK = 1
+
+
+class BackupManifest(object):
+    """Accumulates the manifest of a base backup while it is taken
+
+    If parent is passed, it is the BackupInfo, with details loaded, of
+    the backup to take an incremental backup from.  If page_deltas is
+    also set, changed relation files may be archived as page deltas.
+    """
+
+    def __init__(self, backup_name, parent=None, page_deltas=False):
+        self.backup_name = backup_name
+        self.parent = parent
+        self.created = time.time()
+        self.files = {}
+        self.volumes = {}
+
+        if parent is not None:
+            self._parent_files = _files_by_member_name(parent.manifest)
+            self._parent_created = parent.manifest['created']
+        else:
+            self._parent_files = None
+            self._parent_created = None
+
+        # Pages with an LSN from before the parent backup started are
+        # held by it.
+        if parent is not None and page_deltas:
+            self.delta_lsn = page_delta.lsn_from_segment(
+                parent.wal_segment_backup_start,
+                parent.wal_segment_offset_backup_start)
+        else:
+            self.delta_lsn = None
+
+    def inherit(self, tarinfo):
+        """Refer to the parent backup's copy of a file, if unchanged
+
+        Returns True if so, in which case the file need not be
+        archived.
+        """
+        if self._parent_files is None or not tarinfo.isfile():
+            return False
+
+        entry = self._parent_files.get(tarinfo.name)
+        if (entry is None
+                or entry[SIZE] != tarinfo.size
+                or entry[MTIME] != tarinfo.mtime
+                or entry[MTIME] >= self._parent_created - MTIME_SLACK):
+            return False
+
+        self.files[tarinfo.name] = entry
+        return True
+
+    def delta_base_size(self, tarinfo):
+        """Return the parent's size of a file to archive a delta of
+
+        Returns None if the whole file is to be archived.
+        """
+        if self.delta_lsn is None or not page_delta.is_relation(
+                tarinfo.name):
+            return None
+
+        entry = self._parent_files.get(tarinfo.name)
+        if entry is None or len(entry[DELTAS]) >= page_delta.DELTA_CHAIN_MAX:
+            return None
+
+        return entry[SIZE]
+
+    def add(self, tarinfo, part, digest):
+        """Record a file archived in volume number part"""
+        self.files[tarinfo.name] = [tarinfo.size, tarinfo.mtime, digest,
+                                    self.backup_name, part, []]
+
+    def add_delta(self, tarinfo, part, digest):
+        """Record a delta of a file archived in volume number part"""
+        base = self._parent_files[tarinfo.name]
+        self.files[tarinfo.name] = [
+            tarinfo.size, tarinfo.mtime, digest, base[BACKUP], base[PART],
+            base[DELTAS] + [[self.backup_name, part]]]
+
+    def add_volume(self, part, checksums):
+        """Record the checksums of volume number part, as a dict"""
+        self.volumes[part] = checksums
+
+    def depends_on(self):
+        """List the other backups holding files, oldest first"""
+        if self.parent is None:
+            return []
+
+        referenced = set()
+        for entry in self.files.itervalues():
+            referenced.add(entry[BACKUP])
+            referenced.update(backup for backup, part in entry[DELTAS])
+        chain = list(getattr(self.parent, 'depends_on', None) or [])
+        chain.append(self.parent.name)
+
+        return [name for name in chain if name in referenced]
+
+    def as_dict(self):
+        return {'created': self.created, 'files': self.files,
+                'volumes': self.volumes}
+
+
+def members_by_volume(manifest, backup_name):
+    """Map volume numbers to the file names held there by a backup
+
+    Those are the names of both files and deltas of files.  The
+    manifest is as stored in the sentinel of a (later) backup.
+    """
+    volumes = {}
+    for name, entry in _files_by_member_name(manifest).iteritems():
+        if entry[BACKUP] == backup_name:
+            volumes.setdefault(entry[PART], set()).add(name)
+
+        for backup, part in entry[DELTAS]:
+            if backup == backup_name:
+                volumes.setdefault(part, set()).add(name)
+
+    return volumes
+
+
+def _files_by_member_name(manifest):
+    # JSON decoding yields unicode file names, whereas tar member
+    # names are byte strings.
+    return dict((name.encode('utf-8'), entry)
+                for name, entry in manifest['files'].iteritems())
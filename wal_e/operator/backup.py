@@ -1,24 +1,36 @@
 import errno
 import functools
 import gevent
-import gevent.pool
 import itertools
 import json
 import os
+import re
 import sys
+import time
 
 from cStringIO import StringIO
+from wal_e import backup_journal
+from wal_e import chunk_store
+from wal_e import compression as compression_codecs
+from wal_e import file_io
 from wal_e import log_help
+from wal_e import manifest
+from wal_e import page_cache
 from wal_e import storage
 from wal_e import tar_partition
+from wal_e import throttle
+from wal_e.durability import Durability
 from wal_e.exception import UserException, UserCritical
 from wal_e.worker import prefetch
-from wal_e.worker import (WalSegment,
+from wal_e.worker import (FetchPool,
+                          WalSegment,
                           WalUploader,
                           PgBackupStatements,
                           PgControlDataParser,
                           PartitionUploader,
+                          StagedTarUploadPool,
                           TarUploadPool,
+                          VolumeBudget,
                           WalTransferGroup,
                           uri_put_file,
                           do_lzop_get)
@@ -34,10 +46,12 @@ logger = log_help.WalELogger(__name__)
 
 class Backup(object):
 
-    def __init__(self, layout, creds, gpg_key_id):
+    def __init__(self, layout, creds, gpg_key_id, compression=None):
         self.layout = layout
         self.creds = creds
         self.gpg_key_id = gpg_key_id
+        self.compression = (compression or
+                            compression_codecs.DEFAULT_COMPRESSION)
         self.exceptions = []
 
     def new_connection(self):
@@ -69,7 +83,9 @@ class Backup(object):
         sys.stdout.flush()
 
     def database_fetch(self, pg_cluster_dir, backup_name,
-                       blind_restore, restore_spec, pool_size):
+                       blind_restore, restore_spec, pool_size,
+                       download_connections=1, durability='fsync',
+                       io_threads=file_io.THREADS):
         if os.path.exists(os.path.join(pg_cluster_dir, 'postmaster.pid')):
             hint = ('Shut down postgres. If there is a stale lockfile, '
                     'then remove it after being very sure postgres is not '
@@ -133,27 +149,89 @@ class Backup(object):
         for i in xrange(pool_size):
             connections.append(self.new_connection())
 
-        partition_iter = self.worker.TarPartitionLister(
-            connections[0], self.layout, backup_info)
-
-        assert len(connections) == pool_size
-        fetchers = []
+        # Each fetcher fetches the ranges of its volumes over
+        # download_connections connections of its own, one of which is
+        # the one it fetches whole volumes and listings over.
+        download_conns = []
         for i in xrange(pool_size):
-            fetchers.append(self.worker.BackupFetcher(
-                connections[i], self.layout, backup_info,
-                backup_info.spec['base_prefix'],
-                (self.gpg_key_id is not None)))
-        assert len(fetchers) == pool_size
-
-        p = gevent.pool.Pool(size=pool_size)
-        fetcher_cycle = itertools.cycle(fetchers)
-        for part_name in partition_iter:
-            p.spawn(
-                self._exception_gather_guard(
-                    fetcher_cycle.next().fetch_partition),
-                part_name)
-
-        p.join(raise_error=True)
+            conns = [connections[i]]
+            if download_connections > 1:
+                conns.extend(self.new_connection()
+                             for j in xrange(download_connections - 1))
+            download_conns.append(conns)
+
+        # Files of chunked backups are restored from their chunks in
+        # the background, and must be complete before moving on.
+        chunks = chunk_store.ChunkRestorer(self.creds, self.layout,
+                                           (self.gpg_key_id is not None))
+
+        # Restored files are durable only once this has finished.
+        durable = Durability(durability)
+
+        def make_fetchers(bi):
+            fetchers = []
+            for i in xrange(pool_size):
+                fetchers.append(self.worker.BackupFetcher(
+                    connections[i], self.layout, bi,
+                    backup_info.spec['base_prefix'],
+                    (self.gpg_key_id is not None), chunks=chunks,
+                    download_conns=download_conns[i], durability=durable))
+            assert len(fetchers) == pool_size
+            return fetchers
+
+        # Volumes are fetched largest first, by whichever connection
+        # is free next, and connections that keep failing are retired.
+        pool = FetchPool(pool_size)
+
+        with file_io.using_threads(io_threads), \
+                file_io.StallMonitor('backup-fetch'):
+            # Files of an incremental backup that did not change since
+            # its parent are held by the volumes of earlier backups, so
+            # extract just those from each of them.  Page deltas are to be
+            # applied on top of the files restored from earlier backups,
+            # so go through the backups one at a time, oldest first.
+            depends_on = getattr(backup_info, 'depends_on', None) or []
+            for ancestor in self._find_backups(bl, depends_on):
+                volumes = manifest.members_by_volume(backup_info.manifest,
+                                                     ancestor.name)
+                ancestor_volumes = []
+                for part_name, size in self.worker.TarPartitionLister(
+                        connections[0], self.layout, ancestor).volumes():
+                    members = volumes.get(int(
+                        re.match(storage.VOLUME_REGEXP, part_name).group(1)))
+                    if members:
+                        ancestor_volumes.append((part_name, size, members))
+
+                pool.fetch(make_fetchers(ancestor), ancestor_volumes)
+                chunks.join()
+
+            partition_iter = self.worker.TarPartitionLister(
+                connections[0], self.layout, backup_info)
+
+            pool.fetch(make_fetchers(backup_info),
+                       [(part_name, size, None)
+                        for part_name, size in partition_iter.volumes()])
+            chunks.join()
+            durable.finish()
+
+        durable.log()
+
+    def _find_backups(self, bl, names):
+        """Find the backups of the given names, in the same order"""
+        if not names:
+            return []
+
+        by_name = dict((bi.name, bi) for bi in bl)
+        missing = [name for name in names if name not in by_name]
+        if missing:
+            raise UserException(
+                msg='backup depends on backups that could not be found',
+                detail=('The missing backups are: {0}.'
+                        .format(', '.join(missing))),
+                hint=('The backup is incremental, and the backups holding '
+                      'its unchanged files may have been deleted.'))
+
+        return [by_name[name] for name in names]
 
     def database_backup(self, data_directory, *args, **kwargs):
         """Uploads a PostgreSQL file cluster to S3 or Windows Azure Blob
@@ -164,6 +242,16 @@ class Backup(object):
 
         In particular there is a 'finally' block to stop the backup in
         most situations.
+
+        If incremental_from names a backup (or is 'LATEST'), only files
+        changed since that backup are uploaded.
+
+        With resumable, the backup is journaled as it is uploaded (see
+        backup_journal), and should it fail after uploading some
+        volumes, it is left in progress rather than stopped.  With
+        resume, such a backup is then finished rather than a new one
+        taken, with the options it was started with.  Any other backup
+        that fails is stopped.
         """
         upload_good = False
         backup_stop_good = False
@@ -172,8 +260,35 @@ class Backup(object):
         if 'while_offline' in kwargs:
             while_offline = kwargs.pop('while_offline')
 
+        parent = None
+        incremental_from = kwargs.pop('incremental_from', None)
+
+        path = backup_journal.journal_path(data_directory)
+        journal = None
+        resumable = kwargs.pop('resumable', False)
+        if kwargs.pop('resume', False):
+            resumable = True
+            journal = backup_journal.BackupJournal.load(path)
+            self._check_resumable(journal, data_directory)
+            while_offline = journal.header['while_offline']
+            incremental_from = journal.header['incremental_from']
+            kwargs['page_deltas'] = journal.header['page_deltas']
+            kwargs['chunked'] = journal.header['chunked']
+        else:
+            self._abandon_journal(path, data_directory)
+
+        if incremental_from is not None:
+            parent = self._incremental_parent(incremental_from)
+
         try:
-            if not while_offline:
+            if journal is not None:
+                start_backup_info = journal.header['start_backup_info']
+                version = journal.header['pg_version']
+                logger.info(
+                    msg='resuming an interrupted backup',
+                    detail=('{0} volumes of the backup were uploaded before '
+                            'it was interrupted.'.format(journal.parts)))
+            elif not while_offline:
                 start_backup_info = PgBackupStatements.run_start_backup()
                 version = PgBackupStatements.pg_version()['version']
             else:
@@ -192,25 +307,49 @@ class Backup(object):
                 start_backup_info = ctrl_data.last_xlog_file_name_and_offset()
                 version = ctrl_data.pg_version()
 
-            ret_tuple = self._upload_pg_cluster_dir(
-                start_backup_info, data_directory, version=version, *args,
-                **kwargs)
-            spec, uploaded_to, expanded_size_bytes = ret_tuple
+            if journal is None and resumable:
+                journal = self._new_journal(
+                    path, start_backup_info, version, while_offline,
+                    parent=parent,
+                    page_deltas=kwargs.get('page_deltas', False),
+                    chunked=kwargs.get('chunked', False))
+
+            io_threads = kwargs.get('io_threads', file_io.THREADS)
+            with file_io.using_threads(io_threads):
+                ret_tuple = self._upload_pg_cluster_dir(
+                    start_backup_info, data_directory, version=version,
+                    parent=parent, journal=journal, *args, **kwargs)
+            (spec, uploaded_to, expanded_size_bytes, backup_manifest,
+             chunk_names) = ret_tuple
             upload_good = True
         finally:
-            if not upload_good:
+            left_in_progress = (not upload_good and journal is not None
+                                and journal.parts > 0)
+            if left_in_progress:
+                logger.warning(
+                    msg='leaving the backup in progress so it can be resumed',
+                    detail=('{0} volumes of the backup were uploaded before '
+                            'it failed.'.format(journal.parts)),
+                    hint=('Run backup-push again with --resume to finish '
+                          'it, or without to take a new backup instead.'))
+            elif not upload_good:
                 logger.warning(
                     'blocking on sending WAL segments',
                     detail=('The backup was not completed successfully, '
                             'but we have to wait anyway.  '
                             'See README: TODO about pg_cancel_backup'))
 
-            if not while_offline:
+            if left_in_progress:
+                stop_backup_info = None
+            elif not while_offline:
                 stop_backup_info = PgBackupStatements.run_stop_backup()
             else:
                 stop_backup_info = start_backup_info
             backup_stop_good = True
 
+            if journal is not None and not left_in_progress:
+                journal.remove()
+
         # XXX: Ugly, this is more of a 'worker' task because it might
         # involve retries and error messages, something that is not
         # treated by the "operator" category of modules.  So
@@ -221,15 +360,23 @@ class Backup(object):
             # directory that indicates that the base backup upload has
             # definitely run its course and also communicates what WAL
             # segments are needed to get to consistency.
+            sentinel = {'wal_segment_backup_stop':
+                            stop_backup_info['file_name'],
+                        'wal_segment_offset_backup_stop':
+                            stop_backup_info['file_offset'],
+                        'expanded_size_bytes': expanded_size_bytes,
+                        'spec': spec,
+                        'manifest': backup_manifest.as_dict()}
+
+            if parent is not None:
+                sentinel['incremental_from'] = parent.name
+                sentinel['depends_on'] = backup_manifest.depends_on()
+
+            if chunk_names is not None:
+                sentinel['chunks'] = chunk_names
+
             sentinel_content = StringIO()
-            json.dump(
-                {'wal_segment_backup_stop':
-                    stop_backup_info['file_name'],
-                 'wal_segment_offset_backup_stop':
-                    stop_backup_info['file_offset'],
-                 'expanded_size_bytes': expanded_size_bytes,
-                 'spec': spec},
-                sentinel_content)
+            json.dump(sentinel, sentinel_content)
 
             # XXX: should use the storage operators.
             #
@@ -261,7 +408,8 @@ class Backup(object):
         # in archive_status.
         xlog_dir = os.path.dirname(wal_path)
         segment = WalSegment(wal_path, explicit=True)
-        uploader = WalUploader(self.layout, self.creds, self.gpg_key_id)
+        uploader = WalUploader(self.layout, self.creds, self.gpg_key_id,
+                               self.compression)
         group = WalTransferGroup(uploader)
         group.start(segment)
 
@@ -302,10 +450,12 @@ class Backup(object):
         NB: Postgres doesn't guarantee that wal_name ==
         basename(wal_path), so both are required.
 
+        The WAL file is looked for compressed with the configured
+        codec first, then with the others.
+
         """
-        url = '{0}://{1}/{2}'.format(
-            self.layout.scheme, self.layout.store_name(),
-            self.layout.wal_path(wal_name))
+        urls = self._wal_urls(wal_name)
+        url = urls[0]
 
         if prefetch_max > 0:
             # Check for prefetch-hit.
@@ -351,8 +501,11 @@ class Backup(object):
                         'prefix': self.layout.path_prefix,
                         'state': 'begin'})
 
-        ret = do_lzop_get(self.creds, url, wal_destination,
-                          self.gpg_key_id is not None)
+        for url in urls:
+            ret = do_lzop_get(self.creds, url, wal_destination,
+                              self.gpg_key_id is not None)
+            if ret:
+                break
 
         logger.info(
             msg='complete wal restore',
@@ -364,10 +517,16 @@ class Backup(object):
 
         return ret
 
-    def wal_prefetch(self, base, segment_name):
-        url = '{0}://{1}/{2}'.format(
+    def _wal_urls(self, wal_name):
+        """The URLs a WAL file may be stored at, most likely first"""
+        return ['{0}://{1}/{2}'.format(
             self.layout.scheme, self.layout.store_name(),
-            self.layout.wal_path(segment_name))
+            self.layout.wal_path(wal_name, codec.suffix))
+            for codec in self.compression.fetch_order()]
+
+    def wal_prefetch(self, base, segment_name):
+        urls = self._wal_urls(segment_name)
+        url = urls[0]
         pd = prefetch.Dirs(base)
         seg = WalSegment(segment_name)
         pd.create(seg)
@@ -380,8 +539,12 @@ class Backup(object):
                             'prefix': self.layout.path_prefix,
                             'state': 'begin'})
 
-            ret = do_lzop_get(self.creds, url, d.dest,
-                              self.gpg_key_id is not None, do_retry=False)
+            for url in urls:
+                ret = do_lzop_get(self.creds, url, d.dest,
+                                  self.gpg_key_id is not None, do_retry=False)
+                if ret:
+                    break
+
             if not ret:
                 # If the download failed, AtomicDownload.__exit__()
                 # must be informed so that it does not link an empty
@@ -429,8 +592,125 @@ class Backup(object):
         bl = self.worker.BackupList(conn, self.layout, detail)
         return bl
 
+    def _new_journal(self, path, start_backup_info, version, while_offline,
+                     parent=None, page_deltas=False, chunked=False):
+        """Start the journal of a backup
+
+        Returns None, so that the backup is taken without one, if the
+        journal cannot be written.
+        """
+        header = {'prefix': self.layout.prefix,
+                  'start_backup_info': start_backup_info,
+                  'pg_version': version,
+                  'while_offline': while_offline,
+                  'incremental_from': parent and parent.name,
+                  'page_deltas': page_deltas,
+                  'chunked': chunked,
+                  'created': time.time()}
+
+        try:
+            return backup_journal.BackupJournal.create(path, header)
+        except EnvironmentError, e:
+            logger.warning(
+                msg='taking a backup that cannot be resumed',
+                detail=('The backup journal could not be written to "{0}": '
+                        '{1}'.format(path, e.strerror)))
+            return None
+
+    def _abandon_journal(self, path, data_directory):
+        """Abandon the interrupted backup journaled at path, if any
+
+        A backup left in progress when it failed is stopped, so that
+        a new one can be started, provided it is the backup in
+        progress.
+        """
+        try:
+            journal = backup_journal.BackupJournal.load(path)
+        except UserException:
+            return
+
+        logger.warning(
+            msg='abandoning an interrupted backup',
+            detail=('{0} volumes of the backup were uploaded before it was '
+                    'interrupted.'.format(journal.parts)),
+            hint='Run backup-push with --resume to finish it instead.')
+
+        start_file = journal.header['start_backup_info']['file_name']
+        if (not journal.header['while_offline'] and
+                _backup_label_start_file(data_directory) == start_file):
+            try:
+                PgBackupStatements.run_stop_backup()
+            except UserException:
+                # It was not left in progress after all.
+                pass
+
+        journal.remove()
+
+    def _check_resumable(self, journal, data_directory):
+        """Check that the backup journaled is still in progress"""
+        header = journal.header
+        start_file = header['start_backup_info']['file_name']
+
+        if header['prefix'] != self.layout.prefix:
+            raise UserException(
+                msg='the interrupted backup was taken elsewhere',
+                detail=('It was being uploaded to {0}, not {1}.'
+                        .format(header['prefix'], self.layout.prefix)),
+                hint='Resume it with the WALE_*_PREFIX it was started with.')
+
+        if header['while_offline']:
+            if os.path.exists(os.path.join(data_directory, 'postmaster.pid')):
+                found = None
+            else:
+                ctrl_data = PgControlDataParser(data_directory)
+                found = ctrl_data.last_xlog_file_name_and_offset()['file_name']
+        else:
+            found = _backup_label_start_file(data_directory)
+
+        if found != start_file:
+            raise UserException(
+                msg='the interrupted backup can no longer be resumed',
+                detail=('It started at WAL segment {0}, but that backup is no '
+                        'longer in progress.'.format(start_file)),
+                hint='Run backup-push without --resume to take a new backup.')
+
+    def _incremental_parent(self, query):
+        """Find the backup to take an incremental backup from
+
+        Returns None if that backup has no manifest, in which case a
+        full backup is to be taken.
+        """
+        backups = list(self._backup_list(False).find_all(query))
+        if len(backups) == 0:
+            raise UserException(
+                msg='no backup found to take an incremental backup from',
+                detail=('No backup matching the query {0} '
+                        'was able to be located.'.format(query)))
+
+        parent = backups[0]
+        parent.load_detail(self.new_connection())
+
+        if getattr(parent, 'manifest', None) is None:
+            logger.warning(
+                msg='taking a full backup instead of an incremental one',
+                detail=('The backup {0} has no manifest of its files.'
+                        .format(parent.name)),
+                hint='Backups taken by older versions of WAL-E lack one.')
+            return None
+
+        return parent
+
     def _upload_pg_cluster_dir(self, start_backup_info, pg_cluster_dir,
-                               version, pool_size, rate_limit=None):
+                               version, pool_size, rate_limit=None,
+                               rate_limit_burst=None, rate_limit_file=None,
+                               stream_upload=False,
+                               compression_pool_size=None, parent=None,
+                               page_deltas=False, chunked=False,
+                               journal=None, tar_processes=False,
+                               max_temp_bytes=None, min_temp_free=None,
+                               max_memory=None, readers_per_device=None,
+                               direct_io=False, zero_copy=False,
+                               io_threads=file_io.THREADS):
         """
         Upload to url_prefix from pg_cluster_dir
 
@@ -443,38 +723,95 @@ class Backup(object):
         lzo is completely finished (necessary to have access to the file
         size) the file is sent to S3 or WABS.
 
-        TODO: Investigate an optimization to decouple the compression and
-        upload steps to make sure that the most efficient possible use of
-        pipelining of network and disk resources occurs.  Right now it
-        possible to bounce back and forth between bottlenecking on reading
-        from the database block device and subsequently the S3/WABS sending
-        steps should the processes be at the same stage of the upload
-        pipeline: this can have a very negative impact on being able to
-        make full use of system resources.
-
-        Furthermore, it desirable to overflowing the page cache: having
-        separate tunables for number of simultanious compression jobs
-        (which occupy /tmp space and page cache) and number of uploads
-        (which affect upload throughput) would help.
+        Compression and upload are decoupled: up to
+        compression_pool_size volumes are compressed at once (which
+        occupy /tmp space and page cache) while up to pool_size
+        finished volumes are uploaded (which affect upload
+        throughput), so that reading from the database block device
+        and sending to S3/WABS can proceed at the same time rather than
+        bouncing back and forth between the two bottlenecks.  If
+        compression_pool_size is not given, it defaults to pool_size.
+
+        With stream_upload, volumes are instead cut into parts as they
+        are compressed and sent as multipart uploads, where the blob
+        store supports that, so that no temporary files are used and
+        compression and upload of a volume overlap.
+
+        Every regular file archived is recorded in a manifest.  If the
+        BackupInfo of a parent backup with a manifest is passed, files
+        unchanged since then are not archived again, but refer to the
+        parent backup's copy instead.  With page_deltas, changed
+        relation files may be archived as deltas of their pages.
+
+        Reading the cluster directory is limited to rate_limit bytes
+        per second, in bursts of up to rate_limit_burst bytes, across
+        all volumes being compressed at once.  If rate_limit_file is
+        passed, the limit is changed whenever a new one is written
+        there (see throttle).
+
+        Files are read so as to leave the page cache as it was,
+        dropping the pages read that were not cached before, or
+        bypassing it altogether with direct_io (see page_cache).
+        With zero_copy, larger files are spliced into volumes without
+        being read, at the cost of their digests in the manifest and
+        the raw digests of their volumes.
+
+        With chunked, large files are stored as chunks shared with
+        other backups (see chunk_store), and the names of those
+        referred to are returned as well; otherwise None is.
+
+        Volumes uploaded are recorded in journal, if passed.  Those it
+        has recorded already, of a resumed backup, are not uploaded
+        again.
+
+        With tar_processes, the tar streams of volumes are written by
+        processes of their own (see tar_worker), so that writing
+        several at once is not limited to one CPU.  Each reads files
+        on a pool of io_threads threads (see file_io), as backup-push
+        itself does.
+
+        Volumes are held back from compression while the temporary
+        files of those awaiting upload would take up more than
+        max_temp_bytes, leave less than min_temp_free bytes free on
+        their file system, or while the process takes up more than
+        max_memory bytes (see VolumeBudget).
+
+        Volumes are read from one device each, such as that of a
+        tablespace.  With readers_per_device, up to that many volumes
+        are read from each device at once, volumes of other devices
+        being started meanwhile, so that as many devices as there are
+        are read in parallel.
 
         """
-        spec, parts = tar_partition.partition(pg_cluster_dir)
-
         # TODO :: Move arbitray path construction to StorageLayout Object
         backup_prefix = '{0}/basebackups_{1}/base_{file_name}_{file_offset}'\
             .format(self.layout.prefix.rstrip('/'), FILE_STRUCTURE_VERSION,
                         **start_backup_info)
 
-        if rate_limit is None:
-            per_process_limit = None
+        backup_manifest = manifest.BackupManifest(
+            'base_{file_name}_{file_offset}'.format(**start_backup_info),
+            parent=parent, page_deltas=page_deltas)
+        if journal is not None:
+            # A resumed backup is as old as when it was started.
+            backup_manifest.created = journal.header['created']
+            backup_manifest.volumes.update(journal.checksums)
+        spec, parts = tar_partition.partition(pg_cluster_dir,
+                                              backup_manifest,
+                                              resumed=journal)
+
+        if compression_pool_size is None or stream_upload:
+            compression_pool_size = pool_size
+
+        # The rate limit applies to reading the cluster directory,
+        # and is shared by all the volumes being read at once.
+        if rate_limit is None and rate_limit_file is None:
+            rate_limiter = None
         else:
-            per_process_limit = int(rate_limit / pool_size)
+            rate_limiter = throttle.TokenBucket(rate_limit,
+                                                burst=rate_limit_burst,
+                                                control_path=rate_limit_file)
 
-        # Reject tiny per-process rate limits.  They should be
-        # rejected more nicely elsewhere.
-        assert per_process_limit > 0 or per_process_limit is None
-
-        total_size = 0
+        total_size = 0 if journal is None else journal.total_size
 
         # Make an attempt to upload extended version metadata
         extended_version_url = backup_prefix + '/extended_version.txt'
@@ -488,24 +825,90 @@ class Backup(object):
 
         logger.info(msg='postgres version metadata upload complete')
 
-        uploader = PartitionUploader(self.creds, backup_prefix,
-                                     per_process_limit, self.gpg_key_id)
-
-        pool = TarUploadPool(uploader, pool_size)
+        chunks = None
+        if chunked:
+            # Keep delete from removing the chunks the backup relies on
+            # until its sentinel lists them.
+            uri_put_file(self.creds,
+                         backup_prefix + '/' + chunk_store.PUSH_MARKER,
+                         StringIO(''), content_encoding='text/plain')
+            chunks = chunk_store.ChunkUploader(
+                self.creds, self.layout, self.gpg_key_id,
+                compression=self.compression, known=self._stored_chunks(),
+                rate_limiter=rate_limiter)
 
-        # Enqueue uploads for parallel execution
-        for tpart in parts:
-            total_size += tpart.total_member_size
+        uploader = PartitionUploader(self.creds, backup_prefix,
+                                     rate_limiter, self.gpg_key_id,
+                                     stream=stream_upload,
+                                     manifest=backup_manifest,
+                                     compression=self.compression,
+                                     chunks=chunks, journal=journal,
+                                     tar_processes=tar_processes,
+                                     direct_io=direct_io,
+                                     zero_copy=zero_copy,
+                                     io_threads=io_threads)
+
+        budget = VolumeBudget(max_temp_bytes=max_temp_bytes,
+                              min_temp_free=min_temp_free,
+                              max_memory=max_memory,
+                              temp_files=not stream_upload)
+
+        if stream_upload:
+            # Volumes are uploaded as they are compressed, so there is
+            # only the one stage.
+            pool = TarUploadPool(uploader, pool_size, budget=budget,
+                                 readers_per_device=readers_per_device)
+        else:
+            pool = StagedTarUploadPool(uploader, compression_pool_size,
+                                       pool_size, budget=budget,
+                                       readers_per_device=readers_per_device)
+
+        # Report how long greenlets, uploads among them, were kept
+        # waiting on reads of the cluster directory or anything else.
+        with file_io.StallMonitor('backup-push'):
+            # Enqueue uploads for parallel execution
+            numbers = set()
+            for tpart in parts:
+                total_size += tpart.total_member_size
+                numbers.add(tpart.name)
+
+                # 'put' can raise an exception for a just-failed upload,
+                # aborting the process.
+                pool.put(tpart)
+
+            if journal is not None:
+                # Overwrite volumes an interrupted backup may have left
+                # incomplete, which are not needed after all.
+                for number in journal.unfinished():
+                    if number not in numbers:
+                        pool.put(tar_partition.TarPartition(number))
+
+            # Wait for remaining parts to upload.  An exception can be
+            # raised to signal failure of the upload.
+            pool.join()
+
+            chunk_names = None
+            if chunks is not None:
+                chunks.join()
+                referenced = set(chunks.referenced)
+                if journal is not None:
+                    referenced.update(journal.chunk_names)
+                chunk_names = sorted(referenced)
 
-            # 'put' can raise an exception for a just-failed upload,
-            # aborting the process.
-            pool.put(tpart)
+        logger.info(
+            msg='finished reading the cluster directory',
+            detail=('{0} bytes were read, and {1} pages read were dropped '
+                    'from the page cache.'.format(
+                        page_cache.STATS.bytes_read,
+                        page_cache.STATS.pages_dropped)))
 
-        # Wait for remaining parts to upload.  An exception can be
-        # raised to signal failure of the upload.
-        pool.join()
+        return spec, backup_prefix, total_size, backup_manifest, chunk_names
 
-        return spec, backup_prefix, total_size
+    def _stored_chunks(self):
+        """Map the digests of the chunks already stored to their names"""
+        bl = self._backup_list(False)
+        return chunk_store.stored_chunks(
+            self.layout, bl._backup_list(self.layout.chunk_directory()))
 
     def _exception_gather_guard(self, fn):
         """
@@ -565,6 +968,24 @@ class Backup(object):
                       'spec to have WAL-E create tablespace symlinks for you'))
 
 
+def _backup_label_start_file(data_directory):
+    """Read the WAL segment the backup in progress started at
+
+    Returns None if there is no backup in progress.
+    """
+    try:
+        with open(os.path.join(data_directory, 'backup_label')) as f:
+            label = f.read()
+    except EnvironmentError, e:
+        if e.errno == errno.ENOENT:
+            return None
+        raise
+
+    match = re.search(r'^START WAL LOCATION: .* \(file ([0-9A-F]{24})\)$',
+                      label, re.MULTILINE)
+    return match and match.group(1)
+
+
 def start_prefetches(seg, pd, how_many):
     from wal_e import pep3143daemon as daemon
 
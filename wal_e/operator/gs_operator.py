@@ -8,7 +8,8 @@ class GSBackup(Backup):
     A performs Google Storage uploads of PostgreSQL WAL files and clusters
     """
 
-    def __init__(self, layout, creds, gpg_key_id):
-        super(GSBackup, self).__init__(layout, creds, gpg_key_id)
+    def __init__(self, layout, creds, gpg_key_id, compression=None):
+        super(GSBackup, self).__init__(layout, creds, gpg_key_id,
+                                       compression)
         self.cinfo = calling_format.CallingInfo()
         self.worker = gs_worker
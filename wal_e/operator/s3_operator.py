@@ -8,8 +8,9 @@ class S3Backup(Backup):
 
     """
 
-    def __init__(self, layout, creds, gpg_key_id):
-        super(S3Backup, self).__init__(layout, creds, gpg_key_id)
+    def __init__(self, layout, creds, gpg_key_id, compression=None):
+        super(S3Backup, self).__init__(layout, creds, gpg_key_id,
+                                       compression)
         self.cinfo = calling_format.CallingInfo()
         from wal_e.worker.s3 import s3_worker
         self.worker = s3_worker
@@ -0,0 +1,324 @@
+"""
+Reading files for base backups without flushing the page cache.
+
+A base backup reads the whole cluster directory once.  Read through
+the page cache like anything else, it evicts the database's working
+set in favor of data that will not be read again.  BackupReader reads
+a file sequentially, a window of WINDOW bytes at a time:
+
+* the kernel is told the file is read sequentially, and to read the
+  next window ahead while the current one is being read;
+
+* once a window has been read, the pages of it that were not cached
+  before are dropped from the page cache.  Pages that were cached
+  already, as part of the database's working set, are left alone.
+
+With direct_io, files are instead opened with O_DIRECT, bypassing
+the page cache altogether, and read into page-aligned buffers.  File
+systems that do not support O_DIRECT are read as above.
+
+Otherwise, files can also be spliced into pipes (see zero_copy),
+which keeps to the same windows.
+
+Python 2 has no os.posix_fadvise, so it and mincore, which tells
+which pages are cached, are called from libc through ctypes.  Where
+they are unavailable, files are simply read.
+
+"""
+import ctypes
+import ctypes.util
+import errno
+import io
+import mmap
+import os
+import sys
+import threading
+
+from wal_e import log_help
+from wal_e import zero_copy
+
+logger = log_help.WalELogger(__name__)
+
+PAGE_SIZE = mmap.PAGESIZE
+
+# The number of bytes read ahead, and dropped from the page cache, at
+# a time.
+WINDOW = 8 * 1024 * 1024
+
+# The size of the aligned buffers O_DIRECT reads go to.
+DIRECT_BUFFER_SIZE = 1024 * 1024
+
+# Linux's values of these constants.
+_POSIX_FADV_SEQUENTIAL = 2
+_POSIX_FADV_WILLNEED = 3
+_POSIX_FADV_DONTNEED = 4
+_PROT_READ = 1
+_MAP_SHARED = 1
+
+
+def _load_libc():
+    if not sys.platform.startswith('linux'):
+        return None
+
+    try:
+        libc = ctypes.CDLL(ctypes.util.find_library('c'), use_errno=True)
+        fadvise = getattr(libc, 'posix_fadvise64', None) or libc.posix_fadvise
+        mmap_ = getattr(libc, 'mmap64', None) or libc.mmap
+        mincore = libc.mincore
+        munmap = libc.munmap
+        read = libc.read
+    except (OSError, AttributeError):
+        return None
+
+    fadvise.argtypes = [ctypes.c_int, ctypes.c_int64, ctypes.c_int64,
+                        ctypes.c_int]
+    fadvise.restype = ctypes.c_int
+    mmap_.argtypes = [ctypes.c_void_p, ctypes.c_size_t, ctypes.c_int,
+                      ctypes.c_int, ctypes.c_int, ctypes.c_int64]
+    mmap_.restype = ctypes.c_void_p
+    mincore.argtypes = [ctypes.c_void_p, ctypes.c_size_t,
+                        ctypes.POINTER(ctypes.c_ubyte)]
+    mincore.restype = ctypes.c_int
+    munmap.argtypes = [ctypes.c_void_p, ctypes.c_size_t]
+    munmap.restype = ctypes.c_int
+    read.argtypes = [ctypes.c_int, ctypes.c_void_p, ctypes.c_size_t]
+    read.restype = ctypes.c_ssize_t
+
+    return dict(fadvise=fadvise, mmap=mmap_, mincore=mincore,
+                munmap=munmap, read=read)
+
+
+_libc = _load_libc()
+
+_MAP_FAILED = ctypes.c_void_p(-1).value
+
+
+class ReadStats(object):
+    """Counts bytes read and pages dropped by BackupReaders"""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.bytes_read = 0
+        self.pages_dropped = 0
+
+    def add(self, bytes_read=0, pages_dropped=0):
+        with self._lock:
+            self.bytes_read += bytes_read
+            self.pages_dropped += pages_dropped
+
+
+STATS = ReadStats()
+
+
+def _advise(fd, offset, length, advice):
+    if _libc is not None:
+        # Advice is only advice: errors are ignored.
+        _libc['fadvise'](fd, offset, length, advice)
+
+
+def _resident(fd, offset, length):
+    """Tell which pages of a range of a file are in the page cache
+
+    Returns a list of booleans, or None if that cannot be told.
+    """
+    if _libc is None or length == 0:
+        return None
+
+    addr = _libc['mmap'](None, length, _PROT_READ, _MAP_SHARED, fd, offset)
+    if addr is None or addr == _MAP_FAILED:
+        return None
+
+    try:
+        n_pages = (length + PAGE_SIZE - 1) // PAGE_SIZE
+        vec = (ctypes.c_ubyte * n_pages)()
+        if _libc['mincore'](addr, length, vec) != 0:
+            return None
+        return [bool(v & 1) for v in vec]
+    finally:
+        _libc['munmap'](addr, length)
+
+
+class _Window(object):
+    __slots__ = ('start', 'end', 'resident')
+
+    def __init__(self, start, end, resident):
+        self.start = start
+        self.end = end
+        self.resident = resident
+
+
+class BackupReader(object):
+    """Reads a file once, sequentially, sparing the page cache"""
+
+    def __init__(self, path, direct_io=False):
+        self._fd = None
+        self._direct_buffer = None
+
+        if direct_io and _libc is not None and hasattr(os, 'O_DIRECT'):
+            try:
+                self._fd = os.open(path, os.O_RDONLY | os.O_DIRECT)
+            except EnvironmentError, e:
+                if e.errno != errno.EINVAL:
+                    raise
+
+                logger.debug(
+                    msg='reading without O_DIRECT',
+                    detail=('The file system of {0} does not support it.'
+                            .format(path)))
+            else:
+                # Anonymous mappings are page-aligned.
+                self._direct_buffer = mmap.mmap(-1, DIRECT_BUFFER_SIZE)
+                self._direct_address = ctypes.addressof(
+                    ctypes.c_char.from_buffer(self._direct_buffer))
+
+        self._raw = None
+        if self._fd is None:
+            self._fd = os.open(path, os.O_RDONLY)
+            _advise(self._fd, 0, 0, _POSIX_FADV_SEQUENTIAL)
+
+            # For readinto.
+            self._raw = io.FileIO(self._fd, 'r', closefd=False)
+
+        # Read ahead and drop pages up to the end of the file as it
+        # was when opened, rounded up to a whole page.
+        size = os.fstat(self._fd).st_size
+        self._end = size + -size % PAGE_SIZE
+
+        self._pos = 0
+        self._pending = ''
+        self._windows = []
+
+    def _start_window(self, start):
+        # Small files, most of them, are read in a small window.
+        end = min(start + WINDOW, self._end)
+        resident = _resident(self._fd, start, end - start)
+        _advise(self._fd, start, end - start, _POSIX_FADV_WILLNEED)
+        self._windows.append(_Window(start, end, resident))
+
+    def _advance(self):
+        """Keep the window being read, and the next one, read ahead
+
+        Returns the number of bytes to read before advancing again.
+        """
+        while self._windows and self._windows[0].end <= self._pos:
+            self._drop(self._windows.pop(0), self._pos)
+
+        if not self._windows and self._pos < self._end:
+            self._start_window(self._pos - self._pos % PAGE_SIZE)
+        if len(self._windows) == 1 and self._windows[0].end < self._end:
+            self._start_window(self._windows[0].end)
+
+        if self._windows:
+            return self._windows[0].end - self._pos
+        else:
+            # The file grew since it was opened.
+            return WINDOW
+
+    def _drop(self, window, upto):
+        """Drop the pages of a window read up to upto not cached before"""
+        if window.resident is None:
+            return
+
+        n_pages = max(0, (min(window.end, upto, self._end) - window.start)
+                      // PAGE_SIZE)
+        dropped = 0
+        run_start = None
+        for i in xrange(n_pages + 1):
+            if i < n_pages and not window.resident[i]:
+                dropped += 1
+                if run_start is None:
+                    run_start = i
+            elif run_start is not None:
+                _advise(self._fd, window.start + run_start * PAGE_SIZE,
+                        (i - run_start) * PAGE_SIZE, _POSIX_FADV_DONTNEED)
+                run_start = None
+
+        STATS.add(pages_dropped=dropped)
+
+    def _read_direct(self, size):
+        if not self._pending:
+            got = _libc['read'](self._fd, self._direct_address,
+                                DIRECT_BUFFER_SIZE)
+            if got < 0:
+                e = ctypes.get_errno()
+                raise OSError(e, os.strerror(e))
+            self._pending = self._direct_buffer[:got]
+
+        data, self._pending = self._pending[:size], self._pending[size:]
+        return data
+
+    def read(self, size):
+        chunks = []
+        remaining = size
+
+        while remaining > 0:
+            if self._direct_buffer is not None:
+                data = self._read_direct(remaining)
+            else:
+                data = os.read(self._fd, min(remaining, self._advance()))
+
+            if not data:
+                break
+
+            chunks.append(data)
+            remaining -= len(data)
+            self._pos += len(data)
+
+        STATS.add(bytes_read=size - remaining)
+        return ''.join(chunks)
+
+    def readinto(self, b):
+        """Read into a writable buffer, as file objects do"""
+        if self._raw is None:
+            data = self.read(len(b))
+            b[:len(data)] = data
+            return len(data)
+
+        view = memoryview(b)
+        total = 0
+        while total < len(view):
+            n = self._raw.readinto(
+                view[total:total + min(len(view) - total, self._advance())])
+            if not n:
+                break
+
+            total += n
+            self._pos += n
+
+        STATS.add(bytes_read=total)
+        return total
+
+    def splice(self, fd, size):
+        """Move up to size bytes into the pipe fd, without copying them
+
+        Returns the number of bytes moved, 0 at the end of the file, or
+        None if the file can only be read.
+        """
+        if self._raw is None or not zero_copy.AVAILABLE:
+            return None
+
+        n = zero_copy.splice(self._fd, fd, min(size, self._advance()))
+        self._pos += n
+        STATS.add(bytes_read=n)
+        return n
+
+    def close(self):
+        if self._fd is None:
+            return
+
+        try:
+            # Drop the windows read ahead, whether read or not.
+            for window in self._windows:
+                self._drop(window, window.end)
+        finally:
+            os.close(self._fd)
+            self._fd = None
+            if self._direct_buffer is not None:
+                self._direct_buffer.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.close()
+        return False
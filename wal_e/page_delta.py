@@ -0,0 +1,233 @@
+"""
+Page-level deltas of PostgreSQL relation files.
+
+Every page of a relation file begins with the LSN of the last WAL
+record that modified it.  A page whose LSN precedes the start of a
+previous backup has not been modified since, and so that backup (or
+one it depends on) already holds it.
+
+A delta of a relation file is archived as a tar member of type
+DELTA_TYPE, whose contents are:
+
+* a header, holding a magic number, the size of the file and the LSN
+  the pages were compared against;
+
+* a bitmap with a bit set for every page included;
+
+* the included pages, in order.
+
+It is applied by truncating or extending the previous version of the
+file to the new size and then overwriting the included pages.  Pages
+beyond the end of the previous version of the file are thus always
+included, as are pages with no LSN at all, which might never have
+been WAL-logged.
+
+"""
+import re
+import struct
+
+from wal_e import file_io
+from wal_e.files import read_exactly
+
+# PostgreSQL's default block size.
+PAGE_SIZE = 8192
+
+# The default size of a WAL segment, needed to derive an LSN from a
+# segment name.
+WAL_SEGMENT_SIZE = 16 * 1024 * 1024
+
+# A tar member type not used by tar implementations.
+DELTA_TYPE = 'W'
+
+MAGIC = 'WALEPGD1'
+HEADER = struct.Struct('<8sQQ')
+
+# pd_lsn, as two native 32-bit integers.
+_PAGE_LSN = struct.Struct('=II')
+
+# Read this many pages at a time while scanning.
+_SCAN_PAGES = 128
+
+# Read this many changed pages at a time at most while writing a delta.
+_READ_PAGES = 128
+
+# Main fork segments of relations, i.e. excluding the free space map,
+# visibility map and init forks, as named in tar members.
+RELATION_REGEXP = (r'(?:^|/)(?:base/\d+|global|pg_tblspc/\d+/[^/]+/\d+)'
+                   r'/\d+(?:\.\d+)?$')
+
+# Applying long chains of deltas makes restores slow, so archive the
+# whole file again after this many.
+DELTA_CHAIN_MAX = 8
+
+# Archive the whole file instead of a delta when more than this
+# fraction of its pages changed.
+DELTA_MAX_FRACTION = 0.5
+
+
+def is_relation(name):
+    return re.search(RELATION_REGEXP, name) is not None
+
+
+def lsn_from_segment(segment_name, offset):
+    """Compute the LSN of an offset into a WAL segment
+
+    Both are as hexadecimal strings, as in the names of base backups.
+    """
+    log = int(segment_name[8:16], 16)
+    seg = int(segment_name[16:24], 16)
+    return (log << 32) | (seg * WAL_SEGMENT_SIZE + int(offset, 16))
+
+
+def _bitmap_size(n_pages):
+    return (n_pages + 7) // 8
+
+
+class PageScan(object):
+    """The pages of a relation file modified since a given LSN
+
+    Pages not entirely within the first base_size bytes, the size of
+    the previous version of the file, are always included.
+
+    Scanning reads the whole file, up to size bytes, so that a digest
+    of its contents can be computed along the way.  The file is kept
+    open, and the included pages are read from it again when the
+    delta is written out.
+    """
+
+    def __init__(self, path, size, base_size, start_lsn, digest):
+        self.size = size
+        self.start_lsn = start_lsn
+        self.base_pages = base_size // PAGE_SIZE
+        self.n_pages = (size + PAGE_SIZE - 1) // PAGE_SIZE
+        self.bitmap = bytearray(_bitmap_size(self.n_pages))
+        self.n_changed = 0
+
+        self.f = open(path, 'rb')
+        try:
+            self._scan(digest)
+        except:
+            self.f.close()
+            raise
+
+    def _scan(self, digest):
+        zero_page = '\0' * PAGE_SIZE
+        page_number = 0
+        remaining = self.size
+
+        while remaining > 0:
+            want = min(remaining, PAGE_SIZE * _SCAN_PAGES)
+            chunk = self.f.read(want)
+            if len(chunk) < want:
+                # The file shrank: pad it out with NULs, as TarWriter
+                # does, leaving the rest to WAL replay.
+                chunk += '\0' * (want - len(chunk))
+
+            digest.update(chunk)
+            remaining -= want
+
+            for offset in xrange(0, len(chunk), PAGE_SIZE):
+                page = chunk[offset:offset + PAGE_SIZE]
+                if len(page) < PAGE_SIZE:
+                    page += zero_page[len(page):]
+
+                xlogid, xrecoff = _PAGE_LSN.unpack_from(page)
+                lsn = (xlogid << 32) | xrecoff
+                if (lsn == 0 or lsn >= self.start_lsn
+                        or page_number >= self.base_pages):
+                    self.bitmap[page_number // 8] |= 1 << (page_number % 8)
+                    self.n_changed += 1
+
+                page_number += 1
+
+        assert page_number == self.n_pages
+
+    def worthwhile(self):
+        return self.n_changed <= self.n_pages * DELTA_MAX_FRACTION
+
+    @property
+    def delta_size(self):
+        return (HEADER.size + len(self.bitmap) +
+                self.n_changed * PAGE_SIZE)
+
+    def changed_pages(self):
+        for page_number in xrange(self.n_pages):
+            if self.bitmap[page_number // 8] & (1 << (page_number % 8)):
+                yield page_number
+
+    def changed_runs(self):
+        """Generate (first page, count) of runs of changed pages
+
+        Runs are of _READ_PAGES pages at most.
+        """
+        first = count = None
+        for page_number in self.changed_pages():
+            if count is not None and (page_number == first + count and
+                                      count < _READ_PAGES):
+                count += 1
+                continue
+
+            if count is not None:
+                yield first, count
+            first, count = page_number, 1
+
+        if count is not None:
+            yield first, count
+
+    def _read_pages(self, first, count):
+        self.f.seek(first * PAGE_SIZE)
+        pages = self.f.read(count * PAGE_SIZE)
+        return pages + '\0' * (count * PAGE_SIZE - len(pages))
+
+    def chunks(self):
+        """Generate the contents of the delta
+
+        The changed pages are read on the file I/O pool, a run of them
+        at a time.
+        """
+        yield HEADER.pack(MAGIC, self.size, self.start_lsn)
+        yield str(self.bitmap)
+
+        for first, count in self.changed_runs():
+            yield file_io.run(self._read_pages, first, count)
+
+    def close(self):
+        self.f.close()
+
+
+class DeltaReader(object):
+    """File-like object to read a delta, as tarfile.addfile does"""
+
+    def __init__(self, page_scan):
+        self._chunks = page_scan.chunks()
+        self._buf = ''
+
+    def read(self, size):
+        while len(self._buf) < size:
+            try:
+                self._buf += self._chunks.next()
+            except StopIteration:
+                break
+
+        ret, self._buf = self._buf[:size], self._buf[size:]
+        return ret
+
+
+def apply_delta(fp, target_path):
+    """Apply a delta read from fp to the file at target_path"""
+    magic, size, start_lsn = HEADER.unpack(
+        read_exactly(fp, HEADER.size, 'page delta'))
+    if magic != MAGIC:
+        raise IOError('bad page delta magic number {0!r}'.format(magic))
+
+    n_pages = (size + PAGE_SIZE - 1) // PAGE_SIZE
+    bitmap = bytearray(read_exactly(fp, _bitmap_size(n_pages), 'page delta'))
+
+    with open(target_path, 'r+b') as target:
+        target.truncate(size)
+
+        for page_number in xrange(n_pages):
+            if bitmap[page_number // 8] & (1 << (page_number % 8)):
+                page = read_exactly(fp, PAGE_SIZE, 'page delta')
+                target.seek(page_number * PAGE_SIZE)
+                target.write(page[:size - page_number * PAGE_SIZE])
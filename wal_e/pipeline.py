@@ -1,6 +1,15 @@
 """Primitives to manage and construct pipelines for
 compression/encryption.
 """
+import Queue
+import collections
+import fcntl
+import multiprocessing
+import os
+import sys
+import threading
+
+import gevent.threadpool
 
 from gevent import sleep
 from wal_e import pipebuf
@@ -13,31 +22,57 @@ GPG_BIN = 'gpg'
 LZOP_BIN = 'lzop'
 CAT_BIN = 'cat'
 
+# The size of reads and writes by in-process filters.
+COPY_SIZE = 1024 * 1024
+
+# In-process compression filters cut their input into frames of this
+# size, each compressed independently.
+FRAME_SIZE = 4 * 1024 * 1024
+
 
 def get_upload_pipeline(in_fd, out_fd, rate_limit=None,
-                        gpg_key=None, lzop=True):
+                        gpg_key=None, lzop=True, compression=None,
+                        checksums=None):
     """ Create a UNIX pipeline to process a file for uploading.
-        (Compress, and optionally encrypt) """
+        (Compress, and optionally encrypt)
+
+        compression is a compression.Compression, lzop by default.
+        If a checksum.Checksums is passed, the output of the pipeline,
+        and its input if the Checksums asks for it, are digested
+        along the way. """
     commands = []
     if rate_limit is not None:
         commands.append(PipeViewerRateLimitFilter(rate_limit))
+    if checksums is not None and checksums.raw_digests:
+        commands.append(DigestFilter(checksums.raw_digests))
     if lzop:
-        commands.append(LZOCompressionFilter())
+        if compression is None:
+            commands.append(LZOCompressionFilter())
+        else:
+            commands.append(compression.compression_filter())
 
     if gpg_key is not None:
         commands.append(GPGEncryptionFilter(gpg_key))
+    if checksums is not None:
+        commands.append(DigestFilter(checksums.compressed_digests))
 
     return Pipeline(commands, in_fd, out_fd)
 
 
-def get_download_pipeline(in_fd, out_fd, gpg=False, lzop=True):
+def get_download_pipeline(in_fd, out_fd, gpg=False, lzop=True, codec=None):
     """ Create a pipeline to process a file after downloading.
-        (Optionally decrypt, then decompress) """
+        (Optionally decrypt, then decompress)
+
+        codec is the compression.Codec the file was compressed with,
+        lzop by default. """
     commands = []
     if gpg:
         commands.append(GPGDecryptionFilter())
     if lzop:
-        commands.append(LZODecompressionFilter())
+        if codec is None:
+            commands.append(LZODecompressionFilter())
+        else:
+            commands.append(codec.decompression_filter())
     return Pipeline(commands, in_fd, out_fd)
 
 
@@ -225,9 +260,12 @@ class CatFilter(PipelineCommand):
 
 class LZOCompressionFilter(PipelineCommand):
     """ Compress using LZO. """
-    def __init__(self, stdin=PIPE, stdout=PIPE):
-        PipelineCommand.__init__(
-            self, [LZOP_BIN, '-c'], stdin, stdout)
+    def __init__(self, level=None, stdin=PIPE, stdout=PIPE):
+        command = [LZOP_BIN, '-c']
+        if level is not None:
+            command.append('-{0}'.format(level))
+
+        PipelineCommand.__init__(self, command, stdin, stdout)
 
 
 class LZODecompressionFilter(PipelineCommand):
@@ -237,6 +275,331 @@ class LZODecompressionFilter(PipelineCommand):
                 self, [LZOP_BIN, '-d', '-c', '-'], stdin, stdout)
 
 
+def _set_cloexec(fd):
+    flags = fcntl.fcntl(fd, fcntl.F_GETFD)
+    fcntl.fcntl(fd, fcntl.F_SETFD, flags | fcntl.FD_CLOEXEC)
+
+
+def _thread_file(value, reading):
+    """Open a file for a ThreadedFilter's thread to read or write
+
+    Returns it along with the other end of the pipe, should value be
+    PIPE, or None otherwise.
+    """
+    if value == PIPE:
+        r, w = os.pipe()
+
+        # Subprocesses must not hold on to either end, lest the pipe
+        # never reach its end.
+        _set_cloexec(r)
+        _set_cloexec(w)
+
+        if reading:
+            return os.fdopen(r, 'rb', 0), os.fdopen(w, 'wb', 0)
+        else:
+            return os.fdopen(w, 'wb', 0), os.fdopen(r, 'rb', 0)
+
+    # As with a subprocess, the thread gets its own copy of the file
+    # descriptor.
+    fd = value if isinstance(value, int) else value.fileno()
+    return os.fdopen(os.dup(fd), 'rb' if reading else 'wb', 0), None
+
+
+class ThreadedFilter(object):
+    """A pipeline command run in-process, on a thread of its own
+
+    It stands in for a PipelineCommand.  Subclasses implement
+    transform, which reads from one file and writes to another with
+    blocking calls.  As these, and typically the compression libraries
+    called along the way, release the GIL, the work proceeds in
+    parallel to the rest of the process.
+    """
+    def __init__(self, stdin=PIPE, stdout=PIPE):
+        self._stdin = stdin
+        self._stdout = stdout
+
+        self._pool = None
+        self._result = None
+        self._process_stdin = None
+        self._process_stdout = None
+
+    def transform(self, infile, outfile):
+        raise NotImplementedError()
+
+    def start(self):
+        if self._pool is not None:
+            raise UserCritical(
+                'BUG: Tried to .start on a ThreadedFilter twice')
+
+        infile, self._process_stdin = _thread_file(self._stdin, True)
+        outfile, self._process_stdout = _thread_file(self._stdout, False)
+
+        self._pool = gevent.threadpool.ThreadPool(1)
+        self._result = self._pool.spawn(self._run, infile, outfile)
+
+    def _run(self, infile, outfile):
+        try:
+            self.transform(infile, outfile)
+        finally:
+            infile.close()
+            outfile.close()
+
+    @property
+    def stdin(self):
+        return self._process_stdin
+
+    @stdin.setter
+    def stdinSet(self, value):
+        if self._pool is not None:
+            raise UserCritical(
+                'BUG: Trying to set stdin on ThreadedFilter '
+                'after it has already been .start-ed')
+
+        self._stdin = value
+
+    @property
+    def stdout(self):
+        return self._process_stdout
+
+    @stdout.setter
+    def stdoutSet(self, value):
+        if self._pool is not None:
+            raise UserCritical(
+                'BUG: Trying to set stdout on ThreadedFilter '
+                'after it has already been .start-ed')
+
+        self._stdout = value
+
+    @property
+    def returncode(self):
+        if self._result is None or not self._result.ready():
+            return None
+        else:
+            return 0 if self._result.successful() else 1
+
+    def wait(self):
+        self._result.wait()
+        self._pool.kill()
+        return self.returncode
+
+    def finish(self):
+        retcode = self.wait()
+
+        if self.stdout is not None:
+            self.stdout.close()
+
+        if retcode != 0:
+            raise UserCritical(
+                msg='pipeline thread did not exit gracefully',
+                detail='{0} failed: {1!r}.'
+                .format(type(self).__name__, self._result.exception))
+
+
+class DigestFilter(ThreadedFilter):
+    """ Pass data through unchanged, updating hash objects with it.
+
+        hashlib lets go of the GIL while digesting, so this proceeds in
+        parallel to the rest of the process. """
+    def __init__(self, digests, stdin=PIPE, stdout=PIPE):
+        ThreadedFilter.__init__(self, stdin, stdout)
+        self.digests = digests
+
+    def transform(self, infile, outfile):
+        while True:
+            data = infile.read(COPY_SIZE)
+            if not data:
+                break
+
+            for digest in self.digests:
+                digest.update(data)
+            outfile.write(data)
+
+
+class _Frame(object):
+    """A frame being compressed by the FramePool"""
+    __slots__ = ('done', 'result', 'exc_info')
+
+    def __init__(self):
+        self.done = threading.Event()
+        self.result = None
+        self.exc_info = None
+
+    def get(self):
+        self.done.wait()
+        if self.exc_info is not None:
+            raise self.exc_info[0], self.exc_info[1], self.exc_info[2]
+
+        return self.result
+
+
+class FramePool(object):
+    """Threads compressing frames on behalf of compression filters
+
+    These are plain threads, not gevent's, as they are only ever
+    waited upon by the threads of ThreadedFilters.
+    """
+    def __init__(self, size):
+        self.size = size
+        self._work = Queue.Queue()
+
+        for i in xrange(size):
+            t = threading.Thread(target=self._compress_frames,
+                                 name='wal-e-frame-{0}'.format(i))
+            t.daemon = True
+            t.start()
+
+    def _compress_frames(self):
+        while True:
+            frame, compress, data = self._work.get()
+            try:
+                frame.result = compress(data)
+            except:
+                frame.exc_info = sys.exc_info()
+            finally:
+                del data
+                frame.done.set()
+
+    def submit(self, compress, data):
+        frame = _Frame()
+        self._work.put((frame, compress, data))
+        return frame
+
+
+_frame_pools = {}
+_frame_pools_lock = threading.Lock()
+
+
+def get_frame_pool(threads=None):
+    """Get the process-wide FramePool of a size, starting it if need be
+
+    None means one thread per CPU.
+    """
+    size = threads or multiprocessing.cpu_count()
+
+    with _frame_pools_lock:
+        pool = _frame_pools.get(size)
+        if pool is None:
+            pool = _frame_pools[size] = FramePool(size)
+
+        return pool
+
+
+def _read_frame(infile):
+    """Read FRAME_SIZE bytes, or as many as remain"""
+    chunks = []
+    remaining = FRAME_SIZE
+    while remaining > 0:
+        chunk = infile.read(min(remaining, COPY_SIZE))
+        if not chunk:
+            break
+
+        chunks.append(chunk)
+        remaining -= len(chunk)
+
+    return ''.join(chunks)
+
+
+class FrameCompressionFilter(ThreadedFilter):
+    """Compress a stream as a series of independent frames
+
+    Frames are compressed by the threads of the process-wide
+    FramePool, so compressing a single stream can occupy every core,
+    and written out in order.  A few more frames than there are
+    threads are held in memory at a time.  Decompressors read the
+    concatenated frames as a single stream.
+    """
+    def __init__(self, threads=None, stdin=PIPE, stdout=PIPE):
+        ThreadedFilter.__init__(self, stdin, stdout)
+        self.threads = threads
+
+    def compress_frame(self, data):
+        raise NotImplementedError()
+
+    def transform(self, infile, outfile):
+        pool = get_frame_pool(self.threads)
+        pending = collections.deque()
+
+        while True:
+            data = _read_frame(infile)
+            if not data:
+                break
+
+            pending.append(pool.submit(self.compress_frame, data))
+            del data
+
+            if len(pending) > pool.size:
+                outfile.write(pending.popleft().get())
+
+        while pending:
+            outfile.write(pending.popleft().get())
+
+
+class ZstdCompressionFilter(FrameCompressionFilter):
+    """ Compress using zstd, in-process. """
+    def __init__(self, level, threads=None, stdin=PIPE, stdout=PIPE):
+        FrameCompressionFilter.__init__(self, threads, stdin, stdout)
+        self.level = level
+
+        # Compression contexts may not be shared between threads, but
+        # are worth reusing.
+        self._local = threading.local()
+
+    def compress_frame(self, data):
+        cctx = getattr(self._local, 'cctx', None)
+        if cctx is None:
+            import zstandard
+
+            cctx = zstandard.ZstdCompressor(level=self.level)
+            self._local.cctx = cctx
+
+        return cctx.compress(data)
+
+
+class ZstdDecompressionFilter(ThreadedFilter):
+    """ Decompress using zstd, in-process. """
+    def transform(self, infile, outfile):
+        import zstandard
+
+        dctx = zstandard.ZstdDecompressor()
+        dctx.copy_stream(infile, outfile, read_size=COPY_SIZE,
+                         write_size=COPY_SIZE)
+
+
+class LZ4CompressionFilter(FrameCompressionFilter):
+    """ Compress using the lz4 frame format, in-process. """
+    def __init__(self, level, threads=None, stdin=PIPE, stdout=PIPE):
+        FrameCompressionFilter.__init__(self, threads, stdin, stdout)
+        self.level = level
+
+    def compress_frame(self, data):
+        import lz4.frame
+
+        return lz4.frame.compress(data, compression_level=self.level)
+
+
+class LZ4DecompressionFilter(ThreadedFilter):
+    """ Decompress using the lz4 frame format, in-process. """
+    def transform(self, infile, outfile):
+        import lz4.frame
+
+        decompressor = lz4.frame.LZ4FrameDecompressor()
+
+        while True:
+            data = infile.read(COPY_SIZE)
+            if not data:
+                break
+
+            # Continue with another decompressor should there be
+            # more than one frame.
+            while data:
+                outfile.write(decompressor.decompress(data))
+                if not decompressor.eof:
+                    break
+
+                data = decompressor.unused_data
+                decompressor = lz4.frame.LZ4FrameDecompressor()
+
+
 class GPGEncryptionFilter(PipelineCommand):
     """ Encrypt using GPG, using the provided public key ID. """
     def __init__(self, key, stdin=PIPE, stdout=PIPE):
@@ -5,7 +5,10 @@ from wal_e.storage.base import SEGMENT_REGEXP
 from wal_e.storage.base import SEGMENT_READY_REGEXP
 from wal_e.storage.base import BASE_BACKUP_REGEXP
 from wal_e.storage.base import COMPLETE_BASE_BACKUP_REGEXP
+from wal_e.storage.base import COMPRESSION_SUFFIXES
+from wal_e.storage.base import COMPRESSION_SUFFIX_REGEXP
 from wal_e.storage.base import VOLUME_REGEXP
+from wal_e.storage.base import CHUNK_REGEXP
 from wal_e.storage.base import StorageLayout
 from wal_e.storage.base import get_backup_info
 from wal_e.storage.base import SegmentNumber
@@ -20,7 +23,10 @@ __all__ = [
     'SEGMENT_READY_REGEXP',
     'BASE_BACKUP_REGEXP',
     'COMPLETE_BASE_BACKUP_REGEXP',
+    'COMPRESSION_SUFFIXES',
+    'COMPRESSION_SUFFIX_REGEXP',
     'VOLUME_REGEXP',
+    'CHUNK_REGEXP',
     'get_backup_info',
     'SegmentNumber',
 ]
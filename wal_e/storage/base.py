@@ -8,6 +8,7 @@ backed WAL-E prefix.
 
 """
 import collections
+import re
 
 import wal_e.exception
 
@@ -27,7 +28,19 @@ COMPLETE_BASE_BACKUP_REGEXP = (
     r'base_' + SEGMENT_REGEXP +
     r'_(?P<offset>[0-9A-F]{8})_backup_stop_sentinel\.json')
 
-VOLUME_REGEXP = (r'part_(\d+)\.tar\.lzo')
+# The suffixes of objects compressed with each supported codec (see
+# wal_e.compression).
+COMPRESSION_SUFFIXES = ('.lzo', '.zst', '.lz4')
+
+COMPRESSION_SUFFIX_REGEXP = (
+    r'(?:' + '|'.join(re.escape(suffix) for suffix in COMPRESSION_SUFFIXES) +
+    r')')
+
+VOLUME_REGEXP = (r'part_(\d+)\.tar' + COMPRESSION_SUFFIX_REGEXP)
+
+# Chunks of chunked backups are named by the SHA-256 digest of their
+# contents (see wal_e.chunk_store).
+CHUNK_REGEXP = (r'(?P<digest>[0-9a-f]{64})' + COMPRESSION_SUFFIX_REGEXP)
 
 
 # A representation of a log number and segment, naive of timeline.
@@ -293,9 +306,16 @@ class StorageLayout(object):
     def wal_directory(self):
         return self._api_path_prefix + 'wal_' + self.VERSION + '/'
 
-    def wal_path(self, wal_file_name):
+    def wal_path(self, wal_file_name, suffix='.lzo'):
+        self._error_on_unexpected_version()
+        return self.wal_directory() + wal_file_name + suffix
+
+    def chunk_directory(self):
+        return self._api_path_prefix + 'chunks_' + self.VERSION + '/'
+
+    def chunk_path(self, chunk_name):
         self._error_on_unexpected_version()
-        return self.wal_directory() + wal_file_name + '.lzo'
+        return self.chunk_directory() + chunk_name
 
     def store_name(self):
         """Return either the bucket name (S3) or the account name (Azure).
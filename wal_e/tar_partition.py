@@ -40,18 +40,43 @@ extraction.  This coupling between tarfiles makes the extraction
 process considerably more complicated.
 
 """
+import array
 import collections
+import contextlib
+import copy
 import errno
+import functools
+import hashlib
+import gevent
+import gevent.threadpool
+import heapq
+import itertools
+import math
 import os
 import tarfile
 
+from cStringIO import StringIO
+from wal_e import chunk_store
 from wal_e import files
 from wal_e import log_help
-from wal_e import copyfileobj
+from wal_e import file_io
+from wal_e import page_cache
+from wal_e import page_delta
 from wal_e import pipebuf
-from wal_e import pipeline
+from wal_e import tar_writer
+from wal_e.durability import Durability, fsync_files
 from wal_e.exception import UserException
 
+try:
+    from os import scandir
+except ImportError:
+    try:
+        from scandir import scandir
+    except ImportError:
+        # Fall back to os.listdir, which needs another system call to
+        # tell directories apart.
+        scandir = None
+
 logger = log_help.WalELogger(__name__)
 
 PG_CONF = ('postgresql.conf',
@@ -61,46 +86,6 @@ PG_CONF = ('postgresql.conf',
            'promote')
 
 
-class StreamPadFileObj(object):
-    """
-    Layer on a file to provide a precise stream byte length
-
-    This file-like-object accepts an underlying file-like-object and a
-    target size.  Once the target size is reached, no more bytes will
-    be returned.  Furthermore, if the underlying stream runs out of
-    bytes, '\0' will be returned until the target size is reached.
-
-    """
-
-    # Try to save space via __slots__ optimization: many of these can
-    # be created on systems with many small files that are packed into
-    # a tar partition, and memory blows up when instantiating the
-    # tarfile instance full of these.
-    __slots__ = ('underlying_fp', 'target_size', 'pos')
-
-    def __init__(self, underlying_fp, target_size):
-        self.underlying_fp = underlying_fp
-        self.target_size = target_size
-        self.pos = 0
-
-    def read(self, size):
-        max_readable = min(self.target_size - self.pos, size)
-        ret = self.underlying_fp.read(max_readable)
-        lenret = len(ret)
-        self.pos += lenret
-        return ret + '\0' * (max_readable - lenret)
-
-    def close(self):
-        return self.underlying_fp.close()
-
-    def __enter__(self):
-        return self
-
-    def __exit__(self, exc_type, exc_val, exc_tb):
-        self.close()
-        return False
-
-
 class TarMemberTooBigError(UserException):
     def __init__(self, member_name, limited_to, requested, *args, **kwargs):
         self.member_name = member_name
@@ -147,48 +132,129 @@ PARTITION_MAX_SZ = 1610612736
 # important to try to choose some happy medium between avoiding
 # excessive bloat in the number of partitions and making the wal-e
 # process effectively un-fork()-able for performing any useful work.
+# Members are held compactly in MemberTables, at well under a tenth
+# of the memory of TarInfo objects, so this can be generous.
 #
-# 262144 is 256 KiB.
-PARTITION_MAX_MEMBERS = int(PARTITION_MAX_SZ / 262144)
+# 65536 is 64 KiB, at which the cost of the members alone, per
+# PARTITION_MEMBER_COST, fills a partition.
+PARTITION_MAX_MEMBERS = int(PARTITION_MAX_SZ / 65536)
+
+# The cost of archiving a member, in addition to its size, when
+# balancing partitions: each needs to be opened and created, which
+# takes about as long as transferring this many bytes.
+PARTITION_MEMBER_COST = 65536
+
+# Partitions are planned as the cluster directory is walked, a window
+# of about this many partitions' worth of members at a time.
+PARTITION_PLAN_WINDOW = 8
+
+# The number of directories listed at once while walking the cluster
+# directory.
+WALK_CONCURRENCY = 8
+
+# Files smaller than this are read ahead while volumes are written, up
+# to PREFETCH_FILES or PREFETCH_BYTES of them at a time, on the file
+# I/O pool.
+PREFETCH_MAX_SIZE = 64 * 1024
+PREFETCH_FILES = 256
+PREFETCH_BYTES = 1024 * 1024
+
+# Large files are extracted a chunk of this size at a time, each
+# written on the file I/O pool while the next is read.
+EXTRACT_CHUNK_SIZE = 1024 * 1024
 
 
 def _fsync_files(filenames):
     """Call fsync() a list of file names
 
-    The filenames should be absolute paths already.
+    The filenames should be absolute paths already.  The directories
+    holding them are synced too (see durability.fsync_files).
 
     """
-    touched_directories = set()
+    fsync_files(filenames)
 
-    mode = os.O_RDONLY
 
-    # Windows
-    if hasattr(os, 'O_BINARY'):
-        mode |= os.O_BINARY
+def _read_files(files, direct_io=False):
+    """Read the given paths of files, up to the given sizes
 
-    for filename in filenames:
-        fd = os.open(filename, mode)
-        os.fsync(fd)
-        os.close(fd)
-        touched_directories.add(os.path.dirname(filename))
+    Run on the file I/O pool.  Returns the contents read, or the error
+    reading a file, should there be one, in place of its contents.
+    """
+    contents = []
+    for path, size in files:
+        try:
+            with page_cache.BackupReader(path, direct_io) as f:
+                contents.append(f.read(size))
+        except EnvironmentError, e:
+            contents.append(e)
+
+    return contents
 
-    # Some OSes also require us to fsync the directory where we've
-    # created files or subdirectories.
-    if hasattr(os, 'O_DIRECTORY'):
-        for dirname in touched_directories:
-            fd = os.open(dirname, os.O_RDONLY | os.O_DIRECTORY)
-            os.fsync(fd)
-            os.close(fd)
 
+def file_extract(tar, member, targetpath):
+    """Extract a regular file member, writing it on the file I/O pool
 
-def cat_extract(tar, member, targetpath):
-    """Extract a regular file member using cat for async-like I/O
+    Each chunk of EXTRACT_CHUNK_SIZE bytes read from the tar stream is
+    written on the pool while the next one is read, so that neither
+    the disk nor the download waits on the other.
 
     Mostly adapted from tarfile.py.
 
     """
     assert member.isreg()
 
+    targetpath = _make_upper_dirs(targetpath)
+
+    with files.DeleteOnError(targetpath) as dest:
+        fp = tar.extractfile(member)
+        writing = None
+        try:
+            while True:
+                chunk = fp.read(EXTRACT_CHUNK_SIZE)
+                if writing is not None:
+                    writing.get()
+
+                if not chunk:
+                    break
+
+                writing = file_io.spawn(dest.f.write, chunk)
+                del chunk
+        finally:
+            # The file is not to be closed while it is being written.
+            if writing is not None:
+                writing.wait()
+
+    tar.chown(member, targetpath)
+    tar.chmod(member, targetpath)
+    tar.utime(member, targetpath)
+
+
+def _write_member(tar, member, targetpath, data):
+    """Write a regular file member read as data, as tarfile would
+
+    Run on the file I/O pool.
+    """
+    targetpath = _make_upper_dirs(targetpath)
+
+    with files.DeleteOnError(targetpath) as dest:
+        dest.f.write(data)
+
+    try:
+        tar.chown(member, targetpath)
+        tar.chmod(member, targetpath)
+        tar.utime(member, targetpath)
+    except tarfile.ExtractError:
+        # As tar.extract does.
+        if tar.errorlevel > 1:
+            raise
+
+
+def _make_upper_dirs(targetpath):
+    """Create the directories a member is extracted into
+
+    Mostly adapted from tarfile.py.  Returns the path of the member
+    with platform specific separators.
+    """
     # Fetch the TarInfo object for the given name and build the
     # destination pathname, replacing forward slashes to platform
     # specific separators.
@@ -211,29 +277,162 @@ def cat_extract(tar, member, targetpath):
             else:
                 raise
 
-    with files.DeleteOnError(targetpath) as dest:
-        with pipeline.get_cat_pipeline(pipeline.PIPE, dest.f) as pl:
-            fp = tar.extractfile(member)
-            copyfileobj.copyfileobj(fp, pl.stdin)
+    return targetpath
 
-    tar.chown(member, targetpath)
-    tar.chmod(member, targetpath)
-    tar.utime(member, targetpath)
 
+class MemberTable(object):
+    """Holds the metadata of tar members compactly, in columns
 
-class TarPartition(list):
+    Clusters with many small files are partitioned into very many tar
+    members, and a TarInfo object for each takes a lot of memory.
+    Instead, their metadata is held in arrays, with their directories,
+    and the names of their owners, kept once in tables.  TarInfos are
+    only built again as members are written.
+    """
 
-    def __init__(self, name, *args, **kwargs):
+    def __init__(self):
+        # Directories, as pairs of the member name prefix and the
+        # prefix of the path read, and owner names.
+        self._dirs = []
+        self._dir_numbers = {}
+        self._owners = []
+        self._owner_numbers = {}
+
+        self.dir = array.array('I')
+        self.base = []
+        self.type = array.array('c')
+        self.mode = array.array('I')
+        self.uid = array.array('I')
+        self.gid = array.array('I')
+        self.uname = array.array('I')
+        self.gname = array.array('I')
+        self.size = array.array('L')
+        self.mtime = array.array('d')
+
+        # The few members with a link name, device numbers, or a path
+        # read not ending in their base name, by number.
+        self._linknames = {}
+        self._devices = {}
+        self._paths = {}
+
+    def __len__(self):
+        return len(self.base)
+
+    @staticmethod
+    def _intern(table, numbers, value):
+        number = numbers.get(value)
+        if number is None:
+            number = numbers[value] = len(table)
+            table.append(value)
+        return number
+
+    def add(self, et_info):
+        """Add an ExtendedTarInfo, returning its number"""
+        number = len(self.base)
+        tarinfo = et_info.tarinfo
+        path = et_info.submitted_path
+
+        arc_dir, sep, base = tarinfo.name.rpartition('/')
+        if path.endswith(base):
+            path_dir = path[:len(path) - len(base)]
+        else:
+            path_dir = None
+            self._paths[number] = path
+
+        self.dir.append(self._intern(self._dirs, self._dir_numbers,
+                                     (arc_dir + sep, path_dir)))
+        self.base.append(base)
+        self.type.append(tarinfo.type)
+        self.mode.append(tarinfo.mode)
+        self.uid.append(tarinfo.uid)
+        self.gid.append(tarinfo.gid)
+        self.uname.append(self._intern(self._owners, self._owner_numbers,
+                                       tarinfo.uname))
+        self.gname.append(self._intern(self._owners, self._owner_numbers,
+                                       tarinfo.gname))
+        self.size.append(tarinfo.size)
+        self.mtime.append(tarinfo.mtime)
+
+        if tarinfo.linkname:
+            self._linknames[number] = tarinfo.linkname
+        if tarinfo.ischr() or tarinfo.isblk():
+            self._devices[number] = (tarinfo.devmajor, tarinfo.devminor)
+
+        return number
+
+    def __getitem__(self, number):
+        """Build the ExtendedTarInfo of a member"""
+        arc_dir, path_dir = self._dirs[self.dir[number]]
+        base = self.base[number]
+
+        tarinfo = tarfile.TarInfo(arc_dir + base)
+        tarinfo.type = self.type[number]
+        tarinfo.mode = self.mode[number]
+        tarinfo.uid = self.uid[number]
+        tarinfo.gid = self.gid[number]
+        tarinfo.uname = self._owners[self.uname[number]]
+        tarinfo.gname = self._owners[self.gname[number]]
+        tarinfo.size = self.size[number]
+        tarinfo.mtime = self.mtime[number]
+        tarinfo.linkname = self._linknames.get(number, '')
+        if number in self._devices:
+            tarinfo.devmajor, tarinfo.devminor = self._devices[number]
+
+        if path_dir is None:
+            path = self._paths[number]
+        else:
+            path = path_dir + base
+
+        return ExtendedTarInfo(submitted_path=path, tarinfo=tarinfo)
+
+
+class TarPartition(object):
+    """Members of a MemberTable to archive together, as one volume
+
+    Iterating over a TarPartition generates the ExtendedTarInfos of
+    its members.  Those of partitions generated by partition are all
+    read from the one device, recorded as device (an st_dev).
+    """
+
+    def __init__(self, name, members=None, numbers=(), device=None):
         self.name = name
-        list.__init__(self, *args, **kwargs)
+        self.members = MemberTable() if members is None else members
+        self.numbers = array.array('I', numbers)
+        self.device = device
+
+    def __len__(self):
+        return len(self.numbers)
+
+    def __iter__(self):
+        for number in self.numbers:
+            yield self.members[number]
+
+    def append(self, et_info):
+        self.numbers.append(self.members.add(et_info))
 
     @staticmethod
-    def _padded_tar_add(tar, et_info):
+    def _padded_tar_add(tar, et_info, digest=None, contents=None,
+                        direct_io=False):
+        """Add a file, returning False if it was unlinked meanwhile
+
+        The file is padded with NULs, or cut short, to the size it
+        had when it was planned.  Its contents, if read ahead, are
+        passed as contents, or the error reading them was.
+        """
+        tarinfo = et_info.tarinfo
         try:
-            with open(et_info.submitted_path, 'rb') as raw_file:
-                with StreamPadFileObj(raw_file,
-                                      et_info.tarinfo.size) as f:
-                    tar.addfile(et_info.tarinfo, f)
+            if contents is None:
+                f = file_io.CooperativeReader.open(page_cache.BackupReader,
+                                                   et_info.submitted_path,
+                                                   direct_io)
+            elif isinstance(contents, EnvironmentError):
+                raise contents
+            else:
+                f = StringIO(contents)
+
+            with contextlib.closing(f):
+                tar.add(tar_writer.pack_header(tarinfo), f, tarinfo.size,
+                        digest)
 
         except EnvironmentError, e:
             if (e.errno == errno.ENOENT and
@@ -244,17 +443,91 @@ class TarPartition(list):
                 logger.debug(
                     msg='tar member additions skipping an unlinked file',
                     detail='Skipping {0}.'.format(et_info.submitted_path))
+                return False
             else:
                 raise
 
+        return True
+
+    def _delta_tar_add(self, tar, et_info, base_size, manifest):
+        """Add a page delta of a file, if worthwhile
+
+        Returns False if the whole file is to be added instead.
+        """
+        digest = hashlib.sha1()
+        try:
+            scan = file_io.run(page_delta.PageScan, et_info.submitted_path,
+                               et_info.tarinfo.size, base_size,
+                               manifest.delta_lsn, digest)
+        except EnvironmentError, e:
+            if (e.errno == errno.ENOENT and
+                e.filename == et_info.submitted_path):
+                logger.debug(
+                    msg='tar member additions skipping an unlinked file',
+                    detail='Skipping {0}.'.format(et_info.submitted_path))
+                return True
+            else:
+                raise
+
+        try:
+            if not scan.worthwhile():
+                return False
+
+            tarinfo = copy.copy(et_info.tarinfo)
+            tarinfo.type = page_delta.DELTA_TYPE
+            tarinfo.size = scan.delta_size
+            tar.add(tar_writer.pack_header(tarinfo),
+                    page_delta.DeltaReader(scan), tarinfo.size)
+        finally:
+            scan.close()
+
+        manifest.add_delta(et_info.tarinfo, self.name, digest.hexdigest())
+        return True
+
     @staticmethod
-    def tarfile_extract(fileobj, dest_path):
+    def _chunked_tar_add(tar, et_info, chunks, digest=None,
+                         direct_io=False):
+        """Add a file as its chunks, returning False if it was unlinked"""
+        try:
+            with file_io.CooperativeReader.open(
+                    page_cache.BackupReader,
+                    et_info.submitted_path, direct_io) as raw_file:
+                index = chunk_store.chunk_file(raw_file, et_info.tarinfo.size,
+                                               chunks, digest)
+        except EnvironmentError, e:
+            if (e.errno == errno.ENOENT and
+                e.filename == et_info.submitted_path):
+                logger.debug(
+                    msg='tar member additions skipping an unlinked file',
+                    detail='Skipping {0}.'.format(et_info.submitted_path))
+                return False
+            else:
+                raise
+
+        tarinfo = copy.copy(et_info.tarinfo)
+        tarinfo.type = chunk_store.CHUNK_TYPE
+        tarinfo.size = len(index)
+        tar.add(tar_writer.pack_header(tarinfo), StringIO(index), len(index))
+        return True
+
+    @staticmethod
+    def tarfile_extract(fileobj, dest_path, members=None, chunks=None,
+                        durability=None):
         """Extract a tarfile described by a file object to a specified path.
 
         Args:
             fileobj (file): File object wrapping the target tarfile.
             dest_path (str): Path to extract the contents of the tarfile to.
+            members (set): Names of the members to extract, or None to
+                extract all of them.
+            chunks (ChunkRestorer): Restores the files of chunked
+                backups, which completes only once it is joined.
+            durability (Durability): Syncs the files extracted, by
+                fsync of each volume's files if not passed.
         """
+        if durability is None:
+            durability = Durability()
+
         # Though this method doesn't fit cleanly into the TarPartition object,
         # tarballs are only ever extracted for partitions so the logic jives
         # for the most part.
@@ -272,10 +545,39 @@ class TarPartition(list):
         # getmembers() method will consume it before we extract any data.
         for member in tar:
             assert not member.name.startswith('/')
+            if members is not None and member.name not in members:
+                continue
+
             relpath = os.path.join(dest_path, member.name)
 
-            if member.isreg() and member.size >= pipebuf.PIPE_BUF_BYTES:
-                cat_extract(tar, member, relpath)
+            if member.type == page_delta.DELTA_TYPE:
+                # Patch the file as restored from an earlier backup.
+                page_delta.apply_delta(tar.extractfile(member), relpath)
+                tar.chown(member, relpath)
+                tar.chmod(member, relpath)
+                tar.utime(member, relpath)
+            elif member.type == chunk_store.CHUNK_TYPE:
+                if chunks is None:
+                    raise UserException(
+                        msg='cannot restore a chunked file',
+                        detail='The file {0} is chunked.'.format(member.name),
+                        hint='This should be reported as a bug.')
+
+                # The chunks are written, and the file synced, in the
+                # background.
+                chunks.restore(tar.extractfile(member), relpath, member)
+                tar.chown(member, relpath)
+                tar.chmod(member, relpath)
+                continue
+            elif member.isreg() and member.size >= pipebuf.PIPE_BUF_BYTES:
+                file_extract(tar, member, relpath)
+                durability.extracted(relpath)
+            elif member.isreg():
+                # Small files are read whole, and written on the file
+                # I/O pool.
+                file_io.run(_write_member, tar, member, relpath,
+                            tar.extractfile(member).read())
+                durability.extracted(relpath)
             else:
                 tar.extract(member, path=dest_path)
 
@@ -291,27 +593,127 @@ class TarPartition(list):
             # avoid accumulating an unbounded list of strings which
             # could be quite large for a large database
             if len(extracted_files) > 1000:
-                _fsync_files(extracted_files)
+                durability.sync(extracted_files, _fsync_files)
                 del extracted_files[:]
         tar.close()
-        _fsync_files(extracted_files)
+        durability.sync(extracted_files, _fsync_files)
+
+    def tarfile_write(self, fileobj, manifest=None, chunks=None,
+                      rate_limiter=None, digest=None, direct_io=False,
+                      zero_copy=False):
+        """Write the partition as a tarfile
+
+        Regular files written are recorded in manifest, if passed.
+        Where the manifest calls for it, a page delta is written
+        instead of the whole file.  If a ChunkUploader is passed as
+        chunks, large files are stored as chunks by it, and only
+        refer to them in the tarfile.
+
+        The tarfile is written by a TarWriter, as tarfile would, at
+        the rate rate_limiter allows, if passed, and digested into
+        digest, a hash object, if passed.  Returns whether all of the
+        tarfile was digested, which it is not if any was spliced.
+
+        Files are read with O_DIRECT if direct_io is set (see
+        page_cache).  With zero_copy, the contents of files archived
+        whole are spliced into fileobj without being digested (see
+        tar_writer): their manifest entries then record no digest,
+        and the tarfile goes undigested.
+        """
+        def wanted(et_info):
+            # Small files archived whole.
+            tarinfo = et_info.tarinfo
+            return (tarinfo.isfile() and tarinfo.size < PREFETCH_MAX_SIZE
+                    and (manifest is None or
+                         manifest.delta_base_size(tarinfo) is None))
+
+        tar = tar_writer.TarWriter(fileobj, rate_limiter, digest)
+        for et_info, contents in self._read_ahead(wanted, direct_io):
+            # Treat files specially because they may grow, shrink,
+            # or may be unlinked in the meanwhile.
+            if et_info.tarinfo.isfile():
+                chunked = chunks is not None and chunk_store.wants_chunking(
+                    et_info.tarinfo)
+                if chunked:
+                    add = functools.partial(self._chunked_tar_add,
+                                            chunks=chunks,
+                                            direct_io=direct_io)
+                else:
+                    add = functools.partial(self._padded_tar_add,
+                                            contents=contents,
+                                            direct_io=direct_io)
+
+                if manifest is None:
+                    add(tar, et_info)
+                    continue
+
+                base_size = manifest.delta_base_size(et_info.tarinfo)
+                if base_size is not None and self._delta_tar_add(
+                        tar, et_info, base_size, manifest):
+                    continue
+
+                if zero_copy and not chunked:
+                    if add(tar, et_info):
+                        manifest.add(et_info.tarinfo, self.name, None)
+                    continue
+
+                digest = hashlib.sha1()
+                if add(tar, et_info, digest=digest):
+                    manifest.add(et_info.tarinfo, self.name,
+                                 digest.hexdigest())
+            else:
+                tar.add(tar_writer.pack_header(et_info.tarinfo))
 
-    def tarfile_write(self, fileobj):
-        tar = None
-        try:
-            tar = tarfile.open(fileobj=fileobj, mode='w|',
-                               bufsize=pipebuf.PIPE_BUF_BYTES)
+        tar.close()
+        return tar.digest is not None
+
+    def _read_ahead(self, wanted, direct_io=False):
+        """Generate the members, with the contents of small files
 
+        The files of members for which wanted is true are read, as
+        batches of up to PREFETCH_FILES or PREFETCH_BYTES, on the file
+        I/O pool, the next batch while the members of the one before
+        are generated.  Members are generated with their contents, or
+        the error reading them, or with None if not read.
+        """
+        def batches():
+            members = []
+            batch = []
+            size = 0
             for et_info in self:
-                # Treat files specially because they may grow, shrink,
-                # or may be unlinked in the meanwhile.
-                if et_info.tarinfo.isfile():
-                    self._padded_tar_add(tar, et_info)
+                if wanted(et_info):
+                    members.append((et_info, len(batch)))
+                    batch.append((et_info.submitted_path,
+                                  et_info.tarinfo.size))
+                    size += et_info.tarinfo.size
                 else:
-                    tar.addfile(et_info.tarinfo)
-        finally:
-            if tar is not None:
-                tar.close()
+                    members.append((et_info, None))
+
+                if len(batch) >= PREFETCH_FILES or size >= PREFETCH_BYTES:
+                    yield members, batch
+                    members = []
+                    batch = []
+                    size = 0
+
+            if members:
+                yield members, batch
+
+        def generate(members, reading):
+            contents = reading.get()
+            for et_info, index in members:
+                yield et_info, None if index is None else contents[index]
+
+        previous = None
+        for members, batch in batches():
+            reading = file_io.spawn(_read_files, batch, direct_io)
+            if previous is not None:
+                for member in generate(*previous):
+                    yield member
+            previous = (members, reading)
+
+        if previous is not None:
+            for member in generate(*previous):
+                yield member
 
     @property
     def total_member_size(self):
@@ -321,7 +723,8 @@ class TarPartition(list):
         Expressed in bytes.
 
         """
-        return sum(et_info.tarinfo.size for et_info in self)
+        size = self.members.size
+        return sum(size[number] for number in self.numbers)
 
     def format_manifest(self):
         parts = []
@@ -333,11 +736,127 @@ class TarPartition(list):
         return '\n'.join(parts)
 
 
-def _segmentation_guts(root, file_paths, max_partition_size):
-    """Segment a series of file paths into TarPartition values
+def _archived_members(root, et_infos, max_partition_size, manifest=None,
+                      resumed=None):
+    """Filter ExtendedTarInfos down to those to archive
 
-    These TarPartitions are disjoint and roughly below the prescribed
-    size.
+    Files that the manifest can refer to a previous backup for are
+    left out, as are members that the BackupJournal of a resumed
+    backup has uploaded already.
+    """
+    for et_info in et_infos:
+
+        # Ensure tar members exist within a shared root before
+        # continuing.
+        if not et_info.submitted_path.startswith(root):
+            raise TarBadPathError(root=root,
+                                  offensive_path=et_info.submitted_path)
+
+        # Unchanged files are only referred to by the manifest.
+        if manifest is not None and manifest.inherit(et_info.tarinfo):
+            continue
+
+        if resumed is not None and resumed.uploaded(et_info.tarinfo,
+                                                    manifest):
+            continue
+
+        # Ensure tar members are within an expected size before
+        # continuing.
+        if et_info.tarinfo.size > max_partition_size:
+            raise TarMemberTooBigError(
+                et_info.tarinfo.name, max_partition_size,
+                et_info.tarinfo.size)
+
+        yield et_info
+
+
+def _member_cost(size):
+    return size + PARTITION_MEMBER_COST
+
+
+def _plan_partitions(sizes, max_partition_size, max_members):
+    """Pack members of the given sizes into balanced partitions
+
+    Uses the "longest processing time first" strategy: members are
+    taken in order of decreasing cost, each being added to the least
+    costly partition that can accept it.  The number of partitions is
+    the smallest that the size and member limits allow, with more
+    being added only should no partition be able to accept a member.
+
+    Returns lists of the indexes of the members of each partition, in
+    order of decreasing cost.  Within each, the members keep their
+    original order, so that directories precede their contents.
+    """
+    if not sizes:
+        return []
+
+    total_cost = sum(_member_cost(size) for size in sizes)
+    n_bins = max(int(math.ceil(total_cost / float(max_partition_size))),
+                 int(math.ceil(len(sizes) / float(max_members))))
+
+    # Each bin is [cost, bytes, [index, ...]].
+    bins = [[0, 0, []] for i in xrange(n_bins)]
+    heap = [(0, i) for i in xrange(n_bins)]
+
+    by_cost = sorted(xrange(len(sizes)), key=sizes.__getitem__,
+                     reverse=True)
+
+    for i in by_cost:
+        size = sizes[i]
+
+        # Find the least costly bin able to accept the member, setting
+        # aside those that cannot.
+        unfit = []
+        while heap:
+            cost, b = heapq.heappop(heap)
+            bin_bytes, bin_members = bins[b][1], len(bins[b][2])
+            if (bin_bytes + size < max_partition_size
+                    and bin_members < max_members):
+                break
+            unfit.append((cost, b))
+        else:
+            # Start another bin.  Being empty, it can accept any member
+            # that is not too big to be archived at all.
+            b = len(bins)
+            bins.append([0, 0, []])
+
+        chosen = bins[b]
+        chosen[0] += _member_cost(size)
+        chosen[1] += size
+        chosen[2].append(i)
+
+        heapq.heappush(heap, (chosen[0], b))
+        for entry in unfit:
+            heapq.heappush(heap, entry)
+
+    bins = [planned for planned in bins if planned[2]]
+    bins.sort(key=lambda planned: planned[0], reverse=True)
+
+    return [sorted(planned[2]) for planned in bins]
+
+
+def _segmentation_guts(root, et_infos, max_partition_size,
+                       manifest=None, resumed=None, device_of=None):
+    """Segment a series of ExtendedTarInfos into TarPartition values
+
+    These TarPartitions are disjoint, below the prescribed size, and
+    balanced in size and number of members.  Files that the manifest
+    can refer to a previous backup for are left out.
+
+    So that partitions can be uploaded while the series is still being
+    produced, it is planned in windows of about PARTITION_PLAN_WINDOW
+    partitions' worth of members at a time.  The TarPartitions of each
+    window are generated in order of decreasing size, so that the
+    largest are started on first.
+
+    If device_of is passed, it is called with each ExtendedTarInfo to
+    tell the device it is read from, and members are planned in
+    windows of their own for each device, so that every TarPartition
+    is read from only one.
+
+    If the BackupJournal of a resumed backup is passed, members it
+    has uploaded are left out too, and the TarPartitions are numbered
+    as it calls for.
     """
     # Canonicalize root to include the trailing slash, since root is
     # intended to be a directory anyway.
@@ -347,109 +866,228 @@ def _segmentation_guts(root, file_paths, max_partition_size):
     if not os.path.isdir(root):
         raise TarBadRootError(root=root)
 
-    bogus_tar = None
+    max_window_cost = max_partition_size * PARTITION_PLAN_WINDOW
+    max_window_members = PARTITION_MAX_MEMBERS * PARTITION_PLAN_WINDOW
+
+    if resumed is not None:
+        numbers = resumed.part_numbers()
+    else:
+        numbers = itertools.count()
+
+    # The MemberTable of the window of each device, and its cost.
+    windows = collections.OrderedDict()
+
+    def plan(device):
+        window, window_cost = windows.pop(device)
+        for planned in _plan_partitions(window.size, max_partition_size,
+                                        PARTITION_MAX_MEMBERS):
+            # The TarPartitions of the window share its MemberTable.
+            yield TarPartition(next(numbers), window, planned, device)
+
+    members = _archived_members(root, et_infos, max_partition_size, manifest,
+                                resumed)
+    for et_info in members:
+        device = None if device_of is None else device_of(et_info)
+        window, window_cost = windows.get(device) or (MemberTable(), 0)
+        window.add(et_info)
+        window_cost += _member_cost(et_info.tarinfo.size)
+        windows[device] = (window, window_cost)
+
+        if (window_cost >= max_window_cost
+                or len(window) >= max_window_members):
+            for tpart in plan(device):
+                yield tpart
+
+    for device in windows.keys():
+        for tpart in plan(device):
+            yield tpart
+
+
+def _list_directory(path):
+    """List a directory as os.walk does
+
+    Returns the names of its subdirectories, including symlinks to
+    directories, the names of everything else, and the set of
+    subdirectory names that are symlinks.
+    """
+    dirnames = []
+    filenames = []
+    linked = set()
 
-    try:
-        # Create a bogus TarFile as a contrivance to be able to run
-        # gettarinfo and produce such instances.  Some of the settings
-        # on the TarFile are important, like whether to de-reference
-        # symlinks.
-        bogus_tar = tarfile.TarFile(os.devnull, 'w', dereference=False)
+    if scandir is not None:
+        for entry in scandir(path):
+            try:
+                is_dir = entry.is_dir()
+            except OSError:
+                is_dir = False
+
+            if is_dir:
+                dirnames.append(entry.name)
+                if entry.is_symlink():
+                    linked.add(entry.name)
+            else:
+                filenames.append(entry.name)
+    else:
+        for name in os.listdir(path):
+            entry_path = os.path.join(path, name)
+            if os.path.isdir(entry_path):
+                dirnames.append(name)
+                if os.path.islink(entry_path):
+                    linked.add(name)
+            else:
+                filenames.append(name)
 
-        # Bookkeeping for segmentation of tar members into partitions.
-        partition_number = 0
-        partition_bytes = 0
-        partition_members = 0
-        partition = TarPartition(partition_number)
+    return dirnames, filenames, linked
 
-        for file_path in file_paths:
 
-            # Ensure tar members exist within a shared root before
-            # continuing.
-            if not file_path.startswith(root):
-                raise TarBadPathError(root=root, offensive_path=file_path)
+class _ClusterWalker(object):
+    """Walk a cluster directory, generating ExtendedTarInfos to archive
 
-            # Create an ExtendedTarInfo to represent the tarfile.
-            try:
-                et_info = ExtendedTarInfo(
-                    tarinfo=bogus_tar.gettarinfo(
-                        file_path, arcname=file_path[len(root):]),
-                    submitted_path=file_path)
-
-            except EnvironmentError, e:
-                if (e.errno == errno.ENOENT and
-                    e.filename == file_path):
-                    # log a NOTICE/INFO that the file was unlinked.
-                    # Ostensibly harmless (such unlinks should be replayed
-                    # in the WAL) but good to know.
-                    logger.debug(
-                        msg='tar member additions skipping an unlinked file',
-                        detail='Skipping {0}.'.format(et_info.submitted_path))
-                else:
-                    raise
-
-            # Ensure tar members are within an expected size before
-            # continuing.
-            if et_info.tarinfo.size > max_partition_size:
-                raise TarMemberTooBigError(
-                    et_info.tarinfo.name, max_partition_size,
-                    et_info.tarinfo.size)
-
-            if (partition_bytes + et_info.tarinfo.size >= max_partition_size
-                or partition_members >= PARTITION_MAX_MEMBERS):
-                # Partition is full and cannot accept another member,
-                # so yield the complete one to the caller.
-                yield partition
-
-                # Prepare a fresh partition to accrue additional file
-                # paths into.
-                partition_number += 1
-                partition_bytes = et_info.tarinfo.size
-                partition_members = 1
-                partition = TarPartition(
-                    partition_number, [et_info])
-            else:
-                # Partition is able to accept this member, so just add
-                # it and increment the size counters.
-                partition_bytes += et_info.tarinfo.size
-                partition_members += 1
-                partition.append(et_info)
+    Directories are listed, and their contents stat-ed, by a pool of
+    WALK_CONCURRENCY threads, so that many of the (possibly slow)
+    system calls involved are in flight at once.  ExtendedTarInfos are
+    generated as listings complete, a directory always before its
+    contents, and each path at most once.
 
-                # Partition size overflow must not to be possible
-                # here.
-                assert partition_bytes < max_partition_size
+    Tablespaces are walked along with the rest of the cluster
+    directory as they are found, and recorded in spec.
 
-    finally:
-        if bogus_tar is not None:
-            bogus_tar.close()
+    The device each directory listed is on is recorded, for device to
+    tell that of the ExtendedTarInfos generated.
+    """
 
-    # Flush out the final partition should it be non-empty.
-    if partition:
-        yield partition
+    def __init__(self, root, spec, concurrency=WALK_CONCURRENCY):
+        # The cluster directory, absolute and with a trailing slash.
+        self.root = root
+        self.spec = spec
+        self.concurrency = concurrency
+        self.tblspc_dir = os.path.join(root, 'pg_tblspc')
+        self.bogus_tar = None
 
+        # The st_dev of directories listed, by path without a
+        # trailing slash.
+        self.devices = {}
 
-def partition(pg_cluster_dir):
-    def raise_walk_error(e):
-        raise e
-    if not pg_cluster_dir.endswith(os.path.sep):
-        pg_cluster_dir += os.path.sep
+    def __iter__(self):
+        pool = gevent.threadpool.ThreadPool(self.concurrency)
 
-    # Accumulates a list of archived files while walking the file
-    # system.
-    matches = []
-    # Maintain a manifest of archived files. Tra
-    spec = {'base_prefix': pg_cluster_dir,
-            'tablespaces': []}
+        # Create a bogus TarFile as a contrivance to be able to run
+        # gettarinfo and produce such instances.  Some of the settings
+        # on the TarFile are important, like whether to de-reference
+        # symlinks.
+        self.bogus_tar = tarfile.TarFile(os.devnull, 'w', dereference=False)
+
+        # Directories to list, with the directory of the tablespace
+        # they are within, if any.
+        pending = collections.deque([(self.root, None)])
+        running = {}
+        seen = set()
 
-    walker = os.walk(pg_cluster_dir, onerror=raise_walk_error)
-    for root, dirnames, filenames in walker:
-        is_cluster_toplevel = (os.path.abspath(root) ==
-                               os.path.abspath(pg_cluster_dir))
+        try:
+            while pending or running:
+                while pending and len(running) < self.concurrency:
+                    path, ts_path = pending.popleft()
+                    listing = pool.spawn(self._scan, path, ts_path)
+                    running[listing] = ts_path
+
+                for listing in gevent.wait(running.keys(), count=1):
+                    ts_path = running.pop(listing)
+                    path, device, members, subdirs, tablespaces = (
+                        listing.get())
+                    if device is not None:
+                        self.devices[path.rstrip(os.path.sep)] = device
+
+                    for ts_name, ts_link, ts_loc in tablespaces:
+                        self._add_tablespace(ts_name, ts_link, ts_loc)
+                        pending.append((ts_link, ts_link))
+
+                    pending.extend((subdir, ts_path) for subdir in subdirs)
+
+                    for path, et_info in members:
+                        if path in seen:
+                            continue
+                        seen.add(path)
+
+                        if et_info is None:
+                            # log a NOTICE/INFO that the file was
+                            # unlinked.  Ostensibly harmless (such
+                            # unlinks should be replayed in the WAL)
+                            # but good to know.
+                            logger.debug(
+                                msg=('tar member additions skipping an '
+                                     'unlinked file'),
+                                detail='Skipping {0}.'.format(path))
+                            continue
+
+                        yield et_info
+        finally:
+            pool.kill()
+            self.bogus_tar.close()
+
+    def _add_tablespace(self, ts_name, ts_path, ts_loc):
+        if ts_name not in self.spec['tablespaces']:
+            self.spec['tablespaces'].append(ts_name)
+            self.spec[ts_name] = {
+                'loc': ts_loc,
+                # Link path is relative to base_prefix
+                'link': ts_path[len(self.root):]
+            }
+
+    def device(self, et_info):
+        """Return the st_dev of a directory listed, or of the
+        directory of any other member"""
+        path = et_info.submitted_path.rstrip(os.path.sep)
+        device = self.devices.get(path)
+        if device is None:
+            device = self.devices.get(os.path.dirname(path))
+        return device
+
+    def _scan(self, path, ts_path):
+        """List a directory and stat its members, in a pool thread
+
+        Returns the path of the directory and the device it is on,
+        the paths of members to archive, paired with their
+        ExtendedTarInfos (None for those unlinked in the meantime),
+        the paths of subdirectories to walk and the tablespaces found.
+        """
+        try:
+            dirnames, filenames, linked = _list_directory(path)
+            device = os.stat(path).st_dev
+        except EnvironmentError:
+            if ts_path is not None:
+                # As with os.walk's default, tablespace directories
+                # that cannot be listed are passed over.
+                return path, None, [], [], []
+            raise
+
+        if ts_path is None:
+            paths, tablespaces = self._cluster_members(
+                path, dirnames, filenames, linked)
+        else:
+            paths = self._tablespace_members(path, ts_path, dirnames,
+                                             filenames)
+            tablespaces = []
+
+        # Like os.walk, do not descend into symlinks to directories.
+        subdirs = [os.path.join(path, dirname) for dirname in dirnames
+                   if dirname not in linked]
+
+        return (path, device,
+                [(member, self._tar_info(member)) for member in paths],
+                subdirs, tablespaces)
+
+    def _cluster_members(self, root, dirnames, filenames, linked):
+        """Pick the members to archive from a cluster directory listing
+
+        Returns them, and the tablespaces found.  Subdirectories not
+        to walk are removed from dirnames.
+        """
+        is_cluster_toplevel = root == self.root
 
         # Append "root" so the directory is created during restore
         # even if PostgreSQL empties the directory before tar and
         # upload completes.
-        matches.append(root)
+        matches = [root]
 
         # Do not capture any WAL files, although we do want to
         # capture the WAL directory or symlink
@@ -458,19 +1096,13 @@ def partition(pg_cluster_dir):
             matches.append(os.path.join(root, 'pg_xlog'))
 
         # Do not capture any TEMP Space files, although we do want to
-        # capture the directory name or symlink
-        if 'pgsql_tmp' in dirnames:
-                dirnames.remove('pgsql_tmp')
-                matches.append(os.path.join(root, 'pgsql_tmp'))
-        if 'pg_stat_tmp' in dirnames:
-                dirnames.remove('pg_stat_tmp')
-                matches.append(os.path.join(root, 'pg_stat_tmp'))
-
-        # Do not capture ".wal-e" directories which also contain
-        # temporary working space.
-        if '.wal-e' in dirnames:
-            dirnames.remove('.wal-e')
-            matches.append(os.path.join(root, '.wal-e'))
+        # capture the directory name or symlink.  Likewise for
+        # ".wal-e" directories, which also contain temporary working
+        # space.
+        for dirname in ('pgsql_tmp', 'pg_stat_tmp', '.wal-e'):
+            if dirname in dirnames:
+                dirnames.remove(dirname)
+                matches.append(os.path.join(root, dirname))
 
         # Do not capture lost+found directories, generated by fsck of
         # some file systems, and often only accessible by root,
@@ -493,56 +1125,80 @@ def partition(pg_cluster_dir):
             else:
                 matches.append(os.path.join(root, filename))
 
-        # Special case for tablespaces
-        if root == os.path.join(pg_cluster_dir, 'pg_tblspc'):
-            for tablespace in dirnames:
-                ts_path = os.path.join(root, tablespace)
-                ts_name = os.path.basename(ts_path)
-
-                if os.path.islink(ts_path) and os.path.isdir(ts_path):
+        # Special case for tablespaces: symlinks to directories within
+        # pg_tblspc are recorded in the spec and walked separately.
+        tablespaces = []
+        if root == self.tblspc_dir:
+            for ts_name in dirnames:
+                if ts_name in linked:
+                    ts_path = os.path.join(root, ts_name)
                     ts_loc = os.readlink(ts_path)
-                    ts_walker = os.walk(ts_path)
                     if not ts_loc.endswith(os.path.sep):
                         ts_loc += os.path.sep
+                    tablespaces.append((ts_name, ts_path, ts_loc))
+
+        return matches, tablespaces
+
+    def _tablespace_members(self, ts_root, ts_path, ts_dirnames,
+                            ts_filenames):
+        """Pick the members to archive from a tablespace listing"""
+        matches = []
+
+        if 'pgsql_tmp' in ts_dirnames:
+            ts_dirnames.remove('pgsql_tmp')
+            matches.append(os.path.join(ts_root, 'pgsql_tmp'))
+
+        for ts_filename in ts_filenames:
+            matches.append(os.path.join(ts_root, ts_filename))
+
+        # Pick up the empty directories, other than the tablespace
+        # symlink itself, which the spec restores.
+        if not ts_filenames and ts_root != ts_path:
+            matches.append(ts_root)
+
+        return matches
+
+    def _tar_info(self, path):
+        try:
+            return ExtendedTarInfo(
+                tarinfo=self.bogus_tar.gettarinfo(
+                    path, arcname=path[len(self.root):]),
+                submitted_path=path)
+        except EnvironmentError, e:
+            if e.errno == errno.ENOENT and e.filename == path:
+                return None
+            raise
+
+
+def partition(pg_cluster_dir, manifest=None, resumed=None):
+    """Partition a cluster directory into TarPartitions
+
+    If a BackupManifest is passed, unchanged files are recorded in
+    it rather than partitioned.  If the BackupJournal of a resumed
+    backup is passed, members it has uploaded already are left out.
+
+    TarPartitions are generated while the cluster directory is still
+    being walked, and the tablespaces found are added to the returned
+    spec along the way, so it is only complete once every TarPartition
+    has been generated.
+
+    The members of each TarPartition are all read from the one
+    device, which it records, so that tablespaces on devices of their
+    own are archived in TarPartitions of their own.
+    """
+    if not pg_cluster_dir.endswith(os.path.sep):
+        pg_cluster_dir += os.path.sep
+
+    spec = {'base_prefix': pg_cluster_dir,
+            'tablespaces': []}
+
+    # The prefix removed from the path of all tar members.  Tablespaces
+    # are walked through their symlinks within the cluster directory,
+    # so this is common to all of them.
+    local_prefix = os.path.abspath(pg_cluster_dir) + os.path.sep
 
-                    if ts_name not in spec['tablespaces']:
-                        spec['tablespaces'].append(ts_name)
-                        link_start = len(spec['base_prefix'])
-                        spec[ts_name] = {
-                            'loc': ts_loc,
-                            # Link path is relative to base_prefix
-                            'link': ts_path[link_start:]
-                        }
-
-                    for ts_root, ts_dirnames, ts_filenames in ts_walker:
-                        if 'pgsql_tmp' in ts_dirnames:
-                            ts_dirnames.remove('pgsql_tmp')
-                            matches.append(os.path.join(ts_root, 'pgsql_tmp'))
-
-                        for ts_filename in ts_filenames:
-                            matches.append(os.path.join(ts_root, ts_filename))
-
-                        # pick up the empty directories, make sure ts_root
-                        # isn't duplicated
-                        if not ts_filenames and ts_root not in matches:
-                            matches.append(ts_root)
-
-                    # The symlink for this tablespace is now in the match list,
-                    # remove it.
-                    if ts_path in matches:
-                        matches.remove(ts_path)
-
-    # Absolute upload paths are used for telling lzop what to compress. We
-    # must evaluate tablespace storage dirs separately from core file to handle
-    # the case where a common prefix does not exist between the two.
-    local_abspaths = [os.path.abspath(match) for match in matches]
-    # Common local prefix is the prefix removed from the path all tar members.
-    # Core files first
-    local_prefix = os.path.commonprefix(local_abspaths)
-    if not local_prefix.endswith(os.path.sep):
-        local_prefix += os.path.sep
-
-    parts = _segmentation_guts(
-        local_prefix, matches, PARTITION_MAX_SZ)
+    walker = _ClusterWalker(local_prefix, spec)
+    parts = _segmentation_guts(local_prefix, walker, PARTITION_MAX_SZ,
+                               manifest, resumed, device_of=walker.device)
 
     return spec, parts
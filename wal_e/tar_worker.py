@@ -0,0 +1,307 @@
+"""
+Writing the tar streams of volumes in processes of their own.
+
+backup-push otherwise writes every volume from a greenlet of its one
+process, so that packing headers, padding and copying the files of all
+the volumes being written at once take turns on one CPU.  With
+--tar-processes, each volume is instead written by a process running
+this module, and writing as many volumes at once as are compressed at
+once uses as many CPUs.
+
+The standard output of the process is the standard input of the
+volume's compression pipeline, to which it writes the tar stream
+directly.  Its standard input is a socket to backup-push, over which
+it is sent the members of the volume and, once done, sends back what
+is to be recorded in the manifest, the digest of the tar stream and
+how much it read.  The bytes it writes are taken from backup-push's
+rate limiter, if any, by asking for them over the socket.  backup-push
+itself only schedules volumes and uploads them.
+
+Messages are pickles preceded by their length.  Chunked backups are
+not supported, as chunks are uploaded by backup-push.
+
+"""
+import cPickle as pickle
+import errno
+import gevent
+import gevent.socket
+import hashlib
+import os
+import socket
+import struct
+import sys
+import traceback
+
+import wal_e
+
+from wal_e import checksum
+from wal_e import file_io
+from wal_e import log_help
+from wal_e import page_cache
+from wal_e import pipebuf
+from wal_e import tar_partition
+from wal_e.exception import UserCritical
+from wal_e.piper import popen_sp
+
+_LENGTH = struct.Struct('!I')
+
+
+def _send(sock, message):
+    data = pickle.dumps(message, pickle.HIGHEST_PROTOCOL)
+    sock.sendall(_LENGTH.pack(len(data)) + data)
+
+
+def _recv_exactly(sock, size):
+    chunks = []
+    while size:
+        data = sock.recv(size)
+        if not data:
+            return None
+        chunks.append(data)
+        size -= len(data)
+
+    return ''.join(chunks)
+
+
+def _recv(sock):
+    """Receive a message, or None should the other end have closed"""
+    header = _recv_exactly(sock, _LENGTH.size)
+    if header is None:
+        return None
+
+    data = _recv_exactly(sock, _LENGTH.unpack(header)[0])
+    if data is None:
+        return None
+
+    return pickle.loads(data)
+
+
+def _worker_env():
+    # So that wal_e can be imported from where it was imported here.
+    env = dict(os.environ)
+    path = os.path.dirname(os.path.dirname(os.path.abspath(wal_e.__file__)))
+    env['PYTHONPATH'] = os.pathsep.join(
+        [path] + filter(None, [env.get('PYTHONPATH')]))
+    return env
+
+
+def write_volume(tpart, fileobj, manifest=None, rate_limiter=None,
+                 direct_io=False, zero_copy=False,
+                 io_threads=file_io.THREADS):
+    """Write a volume as TarPartition.tarfile_write does, in a process
+
+    fileobj is to be a pipe, which the process writes to directly,
+    after what was written to fileobj so far.  Returns the hex digest
+    of the tar stream, or None if it could not be digested.
+    """
+    fileobj.flush()
+
+    job = {'name': tpart.name,
+           'members': list(tpart),
+           'manifest': manifest is not None,
+           'delta_lsn': None,
+           'base_sizes': {},
+           'rate_limited': rate_limiter is not None,
+           'direct_io': direct_io,
+           'zero_copy': zero_copy,
+           'io_threads': io_threads}
+
+    if manifest is not None:
+        job['delta_lsn'] = manifest.delta_lsn
+        for et_info in job['members']:
+            if et_info.tarinfo.isfile():
+                base_size = manifest.delta_base_size(et_info.tarinfo)
+                if base_size is not None:
+                    job['base_sizes'][et_info.tarinfo.name] = base_size
+
+    sock, worker_sock = gevent.socket.socketpair()
+    try:
+        proc = popen_sp([sys.executable, '-m', 'wal_e.tar_worker'],
+                        stdin=worker_sock.fileno(), stdout=fileobj.fileno(),
+                        close_fds=True, env=_worker_env())
+    except:
+        sock.close()
+        raise
+    finally:
+        worker_sock.close()
+
+    try:
+        result = _converse(sock, tpart, job, rate_limiter)
+        _wait_exit(sock, proc)
+    finally:
+        sock.close()
+        if proc.poll() is None:
+            proc.kill()
+            proc.wait()
+
+    if proc.returncode != 0:
+        raise UserCritical(
+            msg='volume writing process did not exit gracefully',
+            detail='It had terminated with the exit status {0}.'.format(
+                proc.returncode))
+
+    if manifest is not None:
+        tarinfos = dict((et_info.tarinfo.name, et_info.tarinfo)
+                        for et_info in job['members'])
+        for delta, name, digest in result['added']:
+            if delta:
+                manifest.add_delta(tarinfos[name], tpart.name, digest)
+            else:
+                manifest.add(tarinfos[name], tpart.name, digest)
+
+    page_cache.STATS.add(bytes_read=result['bytes_read'],
+                         pages_dropped=result['pages_dropped'])
+    return result['digest']
+
+
+def _wait_exit(sock, proc):
+    """Wait for a worker to exit without blocking other greenlets
+
+    Its end of the socket is closed as it exits, after which reaping
+    it does not block.
+    """
+    try:
+        while sock.recv(4096):
+            pass
+    except socket.error:
+        pass
+
+    proc.wait()
+
+
+def _exited(tpart):
+    return UserCritical(
+        msg='volume writing process exited unexpectedly',
+        detail='Writing volume {0} was cut short.'.format(tpart.name))
+
+
+def _converse(sock, tpart, job, rate_limiter):
+    """Send a worker its job, and serve it until it is done
+
+    Returns what the worker sent back once done.  A worker that died,
+    whether the socket was then closed or reset, fails the volume as
+    one that reported failure does, for it to be retried.
+    """
+    try:
+        _send(sock, job)
+
+        while True:
+            message = _recv(sock)
+            if message is None:
+                raise _exited(tpart)
+
+            kind, value = message
+            if kind == 'take':
+                rate_limiter.take(value)
+                _send(sock, ('taken', value))
+            elif kind == 'failed':
+                raise UserCritical(
+                    msg='could not write a volume',
+                    detail='Writing volume {0} failed: {1}'.format(
+                        tpart.name, value))
+            else:
+                assert kind == 'done'
+                return value
+    except socket.error, e:
+        if e.errno in (errno.ECONNRESET, errno.EPIPE):
+            raise _exited(tpart)
+        raise
+
+
+class _RemoteTokenBucket(object):
+    """Takes bytes from the rate limiter of backup-push"""
+
+    def __init__(self, sock):
+        self.sock = sock
+
+    def take(self, n):
+        _send(self.sock, ('take', n))
+        kind, value = _recv(self.sock)
+        assert kind == 'taken' and value == n
+
+
+class _VolumeManifest(object):
+    """Stands in for the manifest of backup-push in a worker
+
+    The files archived are recorded as (delta, name, digest) in added,
+    to be added to the manifest by backup-push.
+    """
+
+    def __init__(self, delta_lsn, base_sizes):
+        self.delta_lsn = delta_lsn
+        self.base_sizes = base_sizes
+        self.added = []
+
+    def delta_base_size(self, tarinfo):
+        return self.base_sizes.get(tarinfo.name)
+
+    def add(self, tarinfo, part, digest):
+        self.added.append((False, tarinfo.name, digest))
+
+    def add_delta(self, tarinfo, part, digest):
+        self.added.append((True, tarinfo.name, digest))
+
+
+def main():
+    # Logging is set up for the worker process only, here rather than
+    # in _work.
+    log_help.configure(format='%(name)-12s %(levelname)-8s %(message)s')
+
+    # The socket is non-blocking, as backup-push set it up.
+    sock = gevent.socket.socket(
+        _sock=socket.fromfd(0, socket.AF_UNIX, socket.SOCK_STREAM))
+
+    # Whatever fails is reported to backup-push, for the volume to be
+    # retried.
+    try:
+        return _work(sock)
+    except Exception:
+        _send(sock, ('failed', traceback.format_exc()))
+        return 1
+
+
+def _work(sock):
+    job = _recv(sock)
+    if job is None:
+        # backup-push gave up on the volume already.
+        return 1
+
+    tpart = tar_partition.TarPartition(job['name'])
+    for et_info in job['members']:
+        tpart.append(et_info)
+    del job['members']
+
+    manifest = None
+    if job['manifest']:
+        manifest = _VolumeManifest(job['delta_lsn'], job['base_sizes'])
+
+    rate_limiter = None
+    if job['rate_limited']:
+        rate_limiter = _RemoteTokenBucket(sock)
+
+    # The tar stream is written to what was standard output, which is
+    # pointed at standard error lest anything else be written there.
+    out_fd = os.dup(1)
+    os.dup2(2, 1)
+
+    digest = hashlib.new(checksum.ALGORITHM)
+    out = pipebuf.NonBlockBufferedWriter(os.fdopen(out_fd, 'wb', 0))
+    with file_io.using_threads(job['io_threads']):
+        if not tpart.tarfile_write(out, manifest,
+                                   rate_limiter=rate_limiter, digest=digest,
+                                   direct_io=job['direct_io'],
+                                   zero_copy=job['zero_copy']):
+            digest = None
+    out.flush()
+    out.close()
+
+    _send(sock, ('done', {
+        'added': [] if manifest is None else manifest.added,
+        'digest': None if digest is None else digest.hexdigest(),
+        'bytes_read': page_cache.STATS.bytes_read,
+        'pages_dropped': page_cache.STATS.pages_dropped}))
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,271 @@
+"""
+Writing the tar streams of base backup volumes.
+
+tarfile is general, and slow with it: every member's header goes
+through a dictionary of its fields, each converted on its own, and
+file contents are copied through a new string per read.  For volumes
+of many small files that takes more CPU than reading them.
+
+TarWriter writes the same bytes as tarfile.open(mode='w|') does, in
+its default GNU format, but:
+
+* headers are packed with a single struct call, only members with
+  names too long for the header being left to tarfile;
+
+* headers, file contents, which are read with readinto where
+  possible, and padding are gathered in one buffer, reused for the
+  whole volume and written out a buffer's worth at a time.
+
+When writing to a pipe, as to a compressor, the contents of larger
+files are instead spliced into it from the file (see zero_copy),
+never passing through Python, unless they are to be digested, which
+needs every byte in Python anyway.  Files that shrank while being
+spliced are padded out through the buffer.
+
+Given a hash object, TarWriter digests the stream as it writes it out,
+sparing a pass over it elsewhere.  Contents spliced cannot be, so the
+stream is then left undigested.
+
+"""
+import errno
+import gevent.socket
+import os
+import stat
+import struct
+import tarfile
+
+from wal_e import pipebuf
+from wal_e import zero_copy
+
+BLOCKSIZE = tarfile.BLOCKSIZE
+RECORDSIZE = tarfile.RECORDSIZE
+
+# The size of the buffer volumes are written out in.
+BUFFER_SIZE = pipebuf.PIPE_BUF_BYTES
+
+# The contents of files at least this big are spliced into pipes
+# rather than copied through the buffer.
+SPLICE_MIN = 64 * 1024
+
+# The fields of a header: name, mode, uid, gid, size, mtime, chksum,
+# type, linkname, magic, uname, gname, devmajor, devminor and prefix.
+_HEADER = struct.Struct('100s8s8s8s12s12s8sc100s8s32s32s8s8s155s12x')
+
+_LENGTH_NAME = tarfile.LENGTH_NAME
+_LENGTH_LINK = tarfile.LENGTH_LINK
+
+_NULS = '\0' * BLOCKSIZE
+_CHKSUM_BLANK = ' ' * 8
+
+
+def _number(n, digits):
+    """Convert a number field as tarfile.itn does"""
+    if 0 <= n < 8 ** (digits - 1):
+        return '%0*o\0' % (digits - 1, n)
+    return tarfile.itn(n, digits, tarfile.GNU_FORMAT)
+
+
+def _encoded(s):
+    if type(s) is unicode:
+        return s.encode(tarfile.ENCODING)
+    return s
+
+
+def pack_header(tarinfo):
+    """Return the header blocks of a member, as tarfile would write"""
+    name = _encoded(tarinfo.name)
+    linkname = _encoded(tarinfo.linkname)
+
+    if tarinfo.type == tarfile.DIRTYPE and not name.endswith('/'):
+        name += '/'
+
+    if len(name) > _LENGTH_NAME or len(linkname) > _LENGTH_LINK:
+        # Preceded by GNU long name headers.
+        return tarinfo.tobuf(tarfile.GNU_FORMAT, tarfile.ENCODING, 'strict')
+
+    buf = _HEADER.pack(name,
+                       _number(tarinfo.mode & 07777, 8),
+                       _number(tarinfo.uid, 8),
+                       _number(tarinfo.gid, 8),
+                       _number(tarinfo.size, 12),
+                       _number(tarinfo.mtime, 12),
+                       _CHKSUM_BLANK,
+                       tarinfo.type,
+                       linkname,
+                       tarfile.GNU_MAGIC,
+                       _encoded(tarinfo.uname),
+                       _encoded(tarinfo.gname),
+                       _number(tarinfo.devmajor, 8),
+                       _number(tarinfo.devminor, 8),
+                       '')
+
+    # The checksum is that of the header with the field blank.
+    chksum = sum(bytearray(buf))
+    return buf[:148] + '%06o\0' % chksum + buf[155:]
+
+
+def _pipe_fd(fileobj):
+    """Return the file descriptor of fileobj if it is a pipe"""
+    try:
+        fd = fileobj.fileno()
+    except AttributeError:
+        return None
+
+    if stat.S_ISFIFO(os.fstat(fd).st_mode):
+        return fd
+    return None
+
+
+class TarWriter(object):
+    """Writes a tar stream to fileobj, which is not closed
+
+    The bytes written are taken from rate_limiter, a TokenBucket, if
+    passed, and digest, a hash object, if passed, is updated with them.
+    Should any be spliced, digest is set to None instead.
+    """
+
+    def __init__(self, fileobj, rate_limiter=None, digest=None):
+        self.fileobj = fileobj
+        self.rate_limiter = rate_limiter
+        self.digest = digest
+        self.offset = 0
+
+        self._buffer = bytearray(BUFFER_SIZE)
+        self._view = memoryview(self._buffer)
+        self._used = 0
+
+        self._pipe_fd = None
+        if zero_copy.AVAILABLE:
+            self._pipe_fd = _pipe_fd(fileobj)
+
+    def _take(self, n):
+        if self.rate_limiter is not None:
+            self.rate_limiter.take(n)
+
+    def _write(self, data):
+        self._take(len(data))
+        if self.digest is not None:
+            self.digest.update(data)
+        self.fileobj.write(data)
+
+    def _flush(self):
+        if self._used:
+            # Writers may hold on to what they are passed, so the
+            # buffer, which is reused, is not passed itself.
+            self._write(self._view[:self._used].tobytes())
+            self._used = 0
+
+    def _put(self, data):
+        n = len(data)
+        if self._used + n > len(self._buffer):
+            self._flush()
+            if n > len(self._buffer):
+                self._write(data)
+                self.offset += n
+                return
+
+        self._buffer[self._used:self._used + n] = data
+        self._used += n
+        self.offset += n
+
+    def _pad(self, n):
+        while n:
+            chunk = min(n, BLOCKSIZE)
+            self._put(buffer(_NULS, 0, chunk))
+            n -= chunk
+
+    def add(self, header, f=None, size=0, digest=None):
+        """Add a member, given its header and a file of its contents
+
+        size bytes are read from f; should it end sooner, the rest is
+        made up with NULs.  If a hash object is passed as digest, it
+        is updated with the contents, which are then copied through
+        the buffer rather than spliced.
+        """
+        self._put(header)
+        if f is None:
+            return
+
+        done = 0
+        if (size >= SPLICE_MIN and digest is None and
+                self._pipe_fd is not None and hasattr(f, 'splice')):
+            done = self._splice(f, size)
+
+        self._copy(f, size - done, digest)
+        self._pad(-size % BLOCKSIZE)
+
+    def _copy(self, f, remaining, digest):
+        readinto = getattr(f, 'readinto', None)
+        exhausted = False
+        while remaining:
+            if self._used == len(self._buffer):
+                self._flush()
+
+            start = self._used
+            want = min(remaining, len(self._buffer) - start)
+            target = self._view[start:start + want]
+
+            got = 0
+            if not exhausted:
+                if readinto is not None:
+                    got = readinto(target) or 0
+                else:
+                    data = f.read(want)
+                    got = len(data)
+                    target[:got] = data
+
+            if not got:
+                # Pad out a file that shrank while it was read.
+                exhausted = True
+                self._buffer[start:start + want] = bytearray(want)
+                got = want
+
+            if digest is not None:
+                digest.update(target[:got])
+
+            self._used += got
+            self.offset += got
+            remaining -= got
+
+    def _splice(self, f, size):
+        """Splice up to size bytes of f into the pipe written to
+
+        Returns the number of bytes spliced, which is less than size
+        if the file shrank or cannot be spliced.
+        """
+        # What was written so far has to come first.
+        self._flush()
+        self.fileobj.flush()
+
+        done = 0
+        while done < size:
+            # Waiting here, rather than on EAGAIN, spares a failed call
+            # on the file I/O pool each time the pipe fills.
+            gevent.socket.wait_write(self._pipe_fd)
+            try:
+                n = f.splice(self._pipe_fd, size - done)
+            except EnvironmentError, e:
+                if e.errno == errno.EAGAIN:
+                    gevent.socket.wait_write(self._pipe_fd)
+                    continue
+                elif e.errno == errno.EINVAL and done == 0:
+                    # The file system does not support splicing.
+                    return 0
+                raise
+
+            if not n:
+                break
+
+            self._take(n)
+            self.digest = None
+            done += n
+            self.offset += n
+
+        return done
+
+    def close(self):
+        """End the stream as tarfile does, and write it all out"""
+        self._pad(BLOCKSIZE)
+        self._pad(BLOCKSIZE)
+        self._pad(-self.offset % RECORDSIZE)
+        self._flush()
@@ -0,0 +1,114 @@
+"""
+Limiting the rate at which base backups read the cluster directory.
+
+One TokenBucket is shared by all the volumes of a base backup being
+read at once, so that the limit holds however many of them there are.
+It is meant to be used from greenlets, which sleep while the bytes
+they take are not yet allowed for.
+
+The limit can be changed while a backup is running by writing a new
+rate, in bytes per second, to a control file; 0 lifts the limit.
+
+"""
+import errno
+import gevent
+import os
+import time
+
+from wal_e import log_help
+
+logger = log_help.WalELogger(__name__)
+
+# The number of seconds between checks for changes to a control file.
+CONTROL_INTERVAL = 1
+
+
+class TokenBucket(object):
+    """Limits bytes taken to rate per second, in bursts of up to burst
+
+    A rate of None means no limit, and the burst defaults to one
+    second's worth.  If control_path is passed, the rate is read from
+    the file there whenever it changes.
+    """
+
+    def __init__(self, rate, burst=None, control_path=None):
+        self.rate = rate
+        self.burst = burst
+        self.control_path = control_path
+
+        # The time by which the bytes taken so far are allowed for.
+        self._allowed_at = 0
+        self._control_checked = None
+        self._control_mtime = None
+
+    def take(self, n):
+        """Take n bytes, sleeping until the rate allows for them"""
+        now = time.time()
+        self._check_control(now)
+        if self.rate is None:
+            return
+
+        burst = self.rate if self.burst is None else self.burst
+
+        # Allowance unused while idle accumulates up to the burst size.
+        self._allowed_at = (max(self._allowed_at,
+                                now - float(burst) / self.rate) +
+                            float(n) / self.rate)
+
+        wait = self._allowed_at - now
+        if wait > 0:
+            gevent.sleep(wait)
+
+    def _check_control(self, now):
+        if self.control_path is None or (
+                self._control_checked is not None and
+                now - self._control_checked < CONTROL_INTERVAL):
+            return
+
+        self._control_checked = now
+        try:
+            mtime = os.stat(self.control_path).st_mtime
+            if mtime == self._control_mtime:
+                return
+
+            with open(self.control_path) as f:
+                content = f.read().strip()
+        except EnvironmentError, e:
+            if e.errno == errno.ENOENT:
+                return
+            raise
+
+        self._control_mtime = mtime
+        try:
+            rate = int(content)
+            if rate < 0:
+                raise ValueError(content)
+        except ValueError:
+            logger.warning(
+                msg='ignoring invalid rate limit in control file',
+                detail=('The file "{0}" holds "{1}".'
+                        .format(self.control_path, content)),
+                hint='Write a number of bytes per second, or 0 for none.')
+            return
+
+        self.rate = rate or None
+        logger.info(
+            msg='changed the cluster read rate limit',
+            detail=('The limit is now {0}.'.format(
+                'lifted' if self.rate is None
+                else '{0} bytes per second'.format(self.rate))))
+
+
+class RateLimitedWriter(object):
+    """File-like object taking the bytes written from a TokenBucket"""
+
+    def __init__(self, fp, bucket):
+        self.fp = fp
+        self.bucket = bucket
+
+    def write(self, data):
+        self.bucket.take(len(data))
+        self.fp.write(data)
+
+    def __getattr__(self, name):
+        return getattr(self.fp, name)
@@ -1,19 +1,25 @@
+from wal_e.worker.fetch_pool import FetchPool
 from wal_e.worker.pg import PgBackupStatements
 from wal_e.worker.pg import PgControlDataParser
 from wal_e.worker.pg.wal_transfer import WalSegment
 from wal_e.worker.pg.wal_transfer import WalTransferGroup
 from wal_e.worker.upload import PartitionUploader
 from wal_e.worker.upload import WalUploader
+from wal_e.worker.upload_pool import StagedTarUploadPool
 from wal_e.worker.upload_pool import TarUploadPool
+from wal_e.worker.upload_pool import VolumeBudget
 from wal_e.worker.worker_util import do_lzop_get
 from wal_e.worker.worker_util import do_lzop_put
 from wal_e.worker.worker_util import uri_put_file
 
 __all__ = [
+    'FetchPool',
     'PartitionUploader',
     'PgBackupStatements',
     'PgControlDataParser',
+    'StagedTarUploadPool',
     'TarUploadPool',
+    'VolumeBudget',
     'WalSegment',
     'WalTransferGroup',
     'WalUploader',
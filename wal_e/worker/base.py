@@ -2,6 +2,7 @@ import gevent
 import re
 
 from gevent import queue
+from wal_e import chunk_store
 from wal_e import exception
 from wal_e import log_help
 from wal_e import storage
@@ -194,6 +195,7 @@ class _DeleteFromContext(object):
         self.dry_run = dry_run
         self.layout = layout
         self.deleter = None  # Must be set by subclass
+        self._loaded_backups = {}
 
         assert self.dry_run in (True, False)
 
@@ -228,6 +230,130 @@ class _DeleteFromContext(object):
             delete_horizon_segment_number.as_an_integer:
             self._maybe_delete_key(key, type_of_thing)
 
+    def _dependency_horizon(self, segment_info):
+        """Lower a deletion horizon to keep backups still depended upon
+
+        Incremental backups refer to the volumes of earlier backups
+        for unchanged files, which are listed in their sentinel as
+        "depends_on".  Deleting base backups before the returned
+        segment number spares all those depended upon by backups that
+        are retained, along with any backups taken in between.
+        """
+        horizon = segment_info
+
+        for info in self._backups_from(segment_info):
+            for name in getattr(info, 'depends_on', None) or []:
+                dep_match = re.match(storage.BASE_BACKUP_REGEXP, name)
+                dep_sn = self._groupdict_to_segment_number(
+                    dep_match.groupdict())
+
+                if dep_sn.as_an_integer < horizon.as_an_integer:
+                    logger.info(
+                        msg=('retaining a base backup that an '
+                             'incremental backup depends on'),
+                        detail=('{0} depends on {1}.'
+                                .format(info.name, name)))
+                    horizon = dep_sn
+
+        return horizon
+
+    def _backups_from(self, segment_info):
+        """Generate the BackupInfos, with details, of backups retained
+
+        Those are the complete base backups at or after segment_info.
+        Details are loaded once, at the cost of one web request per
+        backup, and kept for later calls.
+        """
+        sentinel_depth = self.layout.basebackups().count('/') + 1
+
+        for key in self._backup_list(prefix=self.layout.basebackups()):
+            key_parts = self.layout.key_name(key).split('/')
+            if len(key_parts) != sentinel_depth:
+                continue
+
+            match = re.match(storage.COMPLETE_BASE_BACKUP_REGEXP,
+                             key_parts[-1])
+            if match is None:
+                continue
+
+            groups = match.groupdict()
+            scanned_sn = self._groupdict_to_segment_number(groups)
+            if scanned_sn.as_an_integer < segment_info.as_an_integer:
+                continue
+
+            name = 'base_{filename}_{offset}'.format(**groups)
+            info = self._loaded_backups.get(name)
+            if info is None:
+                info = storage.get_backup_info(
+                    self.layout,
+                    name=name,
+                    wal_segment_backup_start=groups['filename'],
+                    wal_segment_offset_backup_start=groups['offset'])
+                info.load_detail(self.conn)
+                self._loaded_backups[name] = info
+
+            yield info
+
+    def _chunked_pushes_from(self, segment_info):
+        """The names of chunked backups at or after segment_info that
+        have not completed (see wal_e.chunk_store)"""
+        sentinel_depth = self.layout.basebackups().count('/') + 1
+        marked = set()
+        completed = set()
+
+        for key in self._backup_list(prefix=self.layout.basebackups()):
+            key_parts = self.layout.key_name(key).split('/')
+            if len(key_parts) == sentinel_depth:
+                match = re.match(storage.COMPLETE_BASE_BACKUP_REGEXP,
+                                 key_parts[-1])
+                if match is not None:
+                    completed.add('base_{filename}_{offset}'.format(
+                        **match.groupdict()))
+            elif (len(key_parts) == sentinel_depth + 1 and
+                    key_parts[-1] == chunk_store.PUSH_MARKER):
+                match = re.match(storage.BASE_BACKUP_REGEXP, key_parts[-2])
+                if match is None:
+                    continue
+
+                scanned_sn = self._groupdict_to_segment_number(
+                    match.groupdict())
+                if scanned_sn.as_an_integer >= segment_info.as_an_integer:
+                    marked.add(key_parts[-2])
+
+        return sorted(marked - completed)
+
+    def _delete_unreferenced_chunks(self, segment_info):
+        """Delete the chunks that no retained base backup refers to
+
+        The retained backups are those at or after segment_info.  None
+        are deleted while a chunked backup among them is still being
+        taken, or failed, as it may rely on any chunk.
+        """
+        referenced = set()
+        for info in self._backups_from(segment_info):
+            referenced.update(getattr(info, 'chunks', None) or [])
+
+        unreferenced = [
+            key for key in self._backup_list(
+                prefix=self.layout.chunk_directory())
+            if self.layout.key_name(key).rsplit('/', 1)[-1] not in referenced]
+
+        # Checked for after listing the chunks, so that a backup
+        # started since relies only on chunks listed after its marker.
+        pushes = self._chunked_pushes_from(segment_info)
+        if pushes:
+            logger.warning(
+                msg='retaining unreferenced chunks',
+                detail=('{0} unreferenced chunks are retained, as chunked '
+                        'backups have not completed: {1}.'
+                        .format(len(unreferenced), ', '.join(pushes))),
+                hint=('They are deleted by a later delete once the backups '
+                      'have completed, or have been deleted themselves.'))
+            return
+
+        for key in unreferenced:
+            self._maybe_delete_key(key, 'an unreferenced chunk')
+
     def _delete_base_backups_before(self, segment_info):
         base_backup_sentinel_depth = self.layout.basebackups().count('/') + 1
         version_depth = base_backup_sentinel_depth + 1
@@ -285,7 +411,8 @@ class _DeleteFromContext(object):
                 match = re.match(
                     storage.BASE_BACKUP_REGEXP, key_parts[-2])
 
-                if match is None or key_parts[-1] != 'extended_version.txt':
+                if match is None or key_parts[-1] not in (
+                        'extended_version.txt', chunk_store.PUSH_MARKER):
                     logger.warning(
                         msg="skipping non-qualifying key in 'delete before'",
                         detail=('The unexpected key is "{0}", and it appears '
@@ -296,8 +423,12 @@ class _DeleteFromContext(object):
                     assert match is not None
                     scanned_sn = \
                         self._groupdict_to_segment_number(match.groupdict())
+                    if key_parts[-1] == chunk_store.PUSH_MARKER:
+                        type_of_thing = 'a chunked backup marker'
+                    else:
+                        type_of_thing = 'a extended version metadata file'
                     self._delete_if_before(segment_info, scanned_sn, key,
-                                        'a extended version metadata file')
+                                           type_of_thing)
             elif key_depth == volume_backup_depth:
                 # This has the depth of a base-backup volume, so try
                 # to match the expected pattern and delete it if the
@@ -349,10 +480,13 @@ class _DeleteFromContext(object):
                         'at an unexpected depth.'.format(url)),
                     hint=generic_weird_key_hint_message)
             elif key_depth == wal_key_depth:
-                segment_match = (re.match(storage.SEGMENT_REGEXP + r'\.lzo',
-                                          key_parts[-1]))
+                segment_match = (
+                    re.match(storage.SEGMENT_REGEXP +
+                             storage.COMPRESSION_SUFFIX_REGEXP,
+                             key_parts[-1]))
                 label_match = (re.match(storage.SEGMENT_REGEXP +
-                                        r'\.[A-F0-9]{8,8}.backup.lzo',
+                                        r'\.[A-F0-9]{8,8}.backup' +
+                                        storage.COMPRESSION_SUFFIX_REGEXP,
                                         key_parts[-1]))
                 history_match = re.match(r'[A-F0-9]{8,8}\.history',
                                          key_parts[-1])
@@ -411,6 +545,9 @@ class _DeleteFromContext(object):
         for k in self._backup_list(prefix=self.layout.wal_directory()):
             self._maybe_delete_key(k, 'part of wal logs')
 
+        for k in self._backup_list(prefix=self.layout.chunk_directory()):
+            self._maybe_delete_key(k, 'a chunk of base backups')
+
         if self.deleter:
             self.deleter.close()
 
@@ -423,8 +560,12 @@ class _DeleteFromContext(object):
 
         """
 
-        # This will delete all base backup data before segment_info.
-        self._delete_base_backups_before(segment_info)
+        # This will delete all base backup data before segment_info,
+        # except for that retained incremental backups depend on, and
+        # the chunks only the deleted backups refer to.
+        horizon = self._dependency_horizon(segment_info)
+        self._delete_base_backups_before(horizon)
+        self._delete_unreferenced_chunks(horizon)
 
         # This will delete all WAL segments before segment_info.
         self._delete_wals_before(segment_info)
@@ -502,9 +643,12 @@ class _DeleteFromContext(object):
         logger.info(**log_message)
 
         # This will delete all base backup and WAL data before
-        # last_retained['scanned_sn'].
+        # last_retained['scanned_sn'], except for base backups that
+        # retained incremental backups depend on.
         if last_retained is not None:
-            self._delete_base_backups_before(last_retained['scanned_sn'])
+            horizon = self._dependency_horizon(last_retained['scanned_sn'])
+            self._delete_base_backups_before(horizon)
+            self._delete_unreferenced_chunks(horizon)
             self._delete_wals_before(last_retained['scanned_sn'])
 
         if self.deleter:
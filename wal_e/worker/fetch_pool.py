@@ -0,0 +1,107 @@
+import collections
+import gevent
+import traceback
+
+from gevent import event
+from wal_e import log_help
+
+logger = log_help.WalELogger(__name__)
+
+# After this many failures in a row, the connection of a fetcher is
+# retired, so long as another one is left.
+MAX_FAILURES = 3
+
+# A volume that failed to fetch is retried after this many seconds
+# at the earliest, as by retries.retry.
+RETRY_INTERVAL = 0.1
+
+
+class FetchPool(object):
+    """Fetches volumes over a set of connections, largest first
+
+    Each fetcher, one per connection, fetches the next volume not yet
+    taken from a queue shared by all, so that a fetcher slowed down by
+    its connection takes fewer volumes rather than holding up a share
+    of them.  Volumes are queued largest first, so that none of the
+    large ones is started last and stretches the tail of the restore.
+
+    A volume that fails to fetch goes back to the front of the queue,
+    for any fetcher to retry.  A connection over which fetches failed
+    MAX_FAILURES times in a row is retired, and so is not used for
+    any other backup fetched through the pool either; the last one is
+    kept however, and retries until the volume is fetched, like
+    fetch_partition.
+    """
+
+    def __init__(self, pool_size, max_failures=MAX_FAILURES):
+        self.max_failures = max_failures
+        self.live = set(xrange(pool_size))
+        self.failures = [0] * pool_size
+
+    def fetch(self, fetchers, volumes):
+        """Fetch the volumes of one backup
+
+        fetchers holds a BackupFetcher for each connection of the pool,
+        in the same order every time, and volumes (name, size, members)
+        for each volume to extract members of, all members if None.
+        """
+        queue = collections.deque(
+            sorted(volumes, key=lambda volume: volume[1], reverse=True))
+        state = {'in_flight': 0}
+        changed = event.Event()
+
+        def work(slot):
+            while True:
+                if not queue:
+                    if not state['in_flight']:
+                        return
+
+                    changed.clear()
+                    changed.wait()
+                    continue
+
+                volume = queue.popleft()
+                state['in_flight'] += 1
+                try:
+                    if not self._fetch(slot, fetchers[slot], volume):
+                        queue.appendleft(volume)
+                        if slot not in self.live:
+                            return
+
+                        gevent.sleep(RETRY_INTERVAL)
+                finally:
+                    state['in_flight'] -= 1
+                    changed.set()
+
+        workers = [gevent.spawn(work, slot) for slot in sorted(self.live)]
+        try:
+            gevent.joinall(workers, raise_error=True)
+        finally:
+            gevent.killall(workers)
+
+    def _fetch(self, slot, fetcher, volume):
+        """Fetch a volume, returning whether that succeeded"""
+        name, size, members = volume
+        try:
+            fetcher.fetch_partition_once(name, members)
+        except Exception:
+            self.failures[slot] += 1
+            logger.warning(
+                msg='retrying a volume after it failed to fetch',
+                detail=('Fetching volume {0} failed over connection {1}, '
+                        '{2} times in a row:\n{3}'
+                        .format(name, slot, self.failures[slot],
+                                traceback.format_exc())))
+
+            if (self.failures[slot] >= self.max_failures and
+                    len(self.live) > 1):
+                self.live.discard(slot)
+                logger.warning(
+                    msg='retiring a connection of backup-fetch',
+                    detail=('Connection {0} is no longer used, leaving {1}.'
+                            .format(slot, len(self.live))))
+
+            return False
+
+        self.failures[slot] = 0
+        return True
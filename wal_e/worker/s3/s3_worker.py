@@ -8,6 +8,7 @@ with the intention that they are used in gevent greenlets.
 import gevent
 import re
 
+from wal_e import compression
 from wal_e import log_help
 from wal_e import storage
 from wal_e.blobstore import s3
@@ -33,6 +34,11 @@ class TarPartitionLister(object):
         self.backup_info = backup_info
 
     def __iter__(self):
+        for name, size in self.volumes():
+            yield name
+
+    def volumes(self):
+        """Yield the name and size of every volume of the backup"""
         prefix = self.layout.basebackup_tar_partition_directory(
             self.backup_info)
 
@@ -49,20 +55,27 @@ class TarPartitionLister(object):
                             .format(url)),
                     hint=generic_weird_key_hint_message)
             else:
-                yield key_last_part
+                yield key_last_part, key.size
 
 
 class BackupFetcher(object):
-    def __init__(self, s3_conn, layout, backup_info, local_root, decrypt):
+    def __init__(self, s3_conn, layout, backup_info, local_root, decrypt,
+                 chunks=None, download_conns=None, durability=None):
         self.s3_conn = s3_conn
         self.layout = layout
         self.local_root = local_root
         self.backup_info = backup_info
         self.bucket = get_bucket(self.s3_conn, self.layout.store_name())
         self.decrypt = decrypt
+        self.chunks = chunks
+        self.durability = durability
+
+        # With more than one connection, volumes are fetched in
+        # ranges over all of them at once.
+        self.download_conns = download_conns or []
 
-    @retry()
-    def fetch_partition(self, partition_name):
+    def fetch_partition_once(self, partition_name, members=None):
+        """Fetch and extract a volume, without retrying on failure"""
         part_abs_name = self.layout.basebackup_tar_partition(
             self.backup_info, partition_name)
 
@@ -73,15 +86,28 @@ class BackupFetcher(object):
             hint='The absolute S3 key is {0}.'.format(part_abs_name))
 
         key = self.bucket.Object(part_abs_name)
-        with get_download_pipeline(PIPE, PIPE, self.decrypt) as pl:
-            g = gevent.spawn(s3.write_and_return_error, key, pl.stdin)
-            TarPartition.tarfile_extract(pl.stdout, self.local_root)
+        with get_download_pipeline(
+                PIPE, PIPE, self.decrypt,
+                codec=compression.codec_for_name(partition_name)) as pl:
+            if len(self.download_conns) > 1:
+                keys = [get_bucket(conn, self.layout.store_name())
+                        .Object(part_abs_name)
+                        for conn in self.download_conns]
+                g = gevent.spawn(s3.write_ranges_and_return_error,
+                                 keys, pl.stdin)
+            else:
+                g = gevent.spawn(s3.write_and_return_error, key, pl.stdin)
+            TarPartition.tarfile_extract(pl.stdout, self.local_root,
+                                         members, self.chunks,
+                                         self.durability)
 
             # Raise any exceptions guarded by write_and_return_error.
             exc = g.get()
             if exc is not None:
                 raise exc
 
+    fetch_partition = retry()(fetch_partition_once)
+
 
 class BackupList(_BackupList):
 
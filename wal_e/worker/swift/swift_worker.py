@@ -2,7 +2,7 @@ import re
 
 import gevent
 
-from wal_e import log_help, storage
+from wal_e import compression, log_help, storage
 from wal_e.blobstore import swift
 from wal_e.pipeline import get_download_pipeline
 from wal_e.piper import PIPE
@@ -24,6 +24,11 @@ class TarPartitionLister(object):
         self.backup_info = backup_info
 
     def __iter__(self):
+        for name, size in self.volumes():
+            yield name
+
+    def volumes(self):
+        """Yield the name and size of every volume of the backup"""
         prefix = self.layout.basebackup_tar_partition_directory(
             self.backup_info)
 
@@ -42,19 +47,26 @@ class TarPartitionLister(object):
                             .format(url)),
                     hint=generic_weird_key_hint_message)
             else:
-                yield name_last_part
+                yield name_last_part, obj['bytes']
 
 
 class BackupFetcher(object):
-    def __init__(self, swift_conn, layout, backup_info, local_root, decrypt):
+    def __init__(self, swift_conn, layout, backup_info, local_root, decrypt,
+                 chunks=None, download_conns=None, durability=None):
         self.swift_conn = swift_conn
         self.layout = layout
         self.local_root = local_root
         self.backup_info = backup_info
         self.decrypt = decrypt
+        self.chunks = chunks
+        self.durability = durability
+
+        # With more than one connection, volumes are fetched in
+        # ranges over all of them at once.
+        self.download_conns = download_conns or []
 
-    @retry()
-    def fetch_partition(self, partition_name):
+    def fetch_partition_once(self, partition_name, members=None):
+        """Fetch and extract a volume, without retrying on failure"""
         part_abs_name = self.layout.basebackup_tar_partition(
             self.backup_info, partition_name)
 
@@ -67,16 +79,26 @@ class BackupFetcher(object):
 
         url = 'swift://{ctr}/{path}'.format(ctr=self.layout.store_name(),
                                             path=part_abs_name)
-        with get_download_pipeline(PIPE, PIPE, self.decrypt) as pl:
-            g = gevent.spawn(swift.write_and_return_error,
-                             url, self.swift_conn, pl.stdin)
-            TarPartition.tarfile_extract(pl.stdout, self.local_root)
+        with get_download_pipeline(
+                PIPE, PIPE, self.decrypt,
+                codec=compression.codec_for_name(partition_name)) as pl:
+            if len(self.download_conns) > 1:
+                g = gevent.spawn(swift.write_ranges_and_return_error,
+                                 url, self.download_conns, pl.stdin)
+            else:
+                g = gevent.spawn(swift.write_and_return_error,
+                                 url, self.swift_conn, pl.stdin)
+            TarPartition.tarfile_extract(pl.stdout, self.local_root,
+                                         members, self.chunks,
+                                         self.durability)
 
             # Raise any exceptions guarded by write_and_return_error.
             exc = g.get()
             if exc is not None:
                 raise exc
 
+    fetch_partition = retry()(fetch_partition_once)
+
 
 class BackupList(_BackupList):
 
@@ -1,12 +1,18 @@
 import errno
+import gevent
+import gevent.pool
+import hashlib
 import socket
 import tempfile
 import time
 
+from wal_e import checksum
+from wal_e import file_io
 from wal_e import log_help
 from wal_e import pipebuf
 from wal_e import pipeline
 from wal_e import storage
+from wal_e import tar_worker
 from wal_e.blobstore import get_blobstore
 from wal_e.piper import PIPE
 from wal_e.retries import retry, retry_with_count
@@ -14,19 +20,28 @@ from wal_e.worker.worker_util import do_lzop_put, format_kib_per_second
 
 logger = log_help.WalELogger(__name__)
 
+# Number of parts of a streamed volume that may be buffered and sent
+# concurrently.
+PARTS_IN_FLIGHT = 2
+
+
+def _suffix(compression):
+    return '.lzo' if compression is None else compression.suffix
+
 
 class WalUploader(object):
-    def __init__(self, layout, creds, gpg_key_id):
+    def __init__(self, layout, creds, gpg_key_id, compression=None):
         self.layout = layout
         self.creds = creds
         self.gpg_key_id = gpg_key_id
+        self.compression = compression
         self.blobstore = get_blobstore(layout)
 
     def __call__(self, segment):
         # TODO :: Move arbitray path construction to StorageLayout Object
-        url = '{0}/wal_{1}/{2}.lzo'.format(self.layout.prefix.rstrip('/'),
-                                           storage.CURRENT_VERSION,
-                                           segment.name)
+        url = '{0}/wal_{1}/{2}{3}'.format(
+            self.layout.prefix.rstrip('/'), storage.CURRENT_VERSION,
+            segment.name, _suffix(self.compression))
 
         logger.info(msg='begin archiving a file',
                     detail=('Uploading "{wal_path}" to "{url}".'
@@ -42,10 +57,13 @@ class WalUploader(object):
                                'seg': segment.name,
                                'prefix': self.layout.path_prefix}
 
+        checksums = checksum.Checksums()
         try:
             # Upload and record the rate at which it happened.
             kib_per_second = do_lzop_put(self.creds, url, segment.path,
-                                         self.gpg_key_id)
+                                         self.gpg_key_id,
+                                         compression=self.compression,
+                                         checksums=checksums)
         except EnvironmentError as e:
             if not segment.explicit and e.errno == errno.ENOENT:
                 structured = dict(state='skip', **structured_template)
@@ -58,6 +76,7 @@ class WalUploader(object):
         else:
             structured = dict(rate=str(kib_per_second), state='complete',
                               **structured_template)
+            structured[checksum.ALGORITHM] = checksums.compressed.hexdigest()
             logger.info(msg='completed archiving to a file',
                         detail=('Archiving to "{url}" complete at '
                                 '{kib_per_second}KiB/s.'
@@ -69,66 +88,183 @@ class WalUploader(object):
 
 
 class PartitionUploader(object):
-    def __init__(self, creds, backup_prefix, rate_limit, gpg_key):
+    def __init__(self, creds, backup_prefix, rate_limiter, gpg_key,
+                 stream=False, manifest=None, compression=None,
+                 chunks=None, journal=None, tar_processes=False,
+                 direct_io=False, zero_copy=False,
+                 io_threads=file_io.THREADS):
         self.creds = creds
         self.backup_prefix = backup_prefix
-        self.rate_limit = rate_limit
+        # A TokenBucket shared by all volumes being written, or None.
+        self.rate_limiter = rate_limiter
         self.gpg_key = gpg_key
+        self.manifest = manifest
+        self.compression = compression
+        self.chunks = chunks
+        # A BackupJournal recording the volumes uploaded, or None.
+        self.journal = journal
+        # The Checksums of volumes compressed but not yet uploaded, by
+        # volume number.
+        self.checksums = {}
+        # Whether volumes are written by processes of their own (see
+        # tar_worker).
+        self.tar_processes = tar_processes
+        # Whether files are read with O_DIRECT (see page_cache).
+        self.direct_io = direct_io
+        # Whether files are spliced into volumes undigested (see
+        # TarPartition.tarfile_write).
+        self.zero_copy = zero_copy
+        # The number of file I/O threads of tar_worker processes.
+        self.io_threads = io_threads
         self.blobstore = get_blobstore(storage.StorageLayout(backup_prefix))
 
+        # Streaming volumes straight into a multipart upload requires
+        # support from the blob store; fall back to staging volumes in
+        # a temporary file otherwise.
+        self.stream = stream and hasattr(self.blobstore, 'MultipartUpload')
+        if stream and not self.stream:
+            logger.warning(
+                msg='streaming upload not supported by this blob store',
+                detail=('Volumes will be compressed into temporary files '
+                        'before they are uploaded.'))
+
+    def _volume_url(self, tpart):
+        # TODO :: Move arbitray path construction to StorageLayout Object
+        return '{0}/tar_partitions/part_{number:08d}.tar{1}'.format(
+            self.backup_prefix.rstrip('/'), _suffix(self.compression),
+            number=tpart.name)
+
+    def _write_volume(self, tpart, fp):
+        """Write a volume, returning the hex digest of its tar stream
+
+        None is returned if the stream could not be digested.
+        """
+        if self.tar_processes:
+            assert self.chunks is None
+            return tar_worker.write_volume(tpart, fp, self.manifest,
+                                           self.rate_limiter,
+                                           direct_io=self.direct_io,
+                                           zero_copy=self.zero_copy,
+                                           io_threads=self.io_threads)
+
+        digest = hashlib.new(checksum.ALGORITHM)
+        if tpart.tarfile_write(fp, self.manifest, self.chunks,
+                               self.rate_limiter, digest,
+                               direct_io=self.direct_io,
+                               zero_copy=self.zero_copy):
+            return digest.hexdigest()
+        return None
+
+    def _complete(self, tpart, checksums):
+        """Record the checksums of a volume uploaded, and journal it"""
+        if self.manifest is not None:
+            self.manifest.add_volume(tpart.name, checksums.as_dict())
+
+        if self.journal is None:
+            return
+
+        chunk_names = ()
+        if self.chunks is not None:
+            # The volume may only be relied on once its chunks are
+            # stored too.
+            self.chunks.wait_sent()
+            chunk_names = self.chunks.referenced
+
+        self.journal.complete(tpart, self.manifest, chunk_names,
+                              checksums.as_dict())
+
+    def _retry_volume_errors(self, tpart):
+        def log_volume_failures_on_error(exc_tup, exc_processor_cxt):
+            def standard_detail_message(prefix=''):
+                return (prefix +
+                        '  There have been {n} attempts to send the '
+                        'volume {name} so far.'.format(n=exc_processor_cxt,
+                                                       name=tpart.name))
+
+            typ, value, tb = exc_tup
+            del exc_tup
+
+            # Screen for certain kinds of known-errors to retry from
+            if issubclass(typ, socket.error):
+                socketmsg = value[1] if isinstance(value, tuple) else value
+
+                logger.info(
+                    msg='Retrying send because of a socket error',
+                    detail=standard_detail_message(
+                        "The socket error's message is '{0}'."
+                        .format(socketmsg)))
+            else:
+                # This type of error is unrecognized as a retry-able
+                # condition, so propagate it, original stacktrace and
+                # all.
+                raise typ, value, tb
+
+        return retry(retry_with_count(log_volume_failures_on_error))
+
     def __call__(self, tpart):
         """
         Synchronous version of the upload wrapper
 
+        """
+        if self.stream:
+            logger.info(msg='beginning volume compression',
+                        detail='Building volume {name}.'
+                        .format(name=tpart.name))
+            if self.journal is not None:
+                self.journal.start(tpart.name)
+            checksums = self._stream_upload(tpart, self._volume_url(tpart))
+            self._complete(tpart, checksums)
+            return tpart
+
+        return self.upload(tpart, self.compress(tpart))
+
+    def compress(self, tpart):
+        """Build a compressed volume in a temporary file
+
+        The returned file is positioned at its end and is to be
+        passed on to, and is closed by, upload.  The volume and the
+        file are digested on the way.
         """
         logger.info(msg='beginning volume compression',
                     detail='Building volume {name}.'.format(name=tpart.name))
 
-        with tempfile.NamedTemporaryFile(
-                mode='r+b', bufsize=pipebuf.PIPE_BUF_BYTES) as tf:
-            with pipeline.get_upload_pipeline(PIPE, tf,
-                                              rate_limit=self.rate_limit,
-                                              gpg_key=self.gpg_key) as pl:
-                tpart.tarfile_write(pl.stdin)
+        if self.journal is not None:
+            self.journal.start(tpart.name)
+
+        checksums = checksum.Checksums(raw=False)
+        tf = tempfile.NamedTemporaryFile(mode='r+b',
+                                         bufsize=pipebuf.PIPE_BUF_BYTES)
+        try:
+            with pipeline.get_upload_pipeline(
+                    PIPE, tf, gpg_key=self.gpg_key,
+                    compression=self.compression,
+                    checksums=checksums) as pl:
+                checksums.raw_hexdigest = self._write_volume(tpart,
+                                                             pl.stdin)
 
             tf.flush()
+        except:
+            tf.close()
+            raise
 
-            # TODO :: Move arbitray path construction to StorageLayout Object
-            url = '{0}/tar_partitions/part_{number:08d}.tar.lzo'.format(
-                self.backup_prefix.rstrip('/'), number=tpart.name)
+        self.checksums[tpart.name] = checksums
+        return tf
 
+    def upload(self, tpart, tf):
+        """Upload a volume built by compress"""
+        url = self._volume_url(tpart)
+        checksums = self.checksums.pop(tpart.name)
+
+        with tf:
             logger.info(msg='begin uploading a base backup volume',
                         detail='Uploading to "{url}".'.format(url=url))
 
-            def log_volume_failures_on_error(exc_tup, exc_processor_cxt):
-                def standard_detail_message(prefix=''):
-                    return (prefix +
-                            '  There have been {n} attempts to send the '
-                            'volume {name} so far.'.format(n=exc_processor_cxt,
-                                                           name=tpart.name))
-
-                typ, value, tb = exc_tup
-                del exc_tup
-
-                # Screen for certain kinds of known-errors to retry from
-                if issubclass(typ, socket.error):
-                    socketmsg = value[1] if isinstance(value, tuple) else value
-
-                    logger.info(
-                        msg='Retrying send because of a socket error',
-                        detail=standard_detail_message(
-                            "The socket error's message is '{0}'."
-                            .format(socketmsg)))
-                else:
-                    # This type of error is unrecognized as a retry-able
-                    # condition, so propagate it, original stacktrace and
-                    # all.
-                    raise typ, value, tb
-
-            @retry(retry_with_count(log_volume_failures_on_error))
+            @self._retry_volume_errors(tpart)
             def put_file_helper():
                 tf.seek(0)
-                return self.blobstore.uri_put_file(self.creds, url, tf)
+                return self.blobstore.uri_put_file(
+                    self.creds, url, tf, metadata=checksums.metadata(),
+                    content_md5=checksums.content_md5())
 
             # Actually do work, retrying if necessary, and timing how long
             # it takes.
@@ -144,4 +280,95 @@ class PartitionUploader(object):
                         '{kib_per_second}KiB/s. '
                         .format(url=url, kib_per_second=kib_per_second)))
 
+        self._complete(tpart, checksums)
         return tpart
+
+    def _stream_upload(self, tpart, url):
+        """Upload a volume in parts while it is being compressed
+
+        The compressed stream is cut into parts of the size preferred
+        by the blob store.  At most PARTS_IN_FLIGHT parts are buffered
+        in memory at any one time, and each part is retried on its own
+        should sending it fail.
+
+        Returns the Checksums of the volume.
+        """
+        logger.info(msg='begin streaming a base backup volume',
+                    detail='Uploading to "{url}".'.format(url=url))
+
+        upload = self.blobstore.MultipartUpload(self.creds, url)
+
+        @self._retry_volume_errors(tpart)
+        def put_part_helper(part_number, data):
+            return upload.put_part(part_number, data)
+
+        def write_volume(stdin):
+            checksums.raw_hexdigest = self._write_volume(tpart, stdin)
+            stdin.flush()
+            stdin.close()
+
+        # Parts are sent along with digests of their own, where the
+        # blob store supports it.
+        checksums = checksum.Checksums(content_md5=False, raw=False)
+        senders = gevent.pool.Pool(size=PARTS_IN_FLIGHT)
+        sending = []
+        clock_start = time.time()
+        try:
+            with pipeline.get_upload_pipeline(
+                    PIPE, PIPE, gpg_key=self.gpg_key,
+                    compression=self.compression,
+                    checksums=checksums) as pl:
+                writer = gevent.spawn(write_volume, pl.stdin)
+
+                try:
+                    part_number = 1
+                    while True:
+                        # Blocks while PARTS_IN_FLIGHT parts are being
+                        # sent, which in turn stalls compression, so
+                        # that no more parts are held than that.
+                        senders.wait_available()
+
+                        data = pl.stdout.read(upload.part_size)
+                        if not data:
+                            break
+
+                        sending.append(senders.spawn(put_part_helper,
+                                                     part_number, data))
+                        part_number += 1
+                        del data
+
+                        # Stop early should a part fail to be sent.
+                        for g in [g for g in sending if g.ready()]:
+                            g.get()
+                            sending.remove(g)
+
+                    # Raise any exceptions from writing the volume.
+                    writer.get()
+                except:
+                    # Let the compressor exit rather than have it block
+                    # on a pipe that is no longer being read.
+                    writer.kill()
+                    pl.stdout.close()
+                    raise
+
+            senders.join()
+            for g in sending:
+                g.get()
+
+            k = upload.complete(metadata=checksums.metadata())
+        except:
+            senders.kill()
+            upload.abort()
+            raise
+
+        clock_finish = time.time()
+
+        kib_per_second = format_kib_per_second(clock_start, clock_finish,
+                                               k.size)
+        logger.info(
+            msg='finish uploading a base backup volume',
+            detail=('Uploading to "{url}" complete at '
+                    '{kib_per_second}KiB/s. '
+                    .format(url=url, kib_per_second=kib_per_second)))
+
+        return checksums
@@ -1,17 +1,246 @@
+import collections
 import gc
 import gevent
+import mmap
+import os
+import tarfile
+import tempfile
+import time
 
+from gevent import queue
 from wal_e import channel
+from wal_e import log_help
 from wal_e import tar_partition
-from wal_e.exception import UserCritical
+from wal_e.exception import UserCritical, UserException
+
+logger = log_help.WalELogger(__name__)
+
+# Stages reported by StagedTarUploadPool.
+_COMPRESSED = 'compressed'
+_UPLOADED = 'uploaded'
+
+# The share of the temporary file system kept free by default.
+MIN_TEMP_FREE_FRACTION = 0.1
+
+# While a VolumeBudget admits no volume, it is checked again this
+# often, in seconds, and a warning logged this often at most.
+BACKOFF_INTERVAL = 5
+BACKOFF_WARNING_INTERVAL = 60
+
+# With a limit on the volumes read from each device at once, up to
+# this many volumes are held back while their devices are busy, so
+# that those of other devices can be started before them.
+MAX_HELD_VOLUMES = 2 * tar_partition.PARTITION_PLAN_WINDOW
+
+
+def _resident_bytes():
+    """Return the resident memory of the process, or None if unknown"""
+    try:
+        with open('/proc/self/statm') as f:
+            return int(f.read().split()[1]) * mmap.PAGESIZE
+    except (EnvironmentError, IndexError, ValueError):
+        return None
+
+
+def _tar_size(tpart):
+    # Each member takes a header block, and half a block of padding on
+    # average.
+    return tpart.total_member_size + len(tpart) * tarfile.BLOCKSIZE * 3 // 2
+
+
+class VolumeBudget(object):
+    """Admits volumes to be compressed by the bytes they take up
+
+    Three limits are kept, each only if set:
+
+    * max_temp_bytes, on the temporary files of compressed volumes;
+
+    * min_temp_free, on the space left free on the file system of
+      temp_dir, by default MIN_TEMP_FREE_FRACTION of it;
+
+    * max_memory, on the resident memory of the process.
+
+    Bytes are measured where they can be: the sizes of compressed
+    volumes awaiting upload, the free space and the resident memory.
+    Volumes being compressed are reckoned at the size they are
+    expected to compress to, going by the ratio of those compressed
+    so far, or their uncompressed size to begin with.  A volume is
+    admitted regardless when nothing else is in progress, unless the
+    temporary file system is short of space, which the pools then
+    fail on rather than wait for space to be freed.
+    """
+
+    def __init__(self, max_temp_bytes=None, min_temp_free=None,
+                 max_memory=None, temp_dir=None, temp_files=True):
+        self.max_temp_bytes = max_temp_bytes
+        self.max_memory = max_memory
+        self.temp_dir = temp_dir or tempfile.gettempdir()
+
+        # Whether volumes are staged in temporary files at all.
+        self.temp_files = temp_files
+
+        if min_temp_free is None and temp_files:
+            st = os.statvfs(self.temp_dir)
+            min_temp_free = int(st.f_blocks * st.f_frsize *
+                                MIN_TEMP_FREE_FRACTION)
+        self.min_temp_free = min_temp_free
+
+        # The expected sizes of volumes being compressed, and the
+        # measured ones of those awaiting upload, by name.
+        self._compressing = {}
+        self._compressed = {}
+
+        # Totals of the volumes compressed so far.
+        self._tar_bytes = 0
+        self._compressed_bytes = 0
+
+    def _expected_size(self, tpart):
+        size = _tar_size(tpart)
+        if self._tar_bytes:
+            size = size * self._compressed_bytes // self._tar_bytes
+        return size
+
+    def _temp_free(self):
+        st = os.statvfs(self.temp_dir)
+        return st.f_bavail * st.f_frsize
+
+    def refusal(self, tpart, outstanding):
+        """Tell why tpart cannot be admitted now, or None if it can
+
+        outstanding is the number of volumes in progress.
+        """
+        if self.temp_files:
+            expected = self._expected_size(tpart)
+            growing = sum(self._compressing.itervalues())
+
+            if self.min_temp_free is not None:
+                free = self._temp_free() - growing - expected
+                if free < self.min_temp_free:
+                    return ('{0} bytes would be left free in {1}, short of '
+                            '{2}'.format(free, self.temp_dir,
+                                         self.min_temp_free))
+
+            if self.max_temp_bytes is not None and outstanding:
+                in_use = (growing + expected +
+                          sum(self._compressed.itervalues()))
+                if in_use > self.max_temp_bytes:
+                    return ('{0} bytes of temporary files would exceed {1}'
+                            .format(in_use, self.max_temp_bytes))
+
+        if self.max_memory is not None and outstanding:
+            resident = _resident_bytes()
+            if resident is not None and resident > self.max_memory:
+                # Only now is it worth collecting garbage.
+                gc.collect()
+                resident = _resident_bytes()
+
+            if resident is not None and resident > self.max_memory:
+                return ('{0} bytes of memory are in use, over {1}'
+                        .format(resident, self.max_memory))
+
+        return None
+
+    def started(self, tpart):
+        self._compressing[tpart.name] = self._expected_size(tpart)
+
+    def compressed(self, tpart, fileobj):
+        """Account for tpart having been compressed into fileobj"""
+        del self._compressing[tpart.name]
+        if not self.temp_files:
+            return
+
+        size = os.fstat(fileobj.fileno()).st_size
+        self._compressed[tpart.name] = size
+        self._tar_bytes += _tar_size(tpart)
+        self._compressed_bytes += size
+
+    def finished(self, tpart):
+        self._compressing.pop(tpart.name, None)
+        self._compressed.pop(tpart.name, None)
+
+
+class _DeviceReaders(object):
+    """Holds back volumes while the devices they are read from are busy
+
+    Volumes are started in the order they were put, but for those of
+    devices already being read by readers_per_device volumes, which
+    are passed over until one of those is read.  Without a limit,
+    volumes are simply started in order.
+    """
+
+    def __init__(self, readers_per_device=None):
+        self.readers_per_device = readers_per_device
+        self.held = []
+        self.reading = collections.Counter()
+
+    def __len__(self):
+        return len(self.held)
+
+    def hold(self, tpart):
+        self.held.append(tpart)
+
+    def ready(self):
+        """Return the first volume held that can be read now, if any"""
+        for tpart in self.held:
+            if (self.readers_per_device is None or
+                    self.reading[tpart.device] < self.readers_per_device):
+                return tpart
+
+        return None
+
+    def discard(self, tpart):
+        self.held.remove(tpart)
+
+    def started(self, tpart):
+        self.held.remove(tpart)
+        self.reading[tpart.device] += 1
+
+    def read(self, tpart):
+        self.reading[tpart.device] -= 1
+
+
+class _Backoff(object):
+    """Logs volumes held back by a VolumeBudget, now and then"""
+
+    def __init__(self):
+        self.warned_at = None
+
+    def refused(self, reason):
+        now = time.time()
+        if (self.warned_at is None or
+                now - self.warned_at >= BACKOFF_WARNING_INTERVAL):
+            self.warned_at = now
+            logger.warning(
+                msg='holding back volumes from compression',
+                detail=reason + '.')
+
+
+def _refused_alone(reason):
+    """The error of a volume refused with nothing else in progress
+
+    No volume finishing will make room for it then.
+    """
+    return UserException(
+        msg='not enough room to compress a volume',
+        detail=reason + ', with no other volumes in progress.',
+        hint=('Free up space in the temporary directory, point TMPDIR '
+              'at another, or lower --min-temp-free.'))
 
 
 class TarUploadPool(object):
     def __init__(self, uploader, max_concurrency,
-                 max_members=tar_partition.PARTITION_MAX_MEMBERS):
+                 max_members=tar_partition.PARTITION_MAX_MEMBERS,
+                 budget=None, readers_per_device=None):
         # Injected upload mechanism
         self.uploader = uploader
 
+        # A VolumeBudget admitting volumes, or None.
+        self.budget = budget
+        self._backoff = _Backoff()
+
+        # Volumes put but not yet started.
+        self._devices = _DeviceReaders(readers_per_device)
+
         # Concurrency maximums
         self.max_members = max_members
         self.max_concurrency = max_concurrency
@@ -36,6 +265,9 @@ class TarUploadPool(object):
         self.concurrency_burden += 1
 
         self.member_burden += len(tpart)
+        if self.budget is not None:
+            self.budget.started(tpart)
+        self._devices.started(tpart)
 
         g.start()
 
@@ -53,12 +285,15 @@ class TarUploadPool(object):
         else:
             self.wait_change.put(g.exception)
 
-    def _wait(self):
-        """Block until an upload finishes
+    def _wait(self, timeout=None):
+        """Block until an upload finishes, or timeout seconds pass
 
         Raise an exception if that tar volume failed with an error.
         """
-        val = self.wait_change.get()
+        try:
+            val = self.wait_change.get(timeout=timeout)
+        except queue.Empty:
+            return
 
         if isinstance(val, Exception):
             # Don't other uncharging, because execution is going to stop
@@ -67,19 +302,37 @@ class TarUploadPool(object):
             # Uncharge for resources.
             self.member_burden -= len(val)
             self.concurrency_burden -= 1
+            if self.budget is not None:
+                self.budget.finished(val)
+            self._devices.read(val)
 
     def put(self, tpart):
         """Upload a tar volume
 
         Blocks if there is too much work outstanding already, and
         raise errors of previously submitted greenlets that die
-        unexpectedly.
+        unexpectedly.  With readers_per_device, a volume of a busy
+        device may be held back instead, up to MAX_HELD_VOLUMES.
         """
         if self.closed:
             raise UserCritical(msg='attempt to upload tar after closing',
                                hint='report a bug')
 
+        self._devices.hold(tpart)
+        self._schedule(MAX_HELD_VOLUMES)
+
+    def _schedule(self, max_held):
+        """Start volumes held until no more than max_held are left"""
         while True:
+            tpart = self._devices.ready()
+            if tpart is None:
+                if len(self._devices) <= max_held:
+                    return
+
+                # Every volume held is of a busy device.
+                self._wait()
+                continue
+
             too_many = (
                 self.concurrency_burden + 1 > self.max_concurrency
                 or self.member_burden + len(tpart) > self.max_members
@@ -91,6 +344,7 @@ class TarUploadPool(object):
                 # has gone wrong: the user should not be given enough
                 # rope to hang themselves in this way.
                 if self.concurrency_burden == 0:
+                    self._devices.discard(tpart)
                     raise UserCritical(
                         msg=('not enough resources in pool to '
                              'support an upload'),
@@ -106,15 +360,228 @@ class TarUploadPool(object):
                 # and cause the process to regard the upload as a
                 # failure.
                 self._wait()
-                gc.collect()
+                continue
+
+            refusal = None
+            if self.budget is not None:
+                refusal = self.budget.refusal(tpart,
+                                              self.concurrency_burden)
+
+            if refusal is not None:
+                if self.concurrency_burden == 0:
+                    self._devices.discard(tpart)
+                    raise _refused_alone(refusal)
+
+                # Back off until an upload finishes or, should the
+                # budget be short for other reasons, for a while.
+                self._backoff.refused(refusal)
+                self._wait(timeout=BACKOFF_INTERVAL)
             else:
                 # Enough resources available: commence upload
                 self._start(tpart)
-                return
 
     def join(self):
         """Wait for uploads to exit, raising errors as necessary."""
         self.closed = True
+        self._schedule(0)
 
         while self.concurrency_burden > 0:
             self._wait()
+
+
+class StagedTarUploadPool(object):
+    """Compress and upload tar volumes in separate stages
+
+    Up to compress_concurrency volumes are compressed into temporary
+    files at once.  Finished volumes wait in a queue of at most
+    max_queued entries, from which upload_concurrency uploaders take
+    them.  Compressing keeps the disk busy while uploading keeps the
+    network busy, so that neither waits on the other as long as the
+    queue is neither empty nor full.
+
+    A full queue stalls compression, and so bounds the number of
+    temporary files in existence.  A VolumeBudget, if passed as
+    budget, bounds the bytes they take up as well.
+
+    With readers_per_device, no more than that many volumes read
+    from the same device are compressed at once, others being started
+    ahead of them meanwhile.
+    """
+
+    def __init__(self, uploader, compress_concurrency, upload_concurrency,
+                 max_members=tar_partition.PARTITION_MAX_MEMBERS,
+                 max_queued=None, budget=None, readers_per_device=None):
+        # Injected compression and upload mechanism
+        self.uploader = uploader
+
+        self.budget = budget
+        self._backoff = _Backoff()
+
+        # Volumes put but not yet started.
+        self._devices = _DeviceReaders(readers_per_device)
+
+        # Concurrency maximums
+        self.max_members = max_members
+        self.compress_concurrency = compress_concurrency
+        self.upload_concurrency = upload_concurrency
+
+        if max_queued is None:
+            max_queued = upload_concurrency
+
+        # Current concurrency burden
+        self.member_burden = 0
+        self.compress_burden = 0
+
+        # Number of volumes put but not yet uploaded.
+        self.outstanding = 0
+
+        # Compressed volumes awaiting upload.
+        self.volumes = queue.Queue(maxsize=max_queued)
+
+        # Progress and failures of both stages, in order of
+        # occurrence.  Unbounded so that reporting never blocks.
+        self.events = queue.Queue()
+        self.closed = False
+
+        self.uploaders = [gevent.spawn(self._upload_volumes)
+                          for i in xrange(upload_concurrency)]
+
+    def _compress(self, tpart):
+        """Compress a volume and hand it over to the uploaders.
+
+        The compression slot is held until the volume is queued.
+        """
+        try:
+            volume = self.uploader.compress(tpart)
+            if self.budget is not None:
+                self.budget.compressed(tpart, volume)
+            self.volumes.put((tpart, volume))
+        except Exception, e:
+            self.events.put(e)
+        else:
+            self.events.put((_COMPRESSED, tpart))
+
+    def _upload_volumes(self):
+        """Upload queued volumes until told to stop with None."""
+        while True:
+            item = self.volumes.get()
+            if item is None:
+                return
+
+            tpart, volume = item
+            try:
+                self.uploader.upload(tpart, volume)
+            except Exception, e:
+                self.events.put(e)
+            else:
+                self.events.put((_UPLOADED, tpart))
+
+    def _start(self, tpart):
+        """Start compression and account for resource consumption."""
+        self.compress_burden += 1
+        self.member_burden += len(tpart)
+        self.outstanding += 1
+        if self.budget is not None:
+            self.budget.started(tpart)
+        self._devices.started(tpart)
+
+        gevent.spawn(self._compress, tpart)
+
+    def _wait(self, timeout=None):
+        """Block until a volume finishes either stage, or timeout
+        seconds pass
+
+        Raise an exception if that tar volume failed with an error.
+        """
+        try:
+            val = self.events.get(timeout=timeout)
+        except queue.Empty:
+            return
+
+        if isinstance(val, Exception):
+            # Don't bother uncharging, because execution is going to
+            # stop
+            raise val
+
+        stage, tpart = val
+        if stage is _COMPRESSED:
+            self.compress_burden -= 1
+            self._devices.read(tpart)
+        else:
+            assert stage is _UPLOADED
+            self.member_burden -= len(tpart)
+            self.outstanding -= 1
+            if self.budget is not None:
+                self.budget.finished(tpart)
+
+    def put(self, tpart):
+        """Compress and upload a tar volume
+
+        Blocks if there is too much work outstanding already, and
+        raise errors of previously submitted volumes that failed in
+        either stage.  With readers_per_device, a volume of a busy
+        device may be held back instead, up to MAX_HELD_VOLUMES.
+        """
+        if self.closed:
+            raise UserCritical(msg='attempt to upload tar after closing',
+                               hint='report a bug')
+
+        self._devices.hold(tpart)
+        self._schedule(MAX_HELD_VOLUMES)
+
+    def _schedule(self, max_held):
+        """Start volumes held until no more than max_held are left"""
+        while True:
+            tpart = self._devices.ready()
+            if tpart is None:
+                if len(self._devices) <= max_held:
+                    return
+
+                self._wait()
+                continue
+
+            too_many = (
+                self.compress_burden + 1 > self.compress_concurrency
+                or self.member_burden + len(tpart) > self.max_members
+            )
+
+            if too_many:
+                # As with TarUploadPool, a volume that cannot be
+                # scheduled with nothing else in progress indicates a
+                # bug.
+                if self.outstanding == 0:
+                    self._devices.discard(tpart)
+                    raise UserCritical(
+                        msg=('not enough resources in pool to '
+                             'support an upload'),
+                        hint='report a bug')
+
+                self._wait()
+                continue
+
+            refusal = None
+            if self.budget is not None:
+                refusal = self.budget.refusal(tpart, self.outstanding)
+
+            if refusal is not None:
+                if self.outstanding == 0:
+                    self._devices.discard(tpart)
+                    raise _refused_alone(refusal)
+
+                self._backoff.refused(refusal)
+                self._wait(timeout=BACKOFF_INTERVAL)
+            else:
+                self._start(tpart)
+
+    def join(self):
+        """Wait for uploads to exit, raising errors as necessary."""
+        self.closed = True
+        self._schedule(0)
+
+        while self.outstanding > 0:
+            self._wait()
+
+        for g in self.uploaders:
+            self.volumes.put(None)
+
+        gevent.joinall(self.uploaders)
@@ -8,6 +8,7 @@ with the intention that they are used in gevent greenlets.
 import gevent
 import re
 
+from wal_e import compression
 from wal_e import log_help
 from wal_e import storage
 from wal_e.blobstore import wabs
@@ -29,6 +30,11 @@ class TarPartitionLister(object):
         self.backup_info = backup_info
 
     def __iter__(self):
+        for name, size in self.volumes():
+            yield name
+
+    def volumes(self):
+        """Yield the name and size of every volume of the backup"""
         prefix = self.layout.basebackup_tar_partition_directory(
             self.backup_info)
 
@@ -46,19 +52,26 @@ class TarPartitionLister(object):
                             .format(url)),
                     hint=generic_weird_key_hint_message)
             else:
-                yield name_last_part
+                yield name_last_part, blob.properties.content_length
 
 
 class BackupFetcher(object):
-    def __init__(self, wabs_conn, layout, backup_info, local_root, decrypt):
+    def __init__(self, wabs_conn, layout, backup_info, local_root, decrypt,
+                 chunks=None, download_conns=None, durability=None):
         self.wabs_conn = wabs_conn
         self.layout = layout
         self.local_root = local_root
         self.backup_info = backup_info
         self.decrypt = decrypt
+        self.chunks = chunks
+        self.durability = durability
+
+        # With more than one connection, volumes are fetched in
+        # ranges over all of them at once.
+        self.download_conns = download_conns or []
 
-    @retry()
-    def fetch_partition(self, partition_name):
+    def fetch_partition_once(self, partition_name, members=None):
+        """Fetch and extract a volume, without retrying on failure"""
         part_abs_name = self.layout.basebackup_tar_partition(
             self.backup_info, partition_name)
 
@@ -70,16 +83,26 @@ class BackupFetcher(object):
 
         url = 'wabs://{ctr}/{path}'.format(ctr=self.layout.store_name(),
                                            path=part_abs_name)
-        with get_download_pipeline(PIPE, PIPE, self.decrypt) as pl:
-            g = gevent.spawn(wabs.write_and_return_error,
-                             url, self.wabs_conn, pl.stdin)
-            TarPartition.tarfile_extract(pl.stdout, self.local_root)
+        with get_download_pipeline(
+                PIPE, PIPE, self.decrypt,
+                codec=compression.codec_for_name(partition_name)) as pl:
+            if len(self.download_conns) > 1:
+                g = gevent.spawn(wabs.write_ranges_and_return_error,
+                                 url, self.download_conns, pl.stdin)
+            else:
+                g = gevent.spawn(wabs.write_and_return_error,
+                                 url, self.wabs_conn, pl.stdin)
+            TarPartition.tarfile_extract(pl.stdout, self.local_root,
+                                         members, self.chunks,
+                                         self.durability)
 
             # Raise any exceptions from self._write_and_close
             exc = g.get()
             if exc is not None:
                 raise exc
 
+    fetch_partition = retry()(fetch_partition_once)
+
 
 class BackupList(_BackupList):
 
@@ -1,6 +1,7 @@
 import tempfile
 import time
 
+from wal_e import checksum
 from wal_e import pipebuf
 from wal_e import storage
 from wal_e.blobstore import get_blobstore
@@ -13,31 +14,46 @@ def uri_put_file(creds, uri, fp, content_encoding=None):
                                   content_encoding=content_encoding)
 
 
-def do_lzop_put(creds, url, local_path, gpg_key):
+def do_lzop_put(creds, url, local_path, gpg_key, compression=None,
+                checksums=None):
     """
     Compress and upload a given local path.
 
+    The file and the object uploaded are digested on the way, into
+    checksums if a checksum.Checksums is passed, and the digests
+    stored with the object.
+
     :type url: string
     :param url: A (s3|wabs)://bucket/key style URL that is the destination
 
     :type local_path: string
     :param local_path: a path to a file to be compressed
 
+    :type compression: compression.Compression
+    :param compression: how to compress the file, lzop by default
+
     """
-    assert url.endswith('.lzo')
+    assert url.endswith('.lzo' if compression is None
+                        else compression.suffix)
     blobstore = get_blobstore(storage.StorageLayout(url))
 
+    if checksums is None:
+        checksums = checksum.Checksums()
+
     with tempfile.NamedTemporaryFile(
             mode='r+b', bufsize=pipebuf.PIPE_BUF_BYTES) as tf:
         with pipeline.get_upload_pipeline(
-                open(local_path, 'r'), tf, gpg_key=gpg_key):
+                open(local_path, 'r'), tf, gpg_key=gpg_key,
+                compression=compression, checksums=checksums):
             pass
 
         tf.flush()
 
         clock_start = time.time()
         tf.seek(0)
-        k = blobstore.uri_put_file(creds, url, tf)
+        k = blobstore.uri_put_file(creds, url, tf,
+                                   metadata=checksums.metadata(),
+                                   content_md5=checksums.content_md5())
         clock_finish = time.time()
 
         kib_per_second = format_kib_per_second(
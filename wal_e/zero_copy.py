@@ -0,0 +1,58 @@
+"""
+Moving file contents into pipes without copying them through Python.
+
+On Linux, splice(2) moves bytes from a file into a pipe without
+copying them to user space.  Python 2 has no splice, so it is called
+from libc through ctypes.  AVAILABLE tells whether it can be.
+
+It is called with SPLICE_F_NONBLOCK, so that a full pipe raises
+EAGAIN rather than blocking the process.
+
+"""
+import ctypes
+import ctypes.util
+import os
+import sys
+
+# Linux's values of these constants.
+SPLICE_F_MOVE = 1
+SPLICE_F_NONBLOCK = 2
+
+
+def _load_libc():
+    if not sys.platform.startswith('linux'):
+        return None
+
+    try:
+        libc = ctypes.CDLL(ctypes.util.find_library('c'), use_errno=True)
+        splice = libc.splice
+    except (OSError, AttributeError):
+        return None
+
+    splice.argtypes = [ctypes.c_int, ctypes.c_void_p, ctypes.c_int,
+                       ctypes.c_void_p, ctypes.c_size_t, ctypes.c_uint]
+    splice.restype = ctypes.c_ssize_t
+
+    return dict(splice=splice)
+
+
+_libc = _load_libc()
+
+AVAILABLE = _libc is not None
+
+
+def _check(n):
+    if n < 0:
+        e = ctypes.get_errno()
+        raise OSError(e, os.strerror(e))
+    return n
+
+
+def splice(fd_in, fd_out, length):
+    """Move up to length bytes from fd_in to fd_out, one being a pipe
+
+    Both are read and written at their current offsets.  Returns the
+    number of bytes moved, 0 at the end of fd_in.
+    """
+    return _check(_libc['splice'](fd_in, None, fd_out, None, length,
+                                  SPLICE_F_MOVE | SPLICE_F_NONBLOCK))